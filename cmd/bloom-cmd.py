@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import sys, glob, tempfile
+import sys
 from bup import options, git, bloom
 from bup.helpers import *
 
@@ -10,7 +10,7 @@ ruin       ruin the specified bloom file (clearing the bitfield)
 f,force    ignore existing bloom file and regenerate it from scratch
 o,output=  output bloom filename (default: auto)
 d,dir=     input directory to look for idx files (default: auto)
-k,hashes=  number of hash functions to use (4 or 5) (default: auto)
+k,hashes=  number of hash functions to use (1 to 8) (default: 5)
 c,check=   check the given .idx file against the bloom filter
 """
 
@@ -21,8 +21,10 @@ def ruin_bloom(bloomfilename):
         log("%s\n" % bloomfilename)
         add_error("bloom: %s not found to ruin\n" % rbloomfilename)
         return
-    b = bloom.ShaBloom(bloomfilename, readwrite=True, expected=1)
-    b.map[16:16+2**b.bits] = '\0' * 2**b.bits
+    for name in [bloomfilename] + bloom.layer_filenames(bloomfilename):
+        b = bloom.ShaBloom(name, readwrite=True, expected=1)
+        b.map[16:16+2**b.bits] = '\0' * 2**b.bits
+    git.bump_pack_generation(os.path.dirname(bloomfilename))
 
 
 def check_bloom(path, bloomfilename, idx):
@@ -31,7 +33,7 @@ def check_bloom(path, bloomfilename, idx):
     if not os.path.exists(bloomfilename):
         log("bloom: %s: does not exist.\n" % rbloomfilename)
         return
-    b = bloom.ShaBloom(bloomfilename)
+    b = bloom.LayeredBloom(bloomfilename)
     if not b.valid():
         add_error("bloom: %r is invalid.\n" % rbloomfilename)
         return
@@ -52,80 +54,10 @@ def check_bloom(path, bloomfilename, idx):
 _first = None
 def do_bloom(path, outfilename):
     global _first
-    b = None
-    if os.path.exists(outfilename) and not opt.force:
-        b = bloom.ShaBloom(outfilename)
-        if not b.valid():
-            debug1("bloom: Existing invalid bloom found, regenerating.\n")
-            b = None
-
-    add = []
-    rest = []
-    add_count = 0
-    rest_count = 0
-    for i,name in enumerate(glob.glob('%s/*.idx' % path)):
-        progress('bloom: counting: %d\r' % i)
-        ix = git.open_idx(name)
-        ixbase = os.path.basename(name)
-        if b and (ixbase in b.idxnames):
-            rest.append(name)
-            rest_count += len(ix)
-        else:
-            add.append(name)
-            add_count += len(ix)
-    total = add_count + rest_count
-
-    if not add:
-        debug1("bloom: nothing to do.\n")
-        return
-
-    if b:
-        if len(b) != rest_count:
-            debug1("bloom: size %d != idx total %d, regenerating\n"
-                   % (len(b), rest_count))
-            b = None
-        elif (b.bits < bloom.MAX_BLOOM_BITS and
-              b.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
-            debug1("bloom: regenerating: adding %d entries gives "
-                   "%.2f%% false positives.\n"
-                   % (add_count, b.pfalse_positive(add_count)))
-            b = None
-        else:
-            b = bloom.ShaBloom(outfilename, readwrite=True, expected=add_count)
-    if not b: # Need all idxs to build from scratch
-        add += rest
-        add_count += rest_count
-    del rest
-    del rest_count
-
-    msg = b is None and 'creating from' or 'adding'
     if not _first: _first = path
     dirprefix = (_first != path) and git.repo_rel(path)+': ' or ''
-    progress('bloom: %s%s %d file%s (%d object%s).\n'
-        % (dirprefix, msg,
-           len(add), len(add)!=1 and 's' or '',
-           add_count, add_count!=1 and 's' or ''))
-
-    tfname = None
-    if b is None:
-        tfname = os.path.join(path, 'bup.tmp.bloom')
-        b = bloom.create(tfname, expected=add_count, k=opt.k)
-    count = 0
-    icount = 0
-    for name in add:
-        ix = git.open_idx(name)
-        qprogress('bloom: writing %.2f%% (%d/%d objects)\r' 
-                  % (icount*100.0/add_count, icount, add_count))
-        b.add_idx(ix)
-        count += 1
-        icount += len(ix)
-
-    # Currently, there's an open file object for tfname inside b.
-    # Make sure it's closed before rename.
-    b.close()
-
-    if tfname:
-        os.rename(tfname, outfilename)
+    git.update_bloom(path, outfilename, force=opt.force, k=opt.k,
+                     prefixstr=dirprefix)
 
 
 handle_ctrl_c()
@@ -138,8 +70,8 @@ if extra:
 
 git.check_repo_or_die()
 
-if not opt.check and opt.k and opt.k not in (4,5):
-    o.fatal('only k values of 4 and 5 are supported')
+if not opt.check and opt.k and not 1 <= opt.k <= bloom.MAX_BLOOM3_K:
+    o.fatal('only k values from 1 to %d are supported' % bloom.MAX_BLOOM3_K)
 
 paths = opt.dir and [opt.dir] or git.all_packdirs()
 for path in paths:
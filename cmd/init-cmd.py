@@ -1,14 +1,17 @@
 #!/usr/bin/env python
-import sys
+import sys, glob
 
-from bup import git, options, client
+from bup import git, options, client, hashsplit
 from bup.helpers import *
 
 
 optspec = """
-[BUP_DIR=...] bup init [-r host:path]
+[BUP_DIR=...] bup init [-r host:path] [--blobbits=bits] [--windowbits=bits] [--chunker=name]
 --
 r,remote=  remote repository path
+blobbits=  split files into chunks of 2^bits bytes on average
+windowbits=  base split points on the last 2^bits bytes
+chunker=   how to choose split points (rollsum or gear)
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -17,12 +20,33 @@ if extra:
     o.fatal("no arguments expected")
 
 
+if opt.remote and (opt.blobbits or opt.windowbits or opt.chunker):
+    o.fatal('--blobbits, --windowbits, and --chunker only apply to the'
+            ' local repository')
+
 try:
     git.init_repo()  # local repo
 except git.GitError, e:
     log("bup: error: could not init repository: %s" % e)
     sys.exit(1)
 
+if opt.blobbits or opt.windowbits or opt.chunker:
+    try:
+        old = hashsplit.split_params(git.git_config_get)
+        new = (opt.blobbits or old[0], opt.windowbits or old[1],
+               opt.chunker or old[2])
+        hashsplit.configure(*new)
+    except ValueError, e:
+        o.fatal(str(e))
+    if new != old and glob.glob(git.repo('objects/pack/*.pack')):
+        # Changing them now would split the same data differently.
+        log('bup: error: repository already contains data split with'
+            ' blobbits=%d, windowbits=%d, chunker=%s\n' % old)
+        sys.exit(1)
+    git.git_config_set('bup.blobbits', new[0])
+    git.git_config_set('bup.windowbits', new[1])
+    git.git_config_set('bup.chunker', new[2])
+
 if opt.remote:
     git.check_repo_or_die()
     cli = client.Client(opt.remote, create=True)
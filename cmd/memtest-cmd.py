@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 import sys, re, struct, time, resource
-from bup import git, bloom, midx, options, _helpers
+from bup import git, bloom, midx, hidx, options, _helpers
 from bup.helpers import *
 
 handle_ctrl_c()
@@ -111,6 +111,10 @@ if midx._total_searches:
     print ('midx: %d objects searched in %d steps: avg %.3f steps/object' 
            % (midx._total_searches, midx._total_steps,
               midx._total_steps*1.0/midx._total_searches))
+if hidx._total_searches:
+    print ('hidx: %d objects searched in %d steps: avg %.3f steps/object' 
+           % (hidx._total_searches, hidx._total_steps,
+              hidx._total_steps*1.0/hidx._total_searches))
 if git._total_searches:
     print ('idx: %d objects searched in %d steps: avg %.3f steps/object' 
            % (git._total_searches, git._total_steps,
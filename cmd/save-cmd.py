@@ -24,7 +24,12 @@ f,indexfile=  the name of the index file (normally BUP_DIR/bupindex)
 strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
-#,compress=  set compression level to # (0-9, 9 is highest) [1]
+#,compress=  set compression level to # (0-9, 9 is highest)
+compress-meta=  set compression level for trees and metadata (0-9)
+adaptive-compress  don't compress data that doesn't seem compressible
+meta-packs  write trees and metadata to packs of their own
+j,jobs=    number of threads to use for hashing and compressing files [1]
+append-only  only split the new data at the end of files that have grown
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -39,6 +44,8 @@ opt.progress = (istty2 and not opt.quiet)
 opt.smaller = parse_num(opt.smaller or 0)
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 if opt.date:
     date = parse_date_or_fatal(opt.date, o.fatal)
@@ -70,6 +77,11 @@ is_reverse = os.environ.get('BUP_SERVER_REVERSE')
 if is_reverse and opt.remote:
     o.fatal("don't use -r in reverse mode; it's automatic")
 
+if opt.append_only and (opt.remote or is_reverse):
+    o.fatal("--append-only only works with a local repository")
+if opt.meta_packs and (opt.remote or is_reverse):
+    o.fatal("--meta-packs only works with a local repository")
+
 if opt.name and opt.name.startswith('.'):
     o.fatal("'%s' is not a valid branch name" % opt.name)
 refname = opt.name and 'refs/heads/%s' % opt.name or None
@@ -80,11 +92,33 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+config_get = cli and cli.config_get or git.git_config_get
+
+try:
+    (level, meta_level) = git.compression_levels(config_get, opt.compress,
+                                                 opt.compress_meta)
+except ValueError, e:
+    log('error: invalid compression level: %s\n' % e)
+    sys.exit(1)
+if cli:
+    w = cli.new_packwriter(compression_level=level, jobs=opt.jobs,
+                           adaptive=opt.adaptive_compress,
+                           meta_compression_level=meta_level)
+else:
+    w = git.PackWriter(compression_level=level, jobs=opt.jobs,
+                       adaptive=opt.adaptive_compress,
+                       meta_compression_level=meta_level,
+                       meta_packs=opt.meta_packs)
+
+# Always split the way the destination repository was set up to.
+try:
+    hashsplit.configure(*hashsplit.split_params(config_get))
+except ValueError, e:
+    log('error: invalid repository split settings: %s\n' % e)
+    sys.exit(1)
 
 handle_ctrl_c()
 
@@ -137,9 +171,9 @@ def _pop(force_tree, dir_metadata=None):
         sorted_metalist = sorted(metalist, key = lambda x : x[0])
         metadata = ''.join([m[1].encode() for m in sorted_metalist])
         metadata_f = StringIO(metadata)
-        mode, id = hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
-                                                   [metadata_f],
-                                                   keep_boundaries=False)
+        mode, id = hashsplit.split_to_blob_or_tree(
+            lambda blob: w.new_blob(blob, meta=True), w.new_tree,
+            [metadata_f], keep_boundaries=False)
         shalist.append((mode, '.bupm', id))
     tree = force_tree or w.new_tree(shalist)
     if shalists:
@@ -151,6 +185,31 @@ def _pop(force_tree, dir_metadata=None):
 
 
 lastremain = None
+def read_tree(sha):
+    it = git.cp().get(sha.encode('hex'))
+    type = it.next()
+    if type != 'tree':
+        raise git.GitError('%s is a %s, not a tree' % (sha.encode('hex'), type))
+    return list(git.tree_decode(''.join(it)))
+
+
+def append_point(f, ent):
+    """Return where to start splitting f (see hashsplit.append_point()),
+    or None to split all of it."""
+    if ent.gitmode != GIT_MODE_TREE or ent.sha == index.EMPTY_SHA:
+        return None
+    r = None
+    try:
+        r = hashsplit.append_point(f, ent.gitmode, ent.sha, read_tree)
+    except (KeyError, git.GitError), e:
+        # Most likely a tree that's only in some other repository.
+        if opt.verbose:
+            log('%s: previous tree not found (%s)\n' % (ent.name, e))
+    if not r:
+        f.seek(0)
+    return r
+
+
 def progress_report(n):
     global count, subcount, lastremain
     subcount += n
@@ -375,9 +434,25 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
                 lastskip_name = ent.name
             else:
                 try:
-                    (mode, id) = hashsplit.split_to_blob_or_tree(
-                                            w.new_blob, w.new_tree, [f],
-                                            keep_boundaries=False)
+                    stacks = None
+                    if opt.append_only:
+                        r = append_point(f, ent)
+                        if r:
+                            (ofs, stacks) = r
+                            if opt.progress:
+                                progress_report(ofs)
+                    if opt.jobs > 1 and ent.size >= hashsplit.BLOB_READ_SIZE:
+                        # Only worth starting threads for larger files.
+                        (mode, id) = hashsplit.split_to_blob_or_tree(
+                                                w.write_prepared, w.new_tree,
+                                                [f], keep_boundaries=False,
+                                                prepare=w.prepare_blob,
+                                                jobs=opt.jobs, stacks=stacks)
+                    else:
+                        (mode, id) = hashsplit.split_to_blob_or_tree(
+                                                w.new_blob, w.new_tree, [f],
+                                                keep_boundaries=False,
+                                                stacks=stacks)
                 except (IOError, OSError), e:
                     add_error('%s: %s' % (ent.name, e))
                     lastskip_name = ent.name
@@ -444,6 +519,12 @@ if opt.commit or opt.name:
 
 msr.close()
 w.close()  # must close before we can update the ref
+if opt.verbose:
+    log('Repeated objects: %d hits, %d misses\n'
+        % (w.repeats.hits, w.repeats.misses))
+    if w.adaptive:
+        log('Stored uncompressed: %d objects, %d bytes (%d sampled)\n'
+            % (w.adaptive.stored, w.adaptive.stored_bytes, w.adaptive.sampled))
         
 if opt.name:
     if cli:
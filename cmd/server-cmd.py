@@ -63,6 +63,37 @@ def send_index(conn, name):
     conn.ok()
 
 
+def _write_objects(conn, w, objs, suggested):
+    if dumb_server_mode:
+        oldpacks = [None] * len(objs)
+    else:
+        oldpacks = w.exists_many([sha for sha, crc, buf in objs],
+                                 want_source=True)
+    for (shar, crcr, buf), oldpack in zip(objs, oldpacks):
+        if oldpack:
+            assert(not oldpack == True)
+            assert(oldpack.endswith('.idx'))
+            (dir,name) = os.path.split(oldpack)
+            if not (name in suggested):
+                debug1("bup server: suggesting index %s\n"
+                       % git.shorten_hash(name))
+                debug1("bup server:   because of object %s\n"
+                       % shar.encode('hex'))
+                conn.write('index %s\n' % name)
+                suggested.add(name)
+            continue
+        nw, crc = w._raw_write((buf,), sha=shar)
+        _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
+
+
+# Received objects are checked against the index in batches, which is
+# much faster than one at a time.  A batch ends when it reaches this
+# many objects or bytes, or when the client has nothing more for us
+# yet, so that it still hears about our indexes as soon as it would
+# have without batching.
+OBJ_BATCH = 256
+OBJ_BATCH_BYTES = 1024*1024
+
 def receive_objects_v2(conn, junk):
     global suspended_w
     _init_session()
@@ -75,6 +106,8 @@ def receive_objects_v2(conn, junk):
             w = git.PackWriter(objcache_maker=None)
         else:
             w = git.PackWriter()
+    objs = []
+    objs_size = 0
     while 1:
         ns = conn.read(4)
         if not ns:
@@ -82,6 +115,8 @@ def receive_objects_v2(conn, junk):
             raise Exception('object read: expected length header, got EOF\n')
         n = struct.unpack('!I', ns)[0]
         #debug2('expecting %d bytes\n' % n)
+        if not n or n == 0xffffffff:
+            _write_objects(conn, w, objs, suggested)
         if not n:
             debug1('bup server: received %d object%s.\n' 
                 % (w.count, w.count!=1 and "s" or ''))
@@ -103,22 +138,13 @@ def receive_objects_v2(conn, junk):
         buf = conn.read(n)  # object sizes in bup are reasonably small
         #debug2('read %d bytes\n' % n)
         _check(w, n, len(buf), 'object read: expected %d bytes, got %d\n')
-        if not dumb_server_mode:
-            oldpack = w.exists(shar, want_source=True)
-            if oldpack:
-                assert(not oldpack == True)
-                assert(oldpack.endswith('.idx'))
-                (dir,name) = os.path.split(oldpack)
-                if not (name in suggested):
-                    debug1("bup server: suggesting index %s\n"
-                           % git.shorten_hash(name))
-                    debug1("bup server:   because of object %s\n"
-                           % shar.encode('hex'))
-                    conn.write('index %s\n' % name)
-                    suggested.add(name)
-                continue
-        nw, crc = w._raw_write((buf,), sha=shar)
-        _check(w, crcr, crc, 'object read: expected crc %d, got %d\n')
+        objs.append((shar, crcr, buf))
+        objs_size += n
+        if (len(objs) >= OBJ_BATCH or objs_size >= OBJ_BATCH_BYTES
+            or not conn.has_input()):
+            _write_objects(conn, w, objs, suggested)
+            objs = []
+            objs_size = 0
     # NOTREACHED
     
 
@@ -143,6 +169,14 @@ def update_ref(conn, refname):
     conn.ok()
 
 
+def config_get(conn, name):
+    _init_session()
+    assert(name.find('\n') < 0)
+    value = git.git_config_get(name)
+    conn.write('%s\n' % (value or '').strip())
+    conn.ok()
+
+
 cat_pipe = None
 def cat(conn, id):
     global cat_pipe
@@ -184,6 +218,7 @@ commands = {
     'read-ref': read_ref,
     'update-ref': update_ref,
     'cat': cat,
+    'config-get': config_get,
 }
 
 # FIXME: this protocol is totally lame and not at all future-proof.
@@ -8,6 +8,7 @@ optspec = """
 bup split [-t] [-c] [-n name] OPTIONS [--git-ids | filenames...]
 bup split -b OPTIONS [--git-ids | filenames...]
 bup split <--noop [--copy]|--copy>  OPTIONS [--git-ids | filenames...]
+bup split --bench-chunkers OPTIONS [--git-ids | filenames...]
 --
  Modes:
 b,blobs    output a series of blob ids.  Implies --fanout=0.
@@ -16,6 +17,7 @@ c,commit   output a commit id
 n,name=    save the result under the given name
 noop       split the input, but throw away the result
 copy       split the input, copy it to stdout, don't save to repo
+bench-chunkers  compare the chunkers on the start of the input
  Options:
 r,remote=  remote repository path
 d,date=    date for the commit (seconds since the epoch)
@@ -28,7 +30,10 @@ max-pack-size=  maximum bytes in a single pack
 max-pack-objects=  maximum number of objects in a single pack
 fanout=    average number of blobs in a single tree
 bwlimit=   maximum bytes/sec to transmit to server
-#,compress=  set compression level to # (0-9, 9 is highest) [1]
+#,compress=  set compression level to # (0-9, 9 is highest)
+compress-meta=  set compression level for trees and commits (0-9)
+adaptive-compress  don't compress data that doesn't seem compressible
+j,jobs=    number of threads to use for hashing and compressing [1]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -36,15 +41,21 @@ o = options.Options(optspec)
 handle_ctrl_c()
 git.check_repo_or_die()
 if not (opt.blobs or opt.tree or opt.commit or opt.name or
-        opt.noop or opt.copy):
-    o.fatal("use one or more of -b, -t, -c, -n, --noop, --copy")
+        opt.noop or opt.copy or opt.bench_chunkers):
+    o.fatal("use one or more of -b, -t, -c, -n, --noop, --copy, "
+            "--bench-chunkers")
 if (opt.noop or opt.copy) and (opt.blobs or opt.tree or
                                opt.commit or opt.name):
     o.fatal('--noop and --copy are incompatible with -b, -t, -c, -n')
+if opt.bench_chunkers and (opt.blobs or opt.tree or opt.commit or opt.name
+                           or opt.noop or opt.copy):
+    o.fatal('--bench-chunkers is incompatible with the other modes')
 if opt.blobs and (opt.tree or opt.commit or opt.name):
     o.fatal('-b is incompatible with -t, -c, -n')
 if extra and opt.git_ids:
     o.fatal("don't provide filenames when using --git-ids")
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 if opt.verbose >= 2:
     git.verbose = opt.verbose - 1
@@ -64,6 +75,8 @@ if opt.date:
 else:
     date = time.time()
 
+BENCH_CHUNKERS_SIZE = 64*1024*1024
+
 total_bytes = 0
 def prog(filenum, nbytes):
     global total_bytes
@@ -83,16 +96,41 @@ start_time = time.time()
 if opt.name and opt.name.startswith('.'):
     o.fatal("'%s' is not a valid branch name." % opt.name)
 refname = opt.name and 'refs/heads/%s' % opt.name or None
-if opt.noop or opt.copy:
+if opt.noop or opt.copy or opt.bench_chunkers:
     cli = pack_writer = oldref = None
 elif opt.remote or is_reverse:
     cli = client.Client(opt.remote)
     oldref = refname and cli.read_ref(refname) or None
-    pack_writer = cli.new_packwriter(compression_level=opt.compress)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    pack_writer = git.PackWriter(compression_level=opt.compress)
+config_get = cli and cli.config_get or git.git_config_get
+
+if not (opt.noop or opt.copy or opt.bench_chunkers):
+    try:
+        (level, meta_level) = git.compression_levels(config_get,
+                                                     opt.compress,
+                                                     opt.compress_meta)
+    except ValueError, e:
+        log('error: invalid compression level: %s\n' % e)
+        sys.exit(1)
+    if cli:
+        pack_writer = cli.new_packwriter(compression_level=level,
+                                         jobs=opt.jobs,
+                                         adaptive=opt.adaptive_compress,
+                                         meta_compression_level=meta_level)
+    else:
+        pack_writer = git.PackWriter(compression_level=level,
+                                     jobs=opt.jobs,
+                                     adaptive=opt.adaptive_compress,
+                                     meta_compression_level=meta_level)
+
+# Always split the way the destination repository was set up to.
+try:
+    hashsplit.configure(*hashsplit.split_params(config_get))
+except ValueError, e:
+    log('error: invalid repository split settings: %s\n' % e)
+    sys.exit(1)
 
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
@@ -129,33 +167,73 @@ else:
     # the input either comes from a series of files or from stdin.
     files = extra and (open(fn) for fn in extra) or [sys.stdin]
 
+if pack_writer and opt.jobs > 1:
+    makeblob = pack_writer.write_prepared
+    prepare = pack_writer.prepare_blob
+elif pack_writer:
+    makeblob = pack_writer.new_blob
+    prepare = None
+
 if pack_writer and opt.blobs:
-    shalist = hashsplit.split_to_blobs(pack_writer.new_blob, files,
+    shalist = hashsplit.split_to_blobs(makeblob, files,
                                        keep_boundaries=opt.keep_boundaries,
-                                       progress=prog)
+                                       progress=prog,
+                                       prepare=prepare, jobs=opt.jobs)
     for (sha, size, level) in shalist:
         print sha.encode('hex')
         reprogress()
 elif pack_writer:  # tree or commit or name
     if opt.name: # insert dummy_name which may be used as a restore target
         mode, sha = \
-            hashsplit.split_to_blob_or_tree(pack_writer.new_blob,
+            hashsplit.split_to_blob_or_tree(makeblob,
                                             pack_writer.new_tree,
                                             files,
                                             keep_boundaries=opt.keep_boundaries,
-                                            progress=prog)
+                                            progress=prog,
+                                            prepare=prepare, jobs=opt.jobs)
         splitfile_name = git.mangle_name('data', hashsplit.GIT_MODE_FILE, mode)
         shalist = [(mode, splitfile_name, sha)]
     else:
         shalist = hashsplit.split_to_shalist(
-                      pack_writer.new_blob, pack_writer.new_tree, files,
-                      keep_boundaries=opt.keep_boundaries, progress=prog)
+                      makeblob, pack_writer.new_tree, files,
+                      keep_boundaries=opt.keep_boundaries, progress=prog,
+                      prepare=prepare, jobs=opt.jobs)
     tree = pack_writer.new_tree(shalist)
+elif opt.bench_chunkers:
+    # Compare the chunkers on the same input, which we keep in memory so
+    # that only the splitting itself is timed.  Only the start of it is
+    # used, so that any input fits.
+    def read_sample(f, size):
+        l = []
+        while size > 0:
+            b = f.read(min(size, 1024*1024))
+            if not b:
+                break
+            l.append(b)
+            size -= len(b)
+        return ''.join(l)
+    datalist = []
+    left = BENCH_CHUNKERS_SIZE
+    for f in files:
+        datalist.append(read_sample(f, left))
+        left -= len(datalist[-1])
+        if not left:
+            break
+    if not opt.keep_boundaries:
+        datalist = [''.join(datalist)]
+    hashsplit.total_split = size = sum(len(d) for d in datalist)
+    for (name, secs, count, unique) in hashsplit.bench_chunkers(datalist):
+        log('%s: %d chunks of %d bytes on average, %.2f GB/s, '
+            'dedup ratio %.2f\n'
+            % (name, count, size / max(count, 1),
+               size / 1e9 / max(secs, 0.000001),
+               size / float(max(unique, 1))))
 else:
     last = 0
     it = hashsplit.hashsplit_iter(files,
                                   keep_boundaries=opt.keep_boundaries,
-                                  progress=prog)
+                                  progress=prog,
+                                  readahead=(opt.jobs > 1))
     for (blob, level) in it:
         hashsplit.total_split += len(blob)
         if opt.copy:
@@ -177,6 +255,13 @@ if opt.commit or opt.name:
 
 if pack_writer:
     pack_writer.close()  # must close before we can update the ref
+    if opt.bench:
+        log('bup: repeated objects: %d hits, %d misses\n'
+            % (pack_writer.repeats.hits, pack_writer.repeats.misses))
+        if pack_writer.adaptive:
+            a = pack_writer.adaptive
+            log('bup: stored uncompressed: %d objects, %d bytes '
+                '(%d sampled)\n' % (a.stored, a.stored_bytes, a.sampled))
 
 if opt.name:
     if cli:
@@ -360,11 +360,93 @@ static PyObject *selftest(PyObject *self, PyObject *args)
 }
 
 
+// The hashsplit parameters, normally those of the repository.
+static int split_blobbits = BUP_BLOBBITS;
+static int split_windowbits = BUP_WINDOWBITS;
+static int split_chunker = 0;
+
+static const char *chunker_names[] = { "rollsum", "gear", NULL };
+
+
+static int find_ofs(const unsigned char *buf, int len, int *bits)
+{
+    if (split_chunker == 1)
+	return bupsplit_gear_find_ofs(buf, len, bits, split_blobbits);
+    return bupsplit_find_ofs_with(buf, len, bits,
+				  split_blobbits, split_windowbits);
+}
+
+
 static PyObject *blobbits(PyObject *self, PyObject *args)
 {
     if (!PyArg_ParseTuple(args, ""))
 	return NULL;
-    return Py_BuildValue("i", BUP_BLOBBITS);
+    return Py_BuildValue("i", split_blobbits);
+}
+
+
+static PyObject *windowbits(PyObject *self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ""))
+	return NULL;
+    return Py_BuildValue("i", split_windowbits);
+}
+
+
+static PyObject *chunker(PyObject *self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ""))
+	return NULL;
+    return Py_BuildValue("s", chunker_names[split_chunker]);
+}
+
+
+static PyObject *set_split_params(PyObject *self, PyObject *args)
+{
+    int blobbits, windowbits, i;
+    const char *name = chunker_names[0];
+
+    if (!PyArg_ParseTuple(args, "ii|s", &blobbits, &windowbits, &name))
+	return NULL;
+    for (i = 0; chunker_names[i]; i++)
+	if (!strcmp(chunker_names[i], name))
+	    break;
+    if (!chunker_names[i])
+	return PyErr_Format(PyExc_ValueError,
+			    "chunker must be rollsum or gear, not %s", name);
+    if (blobbits < BUP_MIN_BLOBBITS || blobbits > BUP_MAX_BLOBBITS)
+	return PyErr_Format(PyExc_ValueError,
+			    "blobbits must be between %d and %d, not %d",
+			    BUP_MIN_BLOBBITS, BUP_MAX_BLOBBITS, blobbits);
+    if (windowbits < BUP_MIN_WINDOWBITS || windowbits > BUP_MAX_WINDOWBITS)
+	return PyErr_Format(PyExc_ValueError,
+			    "windowbits must be between %d and %d, not %d",
+			    BUP_MIN_WINDOWBITS, BUP_MAX_WINDOWBITS, windowbits);
+    split_blobbits = blobbits;
+    split_windowbits = windowbits;
+    split_chunker = i;
+    Py_RETURN_NONE;
+}
+
+
+static PyObject *rollsum_impl(PyObject *self, PyObject *args)
+{
+    if (!PyArg_ParseTuple(args, ""))
+	return NULL;
+    return Py_BuildValue("s", bupsplit_rollsum_impl());
+}
+
+
+static PyObject *set_rollsum_impl(PyObject *self, PyObject *args)
+{
+    const char *name;
+
+    if (!PyArg_ParseTuple(args, "s", &name))
+	return NULL;
+    if (bupsplit_set_rollsum_impl(name) < 0)
+	return PyErr_Format(PyExc_ValueError,
+			    "no rollsum implementation called %s", name);
+    Py_RETURN_NONE;
 }
 
 
@@ -377,12 +459,119 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
     if (!PyArg_ParseTuple(args, "t#", &buf, &len))
 	return NULL;
     assert(len <= INT_MAX);
-    out = bupsplit_find_ofs(buf, len, &bits);
-    if (out) assert(bits >= BUP_BLOBBITS);
+    // The buffer is kept alive by args, so other threads can run while
+    // we scan it.
+    Py_BEGIN_ALLOW_THREADS;
+    out = find_ofs(buf, len, &bits);
+    Py_END_ALLOW_THREADS;
+    if (out) assert(bits >= split_blobbits);
     return Py_BuildValue("ii", out, bits);
 }
 
 
+struct split_point
+{
+    int ofs;
+    int bits;
+};
+
+
+// Find all of the split points in buf, exactly as repeated calls to
+// splitbuf() would, except that no chunk may be longer than blob_max;
+// longer chunks are cut at blob_max and reported with bits == 0.
+// Once no more natural split points are found, the remainder is cut
+// into blob_max sized pieces (without searching them) as long as
+// there's enough of it left.  Returns the number of points stored in
+// *points (which the caller must free), or -1 if we run out of memory.
+static int find_split_points(const unsigned char *buf, int len, int blob_max,
+			     struct split_point **points)
+{
+    int n = 0, size = 0, start = 0, searching = 1;
+    struct split_point *p = NULL;
+
+    while (1)
+    {
+	int ofs, bits = 0;
+	if (n == size)
+	{
+	    struct split_point *np;
+	    size = size ? size * 2 : 256;
+	    np = realloc(p, size * sizeof(*p));
+	    if (!np)
+	    {
+		free(p);
+		return -1;
+	    }
+	    p = np;
+	}
+	ofs = 0;
+	if (searching && start < len)
+	    ofs = find_ofs(buf + start, len - start, &bits);
+	if (ofs)
+	{
+	    if (ofs > blob_max)
+	    {
+		ofs = blob_max;
+		bits = 0;
+	    }
+	}
+	else if (len - start >= blob_max)
+	{
+	    searching = 0;
+	    ofs = blob_max;
+	}
+	else
+	    break;
+	start += ofs;
+	p[n].ofs = start;
+	p[n].bits = bits;
+	n++;
+    }
+    *points = p;
+    return n;
+}
+
+
+static PyObject *splitbuf_all(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0;
+    int blob_max = 0, n, i;
+    struct split_point *points = NULL;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#i", &buf, &len, &blob_max))
+	return NULL;
+    assert(len <= INT_MAX);
+    if (blob_max <= 0)
+	return PyErr_Format(PyExc_ValueError, "blob_max must be positive");
+    Py_BEGIN_ALLOW_THREADS;
+    n = find_split_points(buf, len, blob_max, &points);
+    Py_END_ALLOW_THREADS;
+    if (n < 0)
+	return PyErr_NoMemory();
+
+    result = PyList_New(n);
+    if (!result)
+	goto clean_and_return;
+    for (i = 0; i < n; i++)
+    {
+	PyObject *pt = Py_BuildValue("ii", points[i].ofs, points[i].bits);
+	if (!pt)
+	{
+	    Py_DECREF(result);
+	    result = NULL;
+	    goto clean_and_return;
+	}
+	PyList_SET_ITEM(result, i, pt);
+    }
+
+ clean_and_return:
+    free(points);
+    return result;
+}
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -555,6 +744,108 @@ static PyObject *bloom_contains(PyObject *self, PyObject *args)
 }
 
 
+// Version 3 filters are split into 64-byte blocks.  The first nbits-6
+// bits of a sha pick its block, and each of the next k 9-bit fields
+// picks one bit within it, so a lookup only touches one cache line.
+#define BLOOM3_BLOCK_BYTES 64
+#define BLOOM3_BLOCK_SHIFT 6
+#define BLOOM3_BIT_BITS 9
+#define BLOOM3_MAX_BITS 37
+
+// Return the n (<= 32) bits of sha starting at bit pos.
+static uint32_t sha_bits(const unsigned char *sha, int pos, int n)
+{
+    uint64_t v = 0;
+    int i;
+    for (i = pos / 8; i < (pos + n + 7) / 8; i++)
+        v = (v << 8) | sha[i];
+    v >>= (8 - (pos + n) % 8) % 8;
+    return v & (((uint64_t)1 << n) - 1);
+}
+
+static int bloom3_check_args(Py_ssize_t blen, int nbits, int k)
+{
+    if (nbits < BLOOM3_BLOCK_SHIFT || nbits > BLOOM3_MAX_BITS
+        || k < 1 || nbits - BLOOM3_BLOCK_SHIFT + k * BLOOM3_BIT_BITS > 160)
+    {
+        PyErr_Format(PyExc_ValueError,
+                     "unsupported bloom size 2^%d with k=%d", nbits, k);
+        return 0;
+    }
+    if (blen < BLOOM2_HEADERLEN + ((Py_ssize_t)1 << nbits))
+    {
+        PyErr_Format(PyExc_ValueError, "bloom map is too small");
+        return 0;
+    }
+    return 1;
+}
+
+static unsigned char *bloom3_block(unsigned char *bloom,
+                                   const unsigned char *sha, int nbits)
+{
+    int block_bits = nbits - BLOOM3_BLOCK_SHIFT;
+    uint64_t block = block_bits ? sha_bits(sha, 0, block_bits) : 0;
+    return bloom + BLOOM2_HEADERLEN + (block << BLOOM3_BLOCK_SHIFT);
+}
+
+static PyObject *bloom3_add(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block;
+    unsigned char *end;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i;
+
+    if (!PyArg_ParseTuple(args, "w#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+    if (!bloom3_check_args(blen, nbits, k))
+        return NULL;
+    if (len % 20 != 0)
+    {
+        PyErr_Format(PyExc_ValueError, "shas must be a list of 20-byte shas");
+        return NULL;
+    }
+
+    for (end = sha + len; sha < end; sha += 20)
+    {
+        block = bloom3_block(bloom, sha, nbits);
+        for (i = 0; i < k; i++)
+        {
+            int pos = nbits - BLOOM3_BLOCK_SHIFT + i * BLOOM3_BIT_BITS;
+            uint32_t bit = sha_bits(sha, pos, BLOOM3_BIT_BITS);
+            block[bit >> 3] |= 1 << (bit & 7);
+        }
+    }
+    return Py_BuildValue("n", len/20);
+}
+
+static PyObject *bloom3_contains(PyObject *self, PyObject *args)
+{
+    unsigned char *sha = NULL, *bloom = NULL, *block;
+    Py_ssize_t len = 0, blen = 0;
+    int nbits = 0, k = 0, i;
+
+    if (!PyArg_ParseTuple(args, "t#s#ii", &bloom, &blen, &sha, &len, &nbits, &k))
+	return NULL;
+    if (!bloom3_check_args(blen, nbits, k))
+        return NULL;
+    if (len != 20)
+    {
+        PyErr_Format(PyExc_ValueError, "sha must be 20 bytes");
+        return NULL;
+    }
+
+    block = bloom3_block(bloom, sha, nbits);
+    for (i = 0; i < k; i++)
+    {
+        int pos = nbits - BLOOM3_BLOCK_SHIFT + i * BLOOM3_BIT_BITS;
+        uint32_t bit = sha_bits(sha, pos, BLOOM3_BIT_BITS);
+        if (!(block[bit >> 3] & (1 << (bit & 7))))
+            return Py_BuildValue("Oi", Py_None, i + 1);
+    }
+    return Py_BuildValue("ii", 1, k);
+}
+
+
 static uint32_t _extract_bits(unsigned char *buf, int nbits)
 {
     uint32_t v, mask;
@@ -592,6 +883,8 @@ struct idx {
     struct sha *cur;
     struct sha *end;
     uint32_t *cur_name;
+    uint32_t *cur_ofs;
+    unsigned char *ofs64;
     Py_ssize_t bytes;
     int name_base;
 };
@@ -653,19 +946,25 @@ static uint32_t _get_idx_i(struct idx *idx)
     return ntohl(*idx->cur_name) + idx->name_base;
 }
 
-#define MIDX4_HEADERLEN 12
+// A version 5 midx: the header ('MIDX', version, bits and the number
+// of 64-bit offsets), the fanout, the shas, the number of the idx each
+// one came from, and the objects' offsets in their packs, as in a
+// version 2 idx: 31 bits, or the index of a 64-bit offset in the table
+// that follows if the top bit is set.
+#define MIDX5_HEADERLEN 16
 
 static PyObject *merge_into(PyObject *self, PyObject *args)
 {
-    PyObject *py_total, *ilist = NULL;
+    PyObject *py_total, *ilist = NULL, *result = NULL;
     unsigned char *fmap = NULL;
     struct sha *sha_ptr, *sha_start = NULL;
-    uint32_t *table_ptr, *name_ptr, *name_start;
+    uint32_t *table_ptr, *name_ptr, *name_start, *ofs_ptr;
+    uint64_t *ofs64_ptr, *ofs64_end;
     struct idx **idxs = NULL;
     Py_ssize_t flen = 0;
     int bits = 0, i;
     unsigned int total;
-    uint32_t count, prefix;
+    uint32_t count, prefix, ofs64_count;
     int num_i;
     int last_i;
 
@@ -676,35 +975,57 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     if (!bup_uint_from_py(&total, py_total, "total"))
         return NULL;
 
+    if (flen < MIDX5_HEADERLEN + ((Py_ssize_t)4 << bits)
+        + (Py_ssize_t)total * (sizeof(struct sha) + 8))
+    {
+        PyErr_Format(PyExc_ValueError, "midx map is too small");
+        return NULL;
+    }
+
     num_i = PyList_Size(ilist);
     idxs = (struct idx **)PyMem_Malloc(num_i * sizeof(struct idx *));
+    if (!idxs)
+        return PyErr_NoMemory();
+    memset(idxs, 0, num_i * sizeof(struct idx *));
+    last_i = num_i-1;
 
     for (i = 0; i < num_i; i++)
     {
-	long len, sha_ofs, name_map_ofs;
+	long len, sha_ofs, name_map_ofs, ofs_ofs, ofs64_ofs;
 	idxs[i] = (struct idx *)PyMem_Malloc(sizeof(struct idx));
+        if (!idxs[i])
+        {
+            PyErr_NoMemory();
+            goto clean_and_return;
+        }
 	PyObject *itup = PyList_GetItem(ilist, i);
-	if (!PyArg_ParseTuple(itup, "t#llli", &idxs[i]->map, &idxs[i]->bytes,
-		    &len, &sha_ofs, &name_map_ofs, &idxs[i]->name_base))
-	    return NULL;
+	if (!PyArg_ParseTuple(itup, "t#lllill", &idxs[i]->map, &idxs[i]->bytes,
+		    &len, &sha_ofs, &name_map_ofs, &idxs[i]->name_base,
+                    &ofs_ofs, &ofs64_ofs))
+	    goto clean_and_return;
 	idxs[i]->cur = (struct sha *)&idxs[i]->map[sha_ofs];
 	idxs[i]->end = &idxs[i]->cur[len];
 	if (name_map_ofs)
 	    idxs[i]->cur_name = (uint32_t *)&idxs[i]->map[name_map_ofs];
 	else
 	    idxs[i]->cur_name = NULL;
+        idxs[i]->cur_ofs = (uint32_t *)&idxs[i]->map[ofs_ofs];
+        idxs[i]->ofs64 = &idxs[i]->map[ofs64_ofs];
     }
-    table_ptr = (uint32_t *)&fmap[MIDX4_HEADERLEN];
+    table_ptr = (uint32_t *)&fmap[MIDX5_HEADERLEN];
     sha_start = sha_ptr = (struct sha *)&table_ptr[1<<bits];
     name_start = name_ptr = (uint32_t *)&sha_ptr[total];
+    ofs_ptr = &name_ptr[total];
+    ofs64_ptr = (uint64_t *)&ofs_ptr[total];
+    ofs64_end = (uint64_t *)&fmap[flen];
 
-    last_i = num_i-1;
     count = 0;
     prefix = 0;
+    ofs64_count = 0;
     while (last_i >= 0)
     {
 	struct idx *idx;
-	uint32_t new_prefix;
+	uint32_t new_prefix, ofs;
 	if (count % 102424 == 0 && istty2)
 	    fprintf(stderr, "midx: writing %.2f%% (%d/%d)\r",
 		    count*100.0/total, count, total);
@@ -714,9 +1035,25 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
 	    table_ptr[prefix++] = htonl(count);
 	memcpy(sha_ptr++, idx->cur, sizeof(struct sha));
 	*name_ptr++ = htonl(_get_idx_i(idx));
+        ofs = ntohl(*idx->cur_ofs);
+        if (ofs & 0x80000000)
+        {
+            const unsigned char *ofs64 = idx->ofs64 + 8 * (ofs & 0x7fffffff);
+            if (ofs64 + 8 > idx->map + idx->bytes || ofs64_ptr >= ofs64_end)
+            {
+                PyErr_Format(PyExc_ValueError,
+                             "64-bit offset table overflow at object %u",
+                             count);
+                goto clean_and_return;
+            }
+            memcpy(ofs64_ptr++, ofs64, 8);
+            ofs = 0x80000000 | ofs64_count++;
+        }
+        *ofs_ptr++ = htonl(ofs);
 	++idx->cur;
 	if (idx->cur_name != NULL)
 	    ++idx->cur_name;
+        ++idx->cur_ofs;
 	_fix_idx_order(idxs, &last_i);
 	++count;
     }
@@ -726,37 +1063,83 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
     assert(prefix == (1<<bits));
     assert(sha_ptr == sha_start+count);
     assert(name_ptr == name_start+count);
+    ofs64_count = htonl(ofs64_count);
+    memcpy(&fmap[12], &ofs64_count, 4);
+
+    result = Py_BuildValue("kk", (unsigned long)count,
+                           (unsigned long)ntohl(ofs64_count));
 
+ clean_and_return:
+    // _fix_idx_order() frees the ones it's done with
+    for (i = 0; i <= last_i; i++)
+        PyMem_Free(idxs[i]);
     PyMem_Free(idxs);
-    return PyLong_FromUnsignedLong(count);
+    return result;
 }
 
 #define FAN_ENTRIES 256
 
+// The pending idx entries of a PackWriter: the sha, then the crc and
+// the offset in the pack, in network byte order (see git._IdxEntries).
+#define IDX_ENTRY_SIZE 32
+#define IDX_ENTRY_CRC 20
+#define IDX_ENTRY_OFS 24
+
+static int idx_entry_cmp(const void *a, const void *b)
+{
+    return memcmp(a, b, sizeof(struct sha));
+}
+
 static PyObject *write_idx(PyObject *self, PyObject *args)
 {
     char *filename = NULL;
-    PyObject *py_total, *idx = NULL;
-    PyObject *part;
-    unsigned char *fmap = NULL;
+    PyObject *py_total, *result = NULL;
+    Py_buffer entries_buf;
+    unsigned char *fmap = NULL, *entries;
     Py_ssize_t flen = 0;
     unsigned int total = 0;
-    uint32_t count;
-    int i, j, ofs64_count;
+    uint32_t count, fan[FAN_ENTRIES];
+    unsigned int i;
+    uint32_t ofs64_count;
     uint32_t *fan_ptr, *crc_ptr, *ofs_ptr;
     uint64_t *ofs64_ptr;
     struct sha *sha_ptr;
 
-    if (!PyArg_ParseTuple(args, "sw#OO",
-                          &filename, &fmap, &flen, &idx, &py_total))
+    // The entries are a bytearray, which only has the new buffer
+    // interface.
+    if (!PyArg_ParseTuple(args, "sw#w*O",
+                          &filename, &fmap, &flen, &entries_buf, &py_total))
 	return NULL;
+    entries = entries_buf.buf;
 
     if (!bup_uint_from_py(&total, py_total, "total"))
-        return NULL;
+        goto clean_and_return;
 
-    if (PyList_Size (idx) != FAN_ENTRIES) // Check for list of the right length.
-        return PyErr_Format (PyExc_TypeError, "idx must contain %d entries",
-                             FAN_ENTRIES);
+    if (entries_buf.len != (Py_ssize_t)total * IDX_ENTRY_SIZE)
+    {
+        PyErr_Format(PyExc_ValueError, "idx must contain %u %d-byte entries",
+                     total, IDX_ENTRY_SIZE);
+        goto clean_and_return;
+    }
+
+    memset(fan, 0, sizeof(fan));
+    ofs64_count = 0;
+    for (i = 0; i < total; i++)
+    {
+        const unsigned char *e = entries + i * IDX_ENTRY_SIZE;
+        fan[e[0]]++;
+        if (e[IDX_ENTRY_OFS] || e[IDX_ENTRY_OFS + 1] || e[IDX_ENTRY_OFS + 2]
+            || e[IDX_ENTRY_OFS + 3] || (e[IDX_ENTRY_OFS + 4] & 0x80))
+            ofs64_count++;
+    }
+    if (flen < 8 + FAN_ENTRIES * 4 + (Py_ssize_t)total * 28
+        + (Py_ssize_t)ofs64_count * 8)
+    {
+        PyErr_Format(PyExc_ValueError, "idx map is too small");
+        goto clean_and_return;
+    }
+
+    qsort(entries, total, IDX_ENTRY_SIZE, idx_entry_cmp);
 
     const char idx_header[] = "\377tOc\0\0\0\002";
     memcpy (fmap, idx_header, sizeof(idx_header) - 1);
@@ -768,53 +1151,415 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     ofs64_ptr = (uint64_t *)&ofs_ptr[total];
 
     count = 0;
-    ofs64_count = 0;
     for (i = 0; i < FAN_ENTRIES; ++i)
     {
-	int plen;
-	part = PyList_GET_ITEM(idx, i);
-	PyList_Sort(part);
-	plen = PyList_GET_SIZE(part);
-	count += plen;
-	*fan_ptr++ = htonl(count);
-	for (j = 0; j < plen; ++j)
-	{
-	    unsigned char *sha = NULL;
-	    Py_ssize_t sha_len = 0;
-            PyObject *crc_py, *ofs_py;
-	    unsigned int crc;
-            unsigned PY_LONG_LONG ofs_ull;
-	    uint64_t ofs;
-	    if (!PyArg_ParseTuple(PyList_GET_ITEM(part, j), "t#OO",
-				  &sha, &sha_len, &crc_py, &ofs_py))
-		return NULL;
-            if(!bup_uint_from_py(&crc, crc_py, "crc"))
-                return NULL;
-            if(!bup_ullong_from_py(&ofs_ull, ofs_py, "ofs"))
-                return NULL;
-            assert(crc <= UINT32_MAX);
-            assert(ofs_ull <= UINT64_MAX);
-	    ofs = ofs_ull;
-	    if (sha_len != sizeof(struct sha))
-		return NULL;
-	    memcpy(sha_ptr++, sha, sizeof(struct sha));
-	    *crc_ptr++ = htonl(crc);
-	    if (ofs > 0x7fffffff)
-	    {
-                *ofs64_ptr++ = htonll(ofs);
-		ofs = 0x80000000 | ofs64_count++;
-	    }
-	    *ofs_ptr++ = htonl((uint32_t)ofs);
-	}
+        count += fan[i];
+        *fan_ptr++ = htonl(count);
     }
 
-    int rc = msync(fmap, flen, MS_ASYNC);
-    if (rc != 0)
-	return PyErr_SetFromErrnoWithFilename(PyExc_IOError, filename);
+    ofs64_count = 0;
+    for (i = 0; i < total; i++)
+    {
+        const unsigned char *e = entries + i * IDX_ENTRY_SIZE;
+        uint64_t ofs;
+        memcpy(sha_ptr++, e, sizeof(struct sha));
+        memcpy(crc_ptr++, e + IDX_ENTRY_CRC, 4);
+        memcpy(&ofs, e + IDX_ENTRY_OFS, 8);
+        ofs = htonll(ofs); // it's its own inverse
+        if (ofs > 0x7fffffff)
+        {
+            memcpy(ofs64_ptr++, e + IDX_ENTRY_OFS, 8);
+            ofs = 0x80000000 | ofs64_count++;
+        }
+        *ofs_ptr++ = htonl((uint32_t)ofs);
+    }
+
+    if (msync(fmap, flen, MS_ASYNC) != 0)
+	PyErr_SetFromErrnoWithFilename(PyExc_IOError, filename);
+    else
+        result = PyLong_FromUnsignedLong(count);
+
+ clean_and_return:
+    PyBuffer_Release(&entries_buf);
+    return result;
+}
+
+
+static uint32_t sha_firstword(const unsigned char *sha)
+{
+    uint32_t v;
+    memcpy(&v, sha, 4);
+    return ntohl(v);
+}
+
+// Look a sha up in a sorted table of entry_size-byte entries that end
+// with the sha (an idx or midx shatable), given the table's fanout:
+// 2^bits big-endian counts, indexed by the first bits bits of a sha.
+// Since shas are evenly distributed, each step interpolates on their
+// first 32 bits rather than halving the range.
+static PyObject *find_sha(PyObject *self, PyObject *args)
+{
+    const unsigned char *fanout = NULL, *table = NULL, *sha = NULL;
+    Py_ssize_t flen = 0, tlen = 0, slen = 0, entry_size = 0, sha_ofs;
+    int bits = 0, steps;
+    uint32_t el, fan;
+    uint64_t start, end, startv, endv, hashv;
+
+    if (!PyArg_ParseTuple(args, "t#it#nt#", &fanout, &flen, &bits,
+                          &table, &tlen, &entry_size, &sha, &slen))
+	return NULL;
+    if (bits < 0 || bits > 30 || flen != (Py_ssize_t)4 << bits)
+    {
+        PyErr_Format(PyExc_ValueError, "fanout must have 2^%d entries", bits);
+        return NULL;
+    }
+    if (entry_size < (Py_ssize_t)sizeof(struct sha) || tlen % entry_size)
+    {
+        PyErr_Format(PyExc_ValueError,
+                     "table isn't a list of %zd-byte entries", entry_size);
+        return NULL;
+    }
+    if (slen != sizeof(struct sha))
+    {
+        PyErr_Format(PyExc_ValueError, "sha must be 20 bytes");
+        return NULL;
+    }
+    sha_ofs = entry_size - sizeof(struct sha);
+
+    el = bits ? sha_firstword(sha) >> (32 - bits) : 0;
+    if (el)
+    {
+        memcpy(&fan, fanout + (el - 1) * 4, 4);
+        start = ntohl(fan);
+    }
+    else
+        start = 0;
+    memcpy(&fan, fanout + el * 4, 4);
+    end = ntohl(fan);
+    if (start > end || end > (uint64_t)(tlen / entry_size))
+    {
+        PyErr_Format(PyExc_ValueError, "fanout doesn't match the table");
+        return NULL;
+    }
+    startv = (uint64_t)el << (32 - bits);
+    endv = (uint64_t)(el + 1) << (32 - bits);
+    hashv = sha_firstword(sha);
+
+    steps = 1; // the fanout is a step
+    while (start < end)
+    {
+        uint64_t mid;
+        const unsigned char *v;
+        int c;
+
+        steps++;
+        if (endv > startv)
+            mid = start + (hashv - startv) * (end - start - 1) / (endv - startv);
+        else // every sha left shares its first 32 bits
+            mid = start + (end - start) / 2;
+        v = table + mid * entry_size + sha_ofs;
+        c = memcmp(v, sha, sizeof(struct sha));
+        if (c < 0)
+        {
+            start = mid + 1;
+            startv = sha_firstword(v);
+        }
+        else if (c > 0)
+        {
+            end = mid;
+            endv = sha_firstword(v);
+        }
+        else
+            return Py_BuildValue("Ki", (unsigned PY_LONG_LONG)mid, steps);
+    }
+    return Py_BuildValue("Oi", Py_None, steps);
+}
+
+// Return the index of the first entry at or after lo whose sha isn't
+// less than want, galloping ahead since the next query is usually
+// close to the previous one.
+static Py_ssize_t find_sha_from(const unsigned char *table,
+                                Py_ssize_t entry_size, Py_ssize_t n,
+                                Py_ssize_t lo, const unsigned char *want)
+{
+    const Py_ssize_t sha_ofs = entry_size - sizeof(struct sha);
+    Py_ssize_t step = 1, hi;
+    while (lo + step < n
+           && memcmp(table + (lo + step) * entry_size + sha_ofs, want,
+                     sizeof(struct sha)) < 0)
+    {
+        lo += step;
+        step *= 2;
+    }
+    hi = lo + step < n ? lo + step : n;
+    while (lo < hi)
+    {
+        Py_ssize_t mid = lo + (hi - lo) / 2;
+        if (memcmp(table + mid * entry_size + sha_ofs, want,
+                   sizeof(struct sha)) < 0)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    return lo;
+}
+
+static PyObject *find_shas(PyObject *self, PyObject *args)
+{
+    const unsigned char *table = NULL, *shas = NULL;
+    Py_ssize_t tlen = 0, slen = 0, entry_size = 0, n, i, pos;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#nt#", &table, &tlen, &entry_size,
+                          &shas, &slen))
+	return NULL;
+    if (entry_size < (Py_ssize_t)sizeof(struct sha) || tlen % entry_size)
+    {
+        PyErr_Format(PyExc_ValueError,
+                     "table isn't a list of %zd-byte entries", entry_size);
+        return NULL;
+    }
+    if (slen % sizeof(struct sha))
+    {
+        PyErr_Format(PyExc_ValueError, "shas must be a list of 20-byte shas");
+        return NULL;
+    }
+    n = tlen / entry_size;
+    result = PyList_New(slen / sizeof(struct sha));
+    if (!result)
+        return NULL;
+    pos = 0;
+    for (i = 0; i < slen / (Py_ssize_t)sizeof(struct sha); i++)
+    {
+        const unsigned char *want = shas + i * sizeof(struct sha);
+        PyObject *found;
+        if (i && memcmp(want - sizeof(struct sha), want,
+                        sizeof(struct sha)) > 0)
+        {
+            Py_DECREF(result);
+            PyErr_Format(PyExc_ValueError, "shas must be sorted");
+            return NULL;
+        }
+        pos = find_sha_from(table, entry_size, n, pos, want);
+        if (pos < n && memcmp(table + pos * entry_size + entry_size
+                              - sizeof(struct sha), want,
+                              sizeof(struct sha)) == 0)
+            found = PyInt_FromSsize_t(pos);
+        else
+        {
+            found = Py_None;
+            Py_INCREF(found);
+        }
+        if (!found)
+        {
+            Py_DECREF(result);
+            return NULL;
+        }
+        PyList_SET_ITEM(result, i, found);
+    }
+    return result;
+}
+
+
+// A hash index (see hidx.py) is a header followed by an open addressing
+// table of 2^bits slots: a sha, the number of the idx it came from (from
+// 1, 0 for an empty slot), and the object's offset in that idx's pack,
+// both big-endian.  Shas are evenly distributed, so a sha's first bits
+// bits are its home slot, and on collisions the next free slot is used.
+#define HIDX_HEADERLEN 24
+#define HIDX_SLOT_SIZE 32
+#define HIDX_SLOT_WHICH 20
+#define HIDX_SLOT_OFS 24
+#define HIDX_MAX_BITS 40
+
+static int hidx_check_map(Py_ssize_t mlen, int bits)
+{
+    if (bits < 0 || bits > HIDX_MAX_BITS)
+    {
+        PyErr_Format(PyExc_ValueError, "hash index bits must be from 0 to %d",
+                     HIDX_MAX_BITS);
+        return 0;
+    }
+    if (mlen < HIDX_HEADERLEN + ((Py_ssize_t)HIDX_SLOT_SIZE << bits))
+    {
+        PyErr_Format(PyExc_ValueError, "hash index map is too small");
+        return 0;
+    }
+    return 1;
+}
+
+static int hidx_slot_empty(const unsigned char *slot)
+{
+    uint32_t which;
+    memcpy(&which, slot + HIDX_SLOT_WHICH, 4);
+    return which == 0;
+}
+
+// Return the slot holding sha, or else the empty slot it belongs in, or
+// -1 if the table is full.
+static int64_t hidx_probe(const unsigned char *table, int bits,
+                          const unsigned char *sha, int *steps)
+{
+    const uint64_t mask = ((uint64_t)1 << bits) - 1;
+    uint64_t i, n, v;
+
+    memcpy(&v, sha, 8);
+    i = bits ? htonll(v) >> (64 - bits) : 0;
+    for (n = 0; n <= mask; n++)
+    {
+        const unsigned char *slot = table + i * HIDX_SLOT_SIZE;
+        if (steps)
+            ++*steps;
+        if (hidx_slot_empty(slot)
+            || memcmp(slot, sha, sizeof(struct sha)) == 0)
+            return i;
+        i = (i + 1) & mask;
+    }
+    return -1;
+}
+
+static PyObject *hidx_find(PyObject *self, PyObject *args)
+{
+    const unsigned char *map = NULL, *sha = NULL, *table;
+    Py_ssize_t mlen = 0, slen = 0;
+    int bits = 0, steps = 0;
+    int64_t i;
+
+    if (!PyArg_ParseTuple(args, "t#it#", &map, &mlen, &bits, &sha, &slen))
+	return NULL;
+    if (!hidx_check_map(mlen, bits))
+        return NULL;
+    if (slen != sizeof(struct sha))
+    {
+        PyErr_Format(PyExc_ValueError, "sha must be 20 bytes");
+        return NULL;
+    }
+    table = map + HIDX_HEADERLEN;
+    i = hidx_probe(table, bits, sha, &steps);
+    if (i < 0 || hidx_slot_empty(table + i * HIDX_SLOT_SIZE))
+        return Py_BuildValue("Oi", Py_None, steps);
+    return Py_BuildValue("Ki", (unsigned PY_LONG_LONG)i, steps);
+}
 
-    return PyLong_FromUnsignedLong(count);
+// Put the objects of an idx (its sha table, with entry_size-byte
+// entries that end with the sha, and its offset tables) in the hash
+// index, skipping the ones that are already there, and return how many
+// were added.  For version 1 idx files (24-byte entries) the offsets
+// are in the entries themselves, and the offset tables are ignored.
+static PyObject *hidx_add(PyObject *self, PyObject *args)
+{
+    unsigned char *map = NULL, *table;
+    const unsigned char *shas = NULL, *ofs = NULL, *ofs64 = NULL;
+    Py_ssize_t mlen = 0, slen = 0, olen = 0, o64len = 0, entry_size = 0;
+    Py_ssize_t n, i;
+    int bits = 0;
+    unsigned int which = 0;
+    unsigned long long added = 0;
+
+    if (!PyArg_ParseTuple(args, "w#it#nt#t#I", &map, &mlen, &bits,
+                          &shas, &slen, &entry_size, &ofs, &olen,
+                          &ofs64, &o64len, &which))
+	return NULL;
+    if (!hidx_check_map(mlen, bits))
+        return NULL;
+    if ((entry_size != 20 && entry_size != 24) || slen % entry_size)
+    {
+        PyErr_Format(PyExc_ValueError,
+                     "table isn't a list of %zd-byte entries", entry_size);
+        return NULL;
+    }
+    n = slen / entry_size;
+    if (entry_size == 20 && olen < n * 4)
+    {
+        PyErr_Format(PyExc_ValueError, "offset table is too small");
+        return NULL;
+    }
+    if (!which)
+    {
+        PyErr_Format(PyExc_ValueError, "idx number must be nonzero");
+        return NULL;
+    }
+    table = map + HIDX_HEADERLEN;
+    for (i = 0; i < n; i++)
+    {
+        const unsigned char *entry = shas + i * entry_size;
+        const unsigned char *sha = entry + entry_size - sizeof(struct sha);
+        unsigned char *slot;
+        uint64_t o;
+        uint32_t o32;
+        int64_t s = hidx_probe(table, bits, sha, NULL);
+
+        if (s < 0)
+        {
+            PyErr_Format(PyExc_ValueError, "hash index is full");
+            return NULL;
+        }
+        slot = table + s * HIDX_SLOT_SIZE;
+        if (!hidx_slot_empty(slot))
+            continue;
+        memcpy(&o32, entry_size == 24 ? entry : ofs + i * 4, 4);
+        o = ntohl(o32);
+        if (entry_size == 20 && (o & 0x80000000))
+        {
+            Py_ssize_t i64 = o & 0x7fffffff;
+            if ((i64 + 1) * 8 > o64len)
+            {
+                PyErr_Format(PyExc_ValueError,
+                             "64-bit offset table overflow at object %zd", i);
+                return NULL;
+            }
+            memcpy(&o, ofs64 + i64 * 8, 8);
+            o = htonll(o);
+        }
+        // Fill in the idx number last, as it marks the slot used.
+        memcpy(slot, sha, sizeof(struct sha));
+        o = htonll(o);
+        memcpy(slot + HIDX_SLOT_OFS, &o, 8);
+        o32 = htonl(which);
+        memcpy(slot + HIDX_SLOT_WHICH, &o32, 4);
+        added++;
+    }
+    return PyLong_FromUnsignedLongLong(added);
 }
 
+// Move every used slot of the hash index in oldmap to the one in newmap,
+// and return how many there were.
+static PyObject *hidx_rehash(PyObject *self, PyObject *args)
+{
+    unsigned char *newmap = NULL, *newtable;
+    const unsigned char *oldmap = NULL, *oldtable;
+    Py_ssize_t newlen = 0, oldlen = 0;
+    int newbits = 0, oldbits = 0;
+    uint64_t i;
+    unsigned long long moved = 0;
+
+    if (!PyArg_ParseTuple(args, "w#it#i", &newmap, &newlen, &newbits,
+                          &oldmap, &oldlen, &oldbits))
+	return NULL;
+    if (!hidx_check_map(newlen, newbits) || !hidx_check_map(oldlen, oldbits))
+        return NULL;
+    newtable = newmap + HIDX_HEADERLEN;
+    oldtable = oldmap + HIDX_HEADERLEN;
+    for (i = 0; i < (uint64_t)1 << oldbits; i++)
+    {
+        const unsigned char *slot = oldtable + i * HIDX_SLOT_SIZE;
+        int64_t s;
+
+        if (hidx_slot_empty(slot))
+            continue;
+        s = hidx_probe(newtable, newbits, slot, NULL);
+        if (s < 0)
+        {
+            PyErr_Format(PyExc_ValueError, "hash index is full");
+            return NULL;
+        }
+        if (!hidx_slot_empty(newtable + s * HIDX_SLOT_SIZE))
+            continue;
+        memcpy(newtable + s * HIDX_SLOT_SIZE, slot, HIDX_SLOT_SIZE);
+        moved++;
+    }
+    return PyLong_FromUnsignedLongLong(moved);
+}
 
 // I would have made this a lower-level function that just fills in a buffer
 // with random values, and then written those values from python.  But that's
@@ -1297,8 +2042,20 @@ static PyMethodDef helper_methods[] = {
 	"Check that the rolling checksum rolls correctly (for unit tests)." },
     { "blobbits", blobbits, METH_VARARGS,
 	"Return the number of bits in the rolling checksum." },
+    { "windowbits", windowbits, METH_VARARGS,
+	"Return the number of bits in the rolling checksum window size." },
+    { "chunker", chunker, METH_VARARGS,
+	"Return the name of the chunking algorithm (rollsum or gear)." },
+    { "set_split_params", set_split_params, METH_VARARGS,
+	"Set the blobbits, windowbits, and chunker to use for splitting." },
+    { "rollsum_impl", rollsum_impl, METH_VARARGS,
+	"Return the name of the rollsum implementation in use." },
+    { "set_rollsum_impl", set_rollsum_impl, METH_VARARGS,
+	"Choose a rollsum implementation (see ROLLSUM_IMPLS) by name." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "splitbuf_all", splitbuf_all, METH_VARARGS,
+	"Return the (end offset, bits) of every hashsplit chunk in a buffer." },
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
@@ -1307,12 +2064,26 @@ static PyMethodDef helper_methods[] = {
 	"Check if a bloom filter of 2^nbits bytes contains an object" },
     { "bloom_add", bloom_add, METH_VARARGS,
 	"Add an object to a bloom filter of 2^nbits bytes" },
+    { "bloom3_contains", bloom3_contains, METH_VARARGS,
+	"Check if a version 3 (blocked) bloom filter contains an object" },
+    { "bloom3_add", bloom3_add, METH_VARARGS,
+	"Add objects to a version 3 (blocked) bloom filter" },
     { "extract_bits", extract_bits, METH_VARARGS,
 	"Take the first 'nbits' bits from 'buf' and return them as an int." },
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
-	"Write a PackIdxV2 file from an idx list of lists of tuples" },
+	"Write a PackIdxV2 file from a bytearray of pending idx entries" },
+    { "find_sha", find_sha, METH_VARARGS,
+	"Return (index or None, steps) of a sha in an idx or midx shatable" },
+    { "find_shas", find_shas, METH_VARARGS,
+	"Return where each of a sorted list of shas is in a sorted sha table" },
+    { "hidx_find", hidx_find, METH_VARARGS,
+	"Search a hash index for a sha, returning (slot or None, steps)." },
+    { "hidx_add", hidx_add, METH_VARARGS,
+	"Add the objects of an idx to a hash index." },
+    { "hidx_rehash", hidx_rehash, METH_VARARGS,
+	"Copy the entries of one hash index into another." },
     { "write_random", write_random, METH_VARARGS,
 	"Write random bytes to the given file descriptor" },
     { "random_sha", random_sha, METH_VARARGS,
@@ -1370,6 +2141,27 @@ PyMODINIT_FUNC init_helpers(void)
     if (m == NULL)
         return;
 
+    PyModule_AddIntConstant(m, "DEFAULT_BLOBBITS", BUP_BLOBBITS);
+    PyModule_AddIntConstant(m, "DEFAULT_WINDOWBITS", BUP_WINDOWBITS);
+    PyModule_AddStringConstant(m, "DEFAULT_CHUNKER", chunker_names[0]);
+    {
+	PyObject *impls;
+	int i, n;
+	for (n = 0; bupsplit_rollsum_impls[n]; n++)
+	    ;
+	impls = PyTuple_New(n);
+	if (!impls)
+	    return;
+	for (i = 0; i < n; i++)
+	    PyTuple_SET_ITEM(impls, i,
+			     PyString_FromString(bupsplit_rollsum_impls[i]));
+	PyModule_AddObject(m, "ROLLSUM_IMPLS", impls);
+    }
+#ifdef SEEK_HOLE
+    PyModule_AddIntConstant(m, "SEEK_DATA", SEEK_DATA);
+    PyModule_AddIntConstant(m, "SEEK_HOLE", SEEK_HOLE);
+#endif
+
 #pragma clang diagnostic push
 #pragma clang diagnostic ignored "-Wtautological-compare" // For INTEGER_TO_PY().
 #ifdef HAVE_UTIMENSAT
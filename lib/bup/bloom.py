@@ -78,14 +78,28 @@ table with k=5 can represent the repository.
 None of this tells us what max_pfalse_positive to choose.
 
 Brandon Low <lostlogic@lostlogicx.com> 2011-02-04
+
+Version 3 filters are "blocked": the table is split into 64 byte blocks
+(one cache line), the first bits of the SHA pick a block, and all k bits
+of an entry are set within that block, addressed by the 9 bit fields
+that follow.  A miss, which is the common case while saving new data,
+then costs one memory access (and at most one page fault) instead of k.
+Since entries aren't spread evenly across blocks, the false positive
+rate is somewhat higher than the table above for the same size; see
+pfalse_positive().  Addressing only needs bits-6+9*k bits of the SHA, so
+k isn't tied to the size of the table any more, and any k up to
+MAX_BLOOM3_K works.  Version 2 filters are still read and updated.
 """
-import sys, os, math, mmap
+import sys, os, math, mmap, re
 from bup import _helpers
 from bup.helpers import *
 
-BLOOM_VERSION = 2
+BLOOM_VERSION = 3
 MAX_BITS_EACH = 32 # Kinda arbitrary, but 4 bytes per entry is pretty big
-MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8)
+MAX_BLOOM_BITS = {4: 37, 5: 29} # 160/k-log2(8), for version 2
+MAX_BLOOM3_BITS = 37
+MAX_BLOOM3_K = 8
+BLOOM3_BLOCK_BITS = 8*64
 MAX_PFALSE_POSITIVE = 1. # Totally arbitrary, needs benchmarking
 
 _total_searches = 0
@@ -93,6 +107,8 @@ _total_steps = 0
 
 bloom_contains = _helpers.bloom_contains
 bloom_add = _helpers.bloom_add
+bloom3_contains = _helpers.bloom3_contains
+bloom3_add = _helpers.bloom3_add
 
 # FIXME: check bloom create() and ShaBloom handling/ownership of "f".
 # The ownership semantics should be clarified since the caller needs
@@ -104,6 +120,7 @@ class ShaBloom:
         self.name = filename
         self.rwfile = None
         self.map = None
+        self.version = None
         assert(filename.endswith('.bloom'))
         if readwrite:
             assert(expected > 0)
@@ -141,8 +158,8 @@ class ShaBloom:
         if got != 'BLOM':
             log('Warning: invalid BLOM header (%r) in %r\n' % (got, filename))
             return self._init_failed()
-        ver = struct.unpack('!I', self.map[4:8])[0]
-        if ver < BLOOM_VERSION:
+        self.version = ver = struct.unpack('!I', self.map[4:8])[0]
+        if ver < 2:
             log('Warning: ignoring old-style (v%d) bloom %r\n' 
                 % (ver, filename))
             return self._init_failed()
@@ -170,6 +187,13 @@ class ShaBloom:
     def valid(self):
         return self.map and self.bits
 
+    def max_bits(self):
+        """Return the largest table size (in bits of address) that this
+        filter's version and k allow."""
+        if self.version == 2:
+            return MAX_BLOOM_BITS[self.k]
+        return MAX_BLOOM3_BITS
+
     def __del__(self):
         self.close()
 
@@ -191,13 +215,32 @@ class ShaBloom:
         n = self.entries + additional
         m = 8*2**self.bits
         k = self.k
-        return 100*(1-math.exp(-k*float(n)/m))**k
+        if self.version == 2:
+            return 100*(1-math.exp(-k*float(n)/m))**k
+        # The number of entries in a block is Poisson distributed; sum
+        # the false positive rate of a block with i entries over the
+        # likely values of i.
+        per_block = float(n) * BLOOM3_BLOCK_BITS / m
+        if not per_block:
+            return 0.
+        spread = 10 * int(math.sqrt(per_block)) + 10
+        p = 0.
+        for i in xrange(max(0, int(per_block) - spread),
+                        int(per_block) + spread):
+            pblock = math.exp(-per_block + i * math.log(per_block)
+                              - math.lgamma(i + 1))
+            p += pblock * (1 - (1 - 1./BLOOM3_BLOCK_BITS)**(k*i))**k
+        return 100*p
 
     def add_idx(self, ix):
         """Add the object to the filter, return current pfalse_positive."""
         if not self.map:
             raise Exception("Cannot add to closed bloom")
-        self.entries += bloom_add(self.map, ix.shatable, self.bits, self.k)
+        if self.version == 2:
+            add = bloom_add
+        else:
+            add = bloom3_add
+        self.entries += add(self.map, ix.shatable, self.bits, self.k)
         self.idxnames.append(os.path.basename(ix.name))
 
     def exists(self, sha):
@@ -211,7 +254,11 @@ class ShaBloom:
         _total_searches += 1
         if not self.map:
             return None
-        found, steps = bloom_contains(self.map, str(sha), self.bits, self.k)
+        if self.version == 2:
+            contains = bloom_contains
+        else:
+            contains = bloom3_contains
+        found, steps = contains(self.map, str(sha), self.bits, self.k)
         _total_steps += steps
         return found
 
@@ -219,17 +266,78 @@ class ShaBloom:
         return int(self.entries)
 
 
-def create(name, expected, delaywrite=None, f=None, k=None):
+def layer_filenames(filename):
+    """Return the names of the layers that have been added on top of the
+    bloom filter in filename, oldest first."""
+    dir, base = os.path.split(filename)
+    pattern = re.compile(re.escape(base[:-len('.bloom')]) + r'\.(\d+)\.bloom$')
+    layers = []
+    for name in os.listdir(dir or '.'):
+        m = pattern.match(name)
+        if m:
+            layers.append((int(m.group(1)), os.path.join(dir, name)))
+    return [name for n, name in sorted(layers)]
+
+
+class LayeredBloom:
+    """The bloom filter in filename together with the layers added on
+    top of it since it was last regenerated.
+
+    Instead of regenerating a filter that's getting too full, new
+    objects can go in a new, bigger layer; see git.update_bloom().  An
+    object is in the filter if it's in any of the layers.
+    """
+    def __init__(self, filename):
+        self.name = filename
+        self.layers = [ShaBloom(filename)]
+        self.layers.extend(ShaBloom(name)
+                           for name in layer_filenames(filename))
+        self.idxnames = []
+        for layer in self.layers:
+            self.idxnames.extend(layer.idxnames)
+
+    def valid(self):
+        for layer in self.layers:
+            if not layer.valid():
+                return False
+        return True
+
+    def close(self):
+        for layer in self.layers:
+            layer.close()
+
+    def exists(self, sha):
+        """Return nonempty if the object probably exists in any layer."""
+        for layer in self.layers:
+            found = layer.exists(sha)
+            if found:
+                return found
+        return None
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.layers)
+
+
+def create(name, expected, delaywrite=None, f=None, k=None,
+           version=BLOOM_VERSION):
     """Create and return a bloom filter for `expected` entries."""
     bits = int(math.floor(math.log(expected*MAX_BITS_EACH/8,2)))
-    k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
-    if bits > MAX_BLOOM_BITS[k]:
+    if version == 2:
+        k = k or ((bits <= MAX_BLOOM_BITS[5]) and 5 or 4)
+        max_bits = MAX_BLOOM_BITS[k]
+    else:
+        assert(version == 3)
+        k = k or 5
+        assert(1 <= k <= MAX_BLOOM3_K)
+        max_bits = MAX_BLOOM3_BITS
+        bits = max(bits, 6)  # at least one block
+    if bits > max_bits:
         log('bloom: warning, max bits exceeded, non-optimal\n')
-        bits = MAX_BLOOM_BITS[k]
+        bits = max_bits
     debug1('bloom: using 2^%d bytes and %d hash functions\n' % (bits, k))
     f = f or open(name, 'w+b')
     f.write('BLOM')
-    f.write(struct.pack('!IHHI', BLOOM_VERSION, bits, k, 0))
+    f.write(struct.pack('!IHHI', version, bits, k, 0))
     assert(f.tell() == 16)
     # NOTE: On some systems this will not extend+zerofill, but it does on
     # darwin, linux, bsd and solaris.
@@ -30,18 +30,37 @@
 #ifndef __BUPSPLIT_H
 #define __BUPSPLIT_H
 
+// The defaults; see bupsplit_find_ofs_with() for other values.
 #define BUP_BLOBBITS (13)
 #define BUP_BLOBSIZE (1<<BUP_BLOBBITS)
 #define BUP_WINDOWBITS (6)
 #define BUP_WINDOWSIZE (1<<BUP_WINDOWBITS)
 
+#define BUP_MIN_BLOBBITS (10)
+#define BUP_MAX_BLOBBITS (20)
+#define BUP_MIN_WINDOWBITS (4)
+#define BUP_MAX_WINDOWBITS (12)
+
+// The gear hash only ever looks at the last 64 bytes.
+#define BUP_GEAR_WINDOWSIZE (64)
+
 #ifdef __cplusplus
 extern "C" {
 #endif
     
 int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits);
+int bupsplit_find_ofs_with(const unsigned char *buf, int len, int *bits,
+			   int blobbits, int windowbits);
+int bupsplit_gear_find_ofs(const unsigned char *buf, int len, int *bits,
+			   int blobbits);
 int bupsplit_selftest(void);
 
+// The names of the implementations of bupsplit_find_ofs_with(), which
+// all find the same split points (the first one is the default).
+extern const char *const bupsplit_rollsum_impls[];
+int bupsplit_set_rollsum_impl(const char *name);
+const char *bupsplit_rollsum_impl(void);
+
 #ifdef __cplusplus
 }
 #endif
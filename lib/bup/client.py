@@ -55,6 +55,7 @@ class Client:
     def __init__(self, remote, create=False):
         self._busy = self.conn = None
         self.sock = self.p = self.pout = self.pin = None
+        self._commands = None
         is_reverse = os.environ.get('BUP_SERVER_REVERSE')
         if is_reverse:
             assert(not remote)
@@ -173,6 +174,8 @@ class Client:
         debug1('client: removing extra indexes: %s\n' % extra)
         for idx in extra:
             os.unlink(os.path.join(self.cachedir, idx))
+        if extra:
+            git.bump_pack_generation(self.cachedir)
         debug1('client: server requested load of: %s\n' % needed)
         for idx in needed:
             self.sync_index(idx)
@@ -198,9 +201,10 @@ class Client:
                 qprogress('Receiving index from server: %d/%d\r' % (count, n))
             progress('Receiving index from server: %d/%d, done.\n' % (count, n))
             self.check_ok()
+        git.bump_pack_generation(self.cachedir)
 
     def _make_objcache(self):
-        return git.PackIdxList(self.cachedir)
+        return git.shared_pack_idx_list(self.cachedir)
 
     def _suggest_packs(self):
         ob = self._busy
@@ -234,7 +238,8 @@ class Client:
             self.conn.write('%s\n' % ob)
         return idx
 
-    def new_packwriter(self, compression_level = 1):
+    def new_packwriter(self, compression_level = 1, jobs = 1,
+                       adaptive = False, meta_compression_level = None):
         self.check_busy()
         def _set_busy():
             self._busy = 'receive-objects-v2'
@@ -245,7 +250,10 @@ class Client:
                                  onopen = _set_busy,
                                  onclose = self._not_busy,
                                  ensure_busy = self.ensure_busy,
-                                 compression_level = compression_level)
+                                 compression_level = compression_level,
+                                 jobs = jobs, adaptive = adaptive,
+                                 meta_compression_level
+                                     = meta_compression_level)
 
     def read_ref(self, refname):
         self.check_busy()
@@ -258,6 +266,37 @@ class Client:
         else:
             return None   # nonexistent ref
 
+    def server_commands(self):
+        """Return the set of commands the server understands."""
+        if self._commands is None:
+            self.check_busy()
+            self.conn.write('help\n')
+            commands = set()
+            for line in linereader(self.conn):
+                if not line:
+                    break
+                if line[0].isspace():
+                    commands.add(line.strip())
+            self.check_ok()
+            self._commands = commands
+        return self._commands
+
+    def config_get(self, name):
+        """Return the value of a git config option in the remote repository,
+        or None if it's not set.
+
+        Servers from before config-get don't have any such options, and
+        give up on the connection when they see a command they don't
+        know, so they aren't even asked.
+        """
+        if 'config-get' not in self.server_commands():
+            return None
+        self.check_busy()
+        self.conn.write('config-get %s\n' % re.sub(r'[\n\r]', '_', name))
+        r = self.conn.readline().strip()
+        self.check_ok()
+        return r or None
+
     def update_ref(self, refname, newval, oldval):
         self.check_busy()
         self.conn.write('update-ref %s\n%s\n%s\n' 
@@ -283,8 +322,12 @@ class PackWriter_Remote(git.PackWriter):
     def __init__(self, conn, objcache_maker, suggest_packs,
                  onopen, onclose,
                  ensure_busy,
-                 compression_level=1):
-        git.PackWriter.__init__(self, objcache_maker)
+                 compression_level=1, jobs=1, adaptive=False,
+                 meta_compression_level=None):
+        git.PackWriter.__init__(self, objcache_maker,
+                                compression_level=compression_level,
+                                jobs=jobs, adaptive=adaptive,
+                                meta_compression_level=meta_compression_level)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -301,15 +344,21 @@ class PackWriter_Remote(git.PackWriter):
             self._packopen = True
 
     def _end(self):
+        self._write_pending()
         if self._packopen and self.file:
             self.file.write('\0\0\0\0')
             self._packopen = False
             self.onclose() # Unbusy
             self.objcache = None
-            return self.suggest_packs() # Returns last idx received
+            id = self.suggest_packs() # Returns last idx received
+            self._drop_claims(aborted=False)
+            return id
 
-    def close(self):
-        id = self._end()
+    def _close(self, run_midx=True):
+        try:
+            id = self._end()
+        finally:
+            self._close_pool()
         self.file = None
         return id
 
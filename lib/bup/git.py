@@ -3,13 +3,14 @@ bup repositories are in Git format. This library allows us to
 interact with the Git data structures.
 """
 import os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
-from collections import namedtuple
+import threading, Queue, weakref, resource
+from collections import deque, namedtuple
 
 from bup.helpers import *
-from bup import _helpers, path, midx, bloom, xstat
+from bup import _helpers, path, midx, bloom, hidx, xstat
 
 max_pack_size = 1000*1000*1000  # larger packs will slow down pruning
-max_pack_objects = 200*1000  # cache memory usage is about 83 bytes per object
+max_pack_objects = 200*1000  # the object cache takes ~100 bytes per object
 
 verbose = 0
 ignore_midx = 0
@@ -124,26 +125,370 @@ def all_packdirs():
     return paths
 
 
-def auto_midx(objdir):
-    args = [path.exe(), 'midx', '--auto', '--dir', objdir]
+def pack_generation(path):
+    """Return a value that changes whenever the index files (.idx, .midx,
+    bloom filter or hash index) in the pack directory path do, or None
+    if that can't be told.
+
+    bup records its own changes with bump_pack_generation().  Anything
+    else that changes the packs (like git repack) has to add, remove or
+    rename files, which changes the directory's mtime, unless the mtime
+    is too recent to be sure that nothing else changed within the same
+    clock tick.
+    """
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError, e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+        st = xstat.stat(path)
+    except OSError:
+        return None
+    if st.st_mtime >= (time.time() - 1) * 10**9:
+        return None
+    try:
+        with open(os.path.join(path, 'bup.gen')) as f:
+            gen = f.read()
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        gen = ''
+    return (st.st_ino, st.st_mtime, gen)
 
-    args = [path.exe(), 'bloom', '--dir', objdir]
+
+def bump_pack_generation(path):
+    """Record that the index files in the pack directory path have
+    changed (see pack_generation())."""
+    name = os.path.join(path, 'bup.gen')
     try:
-        rv = subprocess.call(args, stdout=open('/dev/null', 'w'))
-    except OSError, e:
-        # make sure 'args' gets printed to help with debugging
-        add_error('%r: exception: %s' % (args, e))
-        raise
-    if rv:
-        add_error('%r: returned %d' % (args, rv))
+        with open(name) as f:
+            gen = int(f.read())
+    except (IOError, ValueError):
+        gen = 0
+    with atomically_replaced_file(name, 'w') as f:
+        f.write('%d\n' % (gen + 1))
+
+
+def midx_max_files():
+    """Return how many index files a midx may be made from at once."""
+    mf = min(resource.getrlimit(resource.RLIMIT_NOFILE))
+    if mf > 32:
+        mf -= 20  # just a safety margin
+    else:
+        mf -= 6   # minimum safety margin
+    return mf
+
+
+def merge_midx(outdir, outfilename, infilenames, auto=False, force=False,
+               prefixstr=''):
+    """Merge the given .idx and .midx files into outfilename (or a new
+    .midx in outdir), and return (object count, filename).  With auto
+    or force, return None if there's not enough to merge to bother."""
+    if not outfilename:
+        assert(outdir)
+        sum = Sha1('\0'.join(infilenames)).hexdigest()
+        outfilename = '%s/midx-%s.midx' % (outdir, sum)
+
+    idxs = []
+    try:
+        total = 0
+        for name in infilenames:
+            ix = open_idx(name)
+            idxs.append(ix)
+            total += len(ix)
+        debug1('midx: %s: %screating from %d files (%d objects).\n'
+               % (repo_rel(outdir), prefixstr, len(infilenames), total))
+        if (auto and (total < 1024 and len(infilenames) < 3)) \
+           or ((auto or force) and len(infilenames) < 2) \
+           or (force and not total):
+            debug1('midx: nothing to do.\n')
+            return None
+        midx.write(outfilename, idxs)
+        bump_pack_generation(os.path.dirname(outfilename))
+    finally:
+        for ix in idxs:
+            if isinstance(ix, midx.PackMidx):
+                ix.close()
+    return total, outfilename
+
+
+def update_midx(path, auto=True, force=False, max_files=None):
+    """Merge the indexes in path until there are few enough of them,
+    removing redundant .midx files, and return the (object count,
+    filename) of the .midx files created.
+
+    Only the smallest indexes are merged, so that once a directory is in
+    shape, adding a pack usually merges nothing, or a few small files.
+    With force, merge everything into a single .midx, ignoring the
+    existing ones unless auto is set too.
+    """
+    max_files = max_files or midx_max_files()
+    already = {}
+    sizes = {}
+    if force and not auto:
+        midxs = []   # don't use existing midx files
+    else:
+        midxs = glob.glob('%s/*.midx' % path)
+        contents = {}
+        for mname in midxs:
+            m = open_idx(mname)
+            contents[mname] = [('%s/%s' % (path,i)) for i in m.idxnames]
+            sizes[mname] = len(m)
+            m.close()
+
+        # sort the biggest+newest midxes first, so that we can eliminate
+        # smaller (or older) redundant ones that come later in the list
+        midxs.sort(key=lambda ix: (-sizes[ix], -xstat.stat(ix).st_mtime))
+
+        for mname in midxs:
+            any = 0
+            for iname in contents[mname]:
+                if not already.get(iname):
+                    already[iname] = 1
+                    any = 1
+            if not any:
+                debug1('%r is redundant\n' % mname)
+                unlink(mname)
+                bump_pack_generation(path)
+                already[mname] = 1
+
+    midxs = [k for k in midxs if not already.get(k)]
+    idxs = [k for k in glob.glob('%s/*.idx' % path) if not already.get(k)]
+
+    for iname in idxs:
+        i = open_idx(iname)
+        sizes[iname] = len(i)
+
+    all = [(sizes[n],n) for n in (midxs + idxs)]
+
+    # FIXME: what are the optimal values?  Does this make sense?
+    DESIRED_HWM = force and 1 or 5
+    DESIRED_LWM = force and 1 or 2
+    existed = dict((name,1) for sz,name in all)
+    debug1('midx: %d indexes; want no more than %d.\n'
+           % (len(all), DESIRED_HWM))
+    if len(all) <= DESIRED_HWM:
+        debug1('midx: nothing to do.\n')
+    while len(all) > DESIRED_HWM:
+        all.sort()
+        part1 = [name for sz,name in all[:len(all)-DESIRED_LWM+1]]
+        part2 = all[len(all)-DESIRED_LWM+1:]
+        groups = [part1[i:i+max_files]
+                  for i in xrange(0, len(part1), max_files)]
+        merged = []
+        for n,sublist in enumerate(groups):
+            gprefix = len(groups) != 1 and 'Group %d: ' % (n+1) or ''
+            rv = merge_midx(path, None, sublist, auto=auto, force=force,
+                            prefixstr=gprefix)
+            if rv:
+                merged.append(rv)
+        all = merged + part2
+        if len(all) > DESIRED_HWM:
+            debug1('\nStill too many indexes (%d > %d).  Merging again.\n'
+                   % (len(all), DESIRED_HWM))
+    return [(sz, name) for sz,name in all if not existed.get(name)]
+
+
+def update_bloom(path, outfilename=None, force=False, k=None,
+                 incremental=False, prefixstr=''):
+    """Add the objects of the .idx files in path to its bloom filter,
+    building a new one if there isn't a usable one already.
+
+    With incremental, only the .idx files the filter doesn't know about
+    yet are opened, instead of checking that the filter's object count
+    matches all the ones it claims to cover.  And when the filter gets
+    too full, the new objects go in a new, bigger layer on top of it
+    (see bloom.LayeredBloom) rather than regenerating it from every
+    .idx file.  Otherwise the layers are merged back into one filter.
+    """
+    outfilename = outfilename or os.path.join(path, 'bup.bloom')
+    b = None
+    if os.path.exists(outfilename) and not force:
+        b = bloom.LayeredBloom(outfilename)
+        if not b.valid():
+            debug1("bloom: Existing invalid bloom found, regenerating.\n")
+            b = None
+
+    add = []
+    rest = []
+    add_count = 0
+    rest_count = 0
+    known = b and set(b.idxnames) or set()
+    for i,name in enumerate(glob.glob('%s/*.idx' % path)):
+        ixbase = os.path.basename(name)
+        if ixbase in known:
+            rest.append(name)
+            if not incremental:
+                progress('bloom: counting: %d\r' % i)
+                rest_count += len(open_idx(name))
+        else:
+            progress('bloom: counting: %d\r' % i)
+            add.append(name)
+            add_count += len(open_idx(name))
+    if incremental:
+        rest_count = b and len(b) or 0
+
+    merge = b and not incremental and len(b.layers) > 1
+    if not add and not merge:
+        debug1("bloom: nothing to do.\n")
+        return
+
+    layer = None
+    if b:
+        top = b.layers[-1]
+        if len(b) != rest_count:
+            debug1("bloom: size %d != idx total %d, regenerating\n"
+                   % (len(b), rest_count))
+            b = None
+        elif merge:
+            debug1("bloom: merging %d layers\n" % len(b.layers))
+            b = None
+        elif (top.bits < top.max_bits() and
+              top.pfalse_positive(add_count) > bloom.MAX_PFALSE_POSITIVE):
+            debug1("bloom: %s: adding %d entries gives "
+                   "%.2f%% false positives.\n"
+                   % (incremental and 'adding a layer' or 'regenerating',
+                      add_count, top.pfalse_positive(add_count)))
+            if incremental:
+                layer = top
+            b = None
+        else:
+            b = bloom.ShaBloom(top.name, readwrite=True, expected=add_count)
+    if not b and not layer: # Need all idxs to build from scratch
+        for name in rest:
+            add.append(name)
+            if incremental:
+                add_count += len(open_idx(name))
+        if not incremental:
+            add_count += rest_count
+    del rest
+    del rest_count
+
+    msg = (layer and 'adding a layer for'
+           or b is None and 'creating from' or 'adding')
+    progress('bloom: %s%s %d file%s (%d object%s).\n'
+        % (prefixstr, msg,
+           len(add), len(add)!=1 and 's' or '',
+           add_count, add_count!=1 and 's' or ''))
+
+    tfname = None
+    if b is None:
+        tfname = os.path.join(path, 'bup.tmp.bloom')
+        if layer:
+            # Leave room for as much again as everything so far, so
+            # that the number of layers only grows logarithmically.
+            b = bloom.create(tfname, expected=max(add_count, len(layer)*2),
+                             k=k)
+        else:
+            b = bloom.create(tfname, expected=add_count, k=k)
+    icount = 0
+    for name in add:
+        ix = open_idx(name)
+        qprogress('bloom: writing %.2f%% (%d/%d objects)\r'
+                  % (icount*100.0/add_count, icount, add_count))
+        b.add_idx(ix)
+        icount += len(ix)
+
+    # Currently, there's an open file object for tfname inside b.
+    # Make sure it's closed before rename.
+    b.close()
+
+    if tfname and layer:
+        layers = bloom.layer_filenames(outfilename)
+        n = layers and int(layers[-1].split('.')[-2]) or 0
+        os.rename(tfname, '%s.%d.bloom' % (outfilename[:-len('.bloom')], n + 1))
+    elif tfname:
+        old_layers = bloom.layer_filenames(outfilename)
+        os.rename(tfname, outfilename)
+        # Everything's in the new filter, so the old layers can only add
+        # false positives.
+        for name in old_layers:
+            unlink(name)
+    bump_pack_generation(path)
+
+
+def update_hidx(path, create=False, force=False, prefixstr=''):
+    """Add the objects of any new .idx files in path to its hash index
+    (see hidx.py), and return its name, or None if there isn't one.
+
+    The hash index is only created if create or force is true; force
+    also rebuilds it from scratch.  When it gets too full, a new one,
+    twice as big, is built from the old one and the new .idx files.
+    It's rebuilt from scratch if an .idx it covers has been removed.
+    """
+    outfilename = os.path.join(path, 'bup.hidx')
+    h = None
+    if os.path.exists(outfilename) and not force:
+        h = hidx.PackHidx(outfilename)
+        if not h.valid():
+            debug1("hidx: Existing invalid hidx found, regenerating.\n")
+            h.close()
+            h = None
+    elif not create and not force:
+        return None
+
+    names = dict((os.path.basename(name), name)
+                 for name in glob.glob('%s/*.idx' % path))
+    if h and [n for n in h.idxnames if n not in names]:
+        debug1("hidx: some indexes are gone, regenerating.\n")
+        h.close()
+        h = None
+    known = h and set(h.idxnames) or set()
+    add = [open_idx(name) for base,name in sorted(names.items())
+           if base not in known]
+    add_count = sum(len(ix) for ix in add)
+    if h and not add:
+        debug1("hidx: nothing to do.\n")
+        h.close()
+        return outfilename
+
+    tfname = None
+    if h and h.room() >= add_count:
+        h.close()
+        out = hidx.PackHidx(outfilename, readwrite=True)
+        old = None
+        msg = 'adding'
+    else:
+        old = h
+        tfname = os.path.join(path, 'bup.tmp.hidx')
+        out = hidx.create(tfname, hidx.bits_for((old and len(old) or 0)
+                                                + add_count))
+        msg = old and 'growing with' or 'creating from'
+    progress('hidx: %s%s %d file%s (%d object%s).\n'
+        % (prefixstr, msg, len(add), len(add)!=1 and 's' or '',
+           add_count, add_count!=1 and 's' or ''))
+    if old:
+        out.add_from(old)
+        old.close()
+    icount = 0
+    for ix in add:
+        qprogress('hidx: writing %.2f%% (%d/%d objects)\r'
+                  % (icount*100.0/(add_count or 1), icount, add_count))
+        out.add_idx(ix)
+        icount += len(ix)
+    out.close()
+    if tfname:
+        os.rename(tfname, outfilename)
+    bump_pack_generation(path)
+    return outfilename
+
+
+_auto_midx_lock = threading.Lock()
+
+def auto_midx(objdir):
+    """Bring the .midx files, bloom filter and hash index (if there is
+    one) in objdir up to date after some packs were added to it."""
+    # Writers closing at the same time mustn't trip over each other's
+    # temporary files.
+    with _auto_midx_lock:
+        try:
+            update_midx(objdir)
+        except (GitError, IOError, OSError), e:
+            add_error('midx: %s: %s' % (objdir, e))
+        try:
+            update_bloom(objdir, incremental=True)
+        except (GitError, IOError, OSError), e:
+            add_error('bloom: %s: %s' % (objdir, e))
+        try:
+            update_hidx(objdir)
+        except (GitError, IOError, OSError, ValueError), e:
+            add_error('hidx: %s: %s' % (objdir, e))
 
 
 def mangle_name(name, mode, gitmode):
@@ -227,7 +572,55 @@ def tree_decode(buf):
         yield (int(mode, 8), name, sha)
 
 
-def _encode_packobj(type, content, compression_level=1):
+class _Compressibility:
+    """Guesses whether objects are worth compressing.
+
+    We compress a small sample from the middle of an object, and if
+    that doesn't shrink it, the object (e.g. part of a JPEG or a gzipped
+    file) is stored with zlib level 0 instead, which costs next to
+    nothing.  Once SKIP objects in a row have come out the same way
+    (most likely they're all from the same file), only every SKIP'th
+    one is sampled, and the others are assumed to be like it.  The
+    counts of what was stored are kept in stored and stored_bytes.
+
+    The guesses only affect the pack contents, never the object ids.
+    """
+    MIN_SIZE = 4096     # smaller objects are always compressed
+    SAMPLE_SIZE = 2048
+    RATIO = 0.95        # compressed sample size above which we give up
+    SKIP = 8
+
+    def __init__(self):
+        self.compress = True
+        self.streak = 0
+        self.sampled = self.stored = self.stored_bytes = 0
+
+    def worth_compressing(self, content):
+        if len(content) < self.MIN_SIZE:
+            return True
+        # Races between threads here only make the guesses a bit off.
+        self.streak += 1
+        compress = self.compress
+        if self.streak <= self.SKIP or self.streak % self.SKIP == 0:
+            self.sampled += 1
+            start = (len(content) - self.SAMPLE_SIZE) // 2
+            sample = buffer(content, start, self.SAMPLE_SIZE)
+            compress = (len(zlib.compress(sample, 1))
+                        < self.SAMPLE_SIZE * self.RATIO)
+            if compress != self.compress:
+                self.compress = compress
+                self.streak = 1
+        if not compress:
+            self.stored += 1
+            self.stored_bytes += len(content)
+        return compress
+
+
+def _encode_packobj(type, content, compression_level=1, adaptive=None):
+    """Yield the pieces of content encoded as a pack entry.
+
+    If adaptive (a _Compressibility) is given, content that doesn't look
+    compressible is stored uncompressed."""
     szout = ''
     sz = len(content)
     szbits = (sz & 0x0f) | (_typemap[type]<<4)
@@ -243,6 +636,9 @@ def _encode_packobj(type, content, compression_level=1):
         compression_level = 9
     elif compression_level < 0:
         compression_level = 0
+    if compression_level and adaptive \
+            and not adaptive.worth_compressing(content):
+        compression_level = 0
     z = zlib.compressobj(compression_level)
     yield szout
     yield z.compress(content)
@@ -298,45 +694,52 @@ class PackIdx:
             return self._ofs_from_idx(idx)
         return None
 
+    def find_pack_and_offset(self, hash):
+        """Return the name of this index and the offset of an object in
+        its pack, or None."""
+        ofs = self.find_offset(hash)
+        if ofs is not None:
+            return os.path.basename(self.name), ofs
+        return None
+
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in this index."""
         if hash and (self._idx_from_hash(hash) != None):
             return want_source and os.path.basename(self.name) or True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Like exists() for each of the sorted list hashes, but in one
+        pass over the index."""
+        global _total_searches
+        _total_searches += len(hashes)
+        src = want_source and os.path.basename(self.name) or True
+        found = _helpers.find_shas(self.shatable, self.entry_size,
+                                   ''.join(hashes))
+        return [src if i is not None else None for i in found]
+
     def __len__(self):
         return int(self.fanout[255])
 
     def _idx_from_hash(self, hash):
         global _total_searches, _total_steps
         _total_searches += 1
-        assert(len(hash) == 20)
-        b1 = ord(hash[0])
-        start = self.fanout[b1-1] # range -1..254
-        end = self.fanout[b1] # range 0..255
-        want = str(hash)
-        _total_steps += 1  # lookup table is a step
-        while start < end:
-            _total_steps += 1
-            mid = start + (end-start)/2
-            v = self._idx_to_hash(mid)
-            if v < want:
-                start = mid+1
-            elif v > want:
-                end = mid
-            else: # got it!
-                return mid
-        return None
+        idx, steps = _helpers.find_sha(self.fantable, 8, self.shatable,
+                                       self.entry_size, str(hash))
+        _total_steps += steps
+        return idx
 
 
 class PackIdxV1(PackIdx):
     """Object representation of a Git pack index (version 1) file."""
+    entry_size = 24
+
     def __init__(self, filename, f):
         self.name = filename
         self.idxnames = [self.name]
         self.map = mmap_read(f)
-        self.fanout = list(struct.unpack('!256I',
-                                         str(buffer(self.map, 0, 256*4))))
+        self.fantable = buffer(self.map, 0, 256*4)
+        self.fanout = list(struct.unpack('!256I', str(self.fantable)))
         self.fanout.append(0)  # entry "-1"
         nsha = self.fanout[255]
         self.sha_ofs = 256*4
@@ -355,22 +758,25 @@ class PackIdxV1(PackIdx):
 
 class PackIdxV2(PackIdx):
     """Object representation of a Git pack index (version 2) file."""
+    entry_size = 20
+
     def __init__(self, filename, f):
         self.name = filename
         self.idxnames = [self.name]
         self.map = mmap_read(f)
         assert(str(self.map[0:8]) == '\377tOc\0\0\0\2')
-        self.fanout = list(struct.unpack('!256I',
-                                         str(buffer(self.map, 8, 256*4))))
+        self.fantable = buffer(self.map, 8, 256*4)
+        self.fanout = list(struct.unpack('!256I', str(self.fantable)))
         self.fanout.append(0)  # entry "-1"
         nsha = self.fanout[255]
         self.sha_ofs = 8 + 256*4
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
-        self.ofstable = buffer(self.map,
-                               self.sha_ofs + nsha*20 + nsha*4,
-                               nsha*4)
-        self.ofs64table = buffer(self.map,
-                                 8 + 256*4 + nsha*20 + nsha*4 + nsha*4)
+        self.ofs_ofs = self.sha_ofs + nsha*20 + nsha*4
+        self.ofstable = buffer(self.map, self.ofs_ofs, nsha*4)
+        self.ofs64_ofs = self.ofs_ofs + nsha*4
+        self.ofs64table = buffer(self.map, self.ofs64_ofs)
+        # The 64-bit offsets are followed by the pack and idx checksums.
+        self.ofs64_count = (len(self.ofs64table) - 40) / 8
 
     def _ofs_from_idx(self, idx):
         ofs = struct.unpack('!I', str(buffer(self.ofstable, idx*4, 4)))[0]
@@ -388,24 +794,27 @@ class PackIdxV2(PackIdx):
             yield buffer(self.map, 8 + 256*4 + 20*i, 20)
 
 
-_mpi_count = 0
 class PackIdxList:
+    """The objects in all the index files in a directory, plus the ones
+    add()ed since.
+
+    These take a lot of memory (well, VM), so anything that may run
+    alongside something else should get one from shared_pack_idx_list()
+    rather than making its own.  They're safe to use from several
+    threads at once.
+    """
     def __init__(self, dir):
-        global _mpi_count
-        assert(_mpi_count == 0) # these things suck tons of VM; don't waste it
-        _mpi_count += 1
         self.dir = dir
         self.also = set()
+        self._owners = {}  # claim()ed hash -> owner, until release()d
         self.packs = []
         self.do_bloom = False
         self.bloom = None
+        self.hidx = None
+        self._generation = None
+        self._lock = threading.RLock()
         self.refresh()
 
-    def __del__(self):
-        global _mpi_count
-        _mpi_count -= 1
-        assert(_mpi_count == 0)
-
     def __iter__(self):
         return iter(idxmerge(self.packs))
 
@@ -414,10 +823,17 @@ class PackIdxList:
 
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
+        with self._lock:
+            return self._exists(hash, want_source)
+
+    def _exists(self, hash, want_source):
         global _total_searches
         _total_searches += 1
         if hash in self.also:
             return True
+        if self.hidx is not None:
+            _total_searches -= 1  # will be incremented by the hidx
+            return self.hidx.exists(hash, want_source=want_source)
         if self.do_bloom and self.bloom:
             if self.bloom.exists(hash):
                 self.do_bloom = False
@@ -435,6 +851,50 @@ class PackIdxList:
         self.do_bloom = True
         return None
 
+    def exists_many(self, hashes, want_source=False):
+        """Return a list with what exists() would return for each of
+        hashes, looking them all up in one sorted pass over each index.
+
+        The bloom filter isn't consulted: checking each hash against it
+        costs more than the extra passes over the indexes it would save.
+        """
+        result = [None] * len(hashes)
+        with self._lock:
+            also = self.also
+            todo = []
+            for i, hash in enumerate(hashes):
+                if hash in also:
+                    result[i] = True
+                else:
+                    todo.append(i)
+            todo.sort(key=hashes.__getitem__)
+            packs = self.hidx is not None and [self.hidx] or self.packs
+            for p in packs:
+                if not todo:
+                    break
+                found = p.exists_many([hashes[i] for i in todo], want_source)
+                missing = []
+                for i, ix in zip(todo, found):
+                    if ix:
+                        result[i] = ix
+                    else:
+                        missing.append(i)
+                todo = missing
+        return result
+
+    def find_pack_and_offset(self, hash):
+        """Return the name of the .idx of a pack that contains the object
+        and the object's offset in it, or None if it isn't in any of the
+        index files."""
+        with self._lock:
+            if self.hidx is not None:
+                return self.hidx.find_pack_and_offset(hash)
+            for p in self.packs:
+                found = p.find_pack_and_offset(hash)
+                if found:
+                    return found
+        return None
+
     def refresh(self, skip_midx = False):
         """Refresh the index list.
         This method verifies if .midx files were superseded (e.g. all of its
@@ -446,9 +906,24 @@ class PackIdxList:
 
         The module-global variable 'ignore_midx' can force this function to
         always act as if skip_midx was True.
+
+        Nothing is done if pack_generation() shows that nothing changed
+        since the last refresh.
         """
+        with self._lock:
+            gen = pack_generation(self.dir)
+            key = (gen, skip_midx or ignore_midx)
+            if gen is not None and key == self._generation:
+                return
+            self._refresh(skip_midx)
+            self._generation = key
+
+    def _refresh(self, skip_midx):
         self.bloom = None # Always reopen the bloom as it may have been relaced
         self.do_bloom = False
+        if self.hidx is not None:
+            self.hidx.close()
+            self.hidx = None
         skip_midx = skip_midx or ignore_midx
         d = dict((p.name, p) for p in self.packs
                  if not skip_midx or not isinstance(p, midx.PackMidx))
@@ -473,6 +948,7 @@ class PackIdxList:
                             mx.close()
                             del mx
                             unlink(full)
+                            bump_pack_generation(self.dir)
                         else:
                             midxl.append(mx)
                 midxl.sort(key=lambda ix:
@@ -494,6 +970,7 @@ class PackIdxList:
                                % os.path.basename(ix.name))
                         ix.close()
                         unlink(ix.name)
+                        bump_pack_generation(self.dir)
             for full in glob.glob(os.path.join(self.dir,'*.idx')):
                 if not d.get(full):
                     try:
@@ -504,19 +981,89 @@ class PackIdxList:
                     d[full] = ix
             bfull = os.path.join(self.dir, 'bup.bloom')
             if self.bloom is None and os.path.exists(bfull):
-                self.bloom = bloom.ShaBloom(bfull)
+                self.bloom = bloom.LayeredBloom(bfull)
             self.packs = list(set(d.values()))
             self.packs.sort(lambda x,y: -cmp(len(x),len(y)))
             if self.bloom and self.bloom.valid() and len(self.bloom) >= len(self):
                 self.do_bloom = True
             else:
                 self.bloom = None
-        debug1('PackIdxList: using %d index%s.\n'
-            % (len(self.packs), len(self.packs)!=1 and 'es' or ''))
+            hfull = os.path.join(self.dir, 'bup.hidx')
+            if not skip_midx and os.path.exists(hfull):
+                # Only a hash index of exactly the .idx files there are
+                # can answer for them.
+                hx = hidx.PackHidx(hfull)
+                idxnames = set(os.path.basename(n) for n in d
+                               if n.endswith('.idx'))
+                if hx.valid() and set(hx.idxnames) == idxnames:
+                    self.hidx = hx
+                else:
+                    hx.close()
+        debug1('PackIdxList: using %d index%s%s.\n'
+            % (len(self.packs), len(self.packs)!=1 and 'es' or '',
+               self.hidx is not None and ' behind a hidx' or ''))
 
     def add(self, hash):
         """Insert an additional object in the list."""
-        self.also.add(hash)
+        with self._lock:
+            self.also.add(hash)
+
+    def claim(self, hash, owner):
+        """Insert hash in the list on behalf of owner, who's going to
+        store it, unless it's already there.
+
+        Return (True, None) if it wasn't.  Otherwise return (False,
+        claimer), where claimer is whoever claim()ed it first, or None
+        once they've release()d it or it's in the index files.
+        """
+        with self._lock:
+            if self._exists(hash, False):
+                return (False, self._owners.get(hash))
+            self.also.add(hash)
+            self._owners[hash] = owner
+            return (True, None)
+
+    def release(self, hashes, owner, discard=False):
+        """Forget that owner claim()ed the given objects.  With discard,
+        drop them from the list too, because they won't be stored after
+        all."""
+        with self._lock:
+            for hash in hashes:
+                if self._owners.get(hash) is owner:
+                    del self._owners[hash]
+                    if discard:
+                        self.also.discard(hash)
+
+    def forget(self, hashes):
+        """Drop the given add()ed objects that are now in the index
+        files, e.g. after a refresh() that found their new pack."""
+        with self._lock:
+            for hash in hashes:
+                if hash in self.also and self._exists_in_packs(hash):
+                    self.also.discard(hash)
+                    self._owners.pop(hash, None)
+
+    def _exists_in_packs(self, hash):
+        for p in self.packs:
+            if p.exists(hash):
+                return True
+        return False
+
+
+_shared_idx_lists = weakref.WeakValueDictionary()
+_shared_idx_lists_lock = threading.Lock()
+
+def shared_pack_idx_list(dir):
+    """Return a PackIdxList for dir that's shared with everyone else in
+    this process who asked for one, so that they see each other's
+    add()ed objects.  It's dropped when the last of them lets go of it.
+    """
+    dir = os.path.realpath(dir)
+    with _shared_idx_lists_lock:
+        l = _shared_idx_lists.get(dir)
+        if l is None:
+            l = _shared_idx_lists[dir] = PackIdxList(dir)
+        return l
 
 
 def open_idx(filename):
@@ -553,11 +1100,190 @@ def idxmerge(idxlist, final_progress=True):
 
 
 def _make_objcache():
-    return PackIdxList(repo('objects/pack'))
+    return shared_pack_idx_list(repo('objects/pack'))
+
+
+_zeros = '\0' * 65536
+
+def _all_zeros(content):
+    for ofs in xrange(0, len(content), len(_zeros)):
+        b = buffer(content, ofs, len(_zeros))
+        if b != buffer(_zeros, 0, len(b)):
+            return False
+    return True
+
+
+class _RepeatCache:
+    """Remembers the ids of objects whose exact content keeps coming back
+    (like the all-zero chunks of preallocated files), so that they can be
+    recognized without hashing them or looking them up in the indexes.
+
+    Objects are looked up by their type, size, and first and last few
+    bytes, and only kept once they've been seen twice.  Only blobs are
+    kept: all-zero ones of any size just by their size, and others of up
+    to max_size bytes with a copy of their content to compare against,
+    up to max_bytes in all.  Everything in the cache must exist in the
+    repository.
+    """
+    def __init__(self, max_seen=4096, max_kept=64,
+                 max_size=64*1024, max_bytes=1024*1024):
+        self.max_seen = max_seen
+        self.max_kept = max_kept
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.seen = {}
+        self.kept = {}
+        self.kept_bytes = 0
+        self.hits = self.misses = 0
+
+    def _key(self, type, content):
+        return (type, len(content), content[:32], content[-32:])
+
+    def get(self, type, content):
+        """Return the id of the given object if it's in the cache."""
+        kept = self.kept.get(self._key(type, content))
+        if kept:
+            (data, sha) = kept
+            if data is None and _all_zeros(content) \
+                    or data is not None and buffer(data) == buffer(content):
+                self.hits += 1
+                return sha
+        self.misses += 1
+        return None
+
+    def _drop(self, key):
+        (data, sha) = self.kept.pop(key)
+        if data is not None:
+            self.kept_bytes -= len(data)
+
+    def add(self, type, content, sha):
+        """Note that the object with the given content, whose id is sha,
+        now exists in the repository."""
+        key = self._key(type, content)
+        if self.seen.get(key) == sha:
+            if type != 'blob' or key in self.kept:
+                return
+            if not key[2].strip('\0') and _all_zeros(content):
+                data = None
+            elif len(content) <= min(self.max_size, self.max_bytes):
+                data = str(content)
+            else:
+                return
+            size = data is not None and len(data) or 0
+            while self.kept and (len(self.kept) >= self.max_kept or
+                                 self.kept_bytes + size > self.max_bytes):
+                self._drop(next(iter(self.kept)))
+            self.kept[key] = (data, sha)
+            self.kept_bytes += size
+        else:
+            if len(self.seen) >= self.max_seen:
+                self.seen.clear()
+            self.seen[key] = sha
+
+    def clear(self):
+        self.seen.clear()
+        self.kept.clear()
+        self.kept_bytes = 0
+
+
+class _CompressPool:
+    """A pool of threads that compress objects for a PackWriter."""
+    def __init__(self, nthreads):
+        self._tasks = Queue.Queue()
+        self._threads = [threading.Thread(target=self._work)
+                         for i in xrange(nthreads)]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def _work(self):
+        while 1:
+            task = self._tasks.get()
+            if task is None:
+                return
+            (args, result) = task
+            try:
+                result.put((True, list(_encode_packobj(*args))))
+            except:
+                result.put((False, sys.exc_info()))
+
+    def submit(self, type, content, compression_level, adaptive=None):
+        """Start compressing an object, and return a Queue that the
+        result of _encode_packobj() will show up in."""
+        result = Queue.Queue(1)
+        self._tasks.put(((type, content, compression_level, adaptive),
+                         result))
+        return result
+
+    def close(self):
+        for t in self._threads:
+            self._tasks.put(None)
+        for t in self._threads:
+            t.join()
+
+
+class _IdxEntries:
+    """The (sha, crc, offset) of each object written to a pack so far,
+    packed into IDX_ENTRY.size bytes each, for _helpers.write_idx()."""
+    IDX_ENTRY = struct.Struct('!20sIQ')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.ofs64_count = 0  # offsets that don't fit in 31 bits
+
+    def __len__(self):
+        return len(self.data) // self.IDX_ENTRY.size
+
+    def add(self, sha, crc, ofs):
+        self.data += self.IDX_ENTRY.pack(sha, crc, ofs)
+        if ofs >= 2**31:
+            self.ofs64_count += 1
+
+    def shas(self):
+        size = self.IDX_ENTRY.size
+        for ofs in xrange(0, len(self.data), size):
+            yield str(self.data[ofs:ofs+20])
+
+
+class _Claims:
+    """The objects a PackWriter has claimed in its object cache (see
+    PackIdxList.claim()) for the packs it's writing, and whether those
+    packs have ended, or been abandoned."""
+    def __init__(self):
+        self.objcache = None
+        self.shas = set()
+        self.ended = threading.Event()
+        self.aborted = False
+
 
 class PackWriter:
-    """Writes Git objects inside a pack file."""
-    def __init__(self, objcache_maker=_make_objcache, compression_level=1):
+    """Writes Git objects inside a pack file.
+
+    With jobs > 1, objects are compressed by a pool of that many
+    threads, but still written to the pack in the order they were
+    given to us.  With adaptive, objects that don't seem to be
+    compressible are stored uncompressed (see _Compressibility; the
+    numbers are in self.adaptive).
+
+    Trees, commits and blobs written with meta=True are compressed
+    with meta_compression_level, which defaults to compression_level.
+    With meta_packs, they also go into packs of their own, so that
+    browsing a backup only has to read those small packs.  These are
+    closed whenever the pack of ordinary blobs is, and also on their own
+    when they reach max_pack_size or max_pack_objects.
+
+    Writers to the same repository share their object cache (see
+    shared_pack_idx_list()), so that two of them working at the same
+    time never both store an object.  An object another writer claimed
+    first may still be in a pack it hasn't finished, so close() waits
+    until every such pack has ended: anything that refers to the
+    objects, like a ref, must only be written after close().  Writers
+    that rely on each other must therefore not be closed one after the
+    other from the same thread.
+    """
+    def __init__(self, objcache_maker=_make_objcache, compression_level=1,
+                 jobs=1, adaptive=False, meta_compression_level=None,
+                 meta_packs=False):
         self.count = 0
         self.outbytes = 0
         self.filename = None
@@ -566,9 +1292,22 @@ class PackWriter:
         self.objcache_maker = objcache_maker
         self.objcache = None
         self.compression_level = compression_level
+        if meta_compression_level is None:
+            meta_compression_level = compression_level
+        self.meta_compression_level = meta_compression_level
+        self.meta_packs = meta_packs
+        self._meta_writer = None
+        self.adaptive = adaptive and _Compressibility() or None
+        self._lock = threading.RLock()
+        self.repeats = _RepeatCache()
+        self.jobs = jobs
+        self._pool = None
+        self._pending = deque()  # (sha, result queue) not written yet
+        self._claims = _Claims()
+        self._borrowed = {}  # sha -> _Claims of the writer storing it
 
     def __del__(self):
-        self.close()
+        self._close()
 
     def _open(self):
         if not self.file:
@@ -577,7 +1316,7 @@ class PackWriter:
             assert(name.endswith('.pack'))
             self.filename = name[:-5]
             self.file.write('PACK\0\0\0\2\0\0\0\0')
-            self.idx = list(list() for i in xrange(256))
+            self.idx = _IdxEntries()
 
     def _raw_write(self, datalist, sha):
         self._open()
@@ -601,21 +1340,82 @@ class PackWriter:
 
     def _update_idx(self, sha, crc, size):
         assert(sha)
-        if self.idx:
-            self.idx[ord(sha[0])].append((sha, crc, self.file.tell() - size))
+        if self.idx is not None:
+            self.idx.add(sha, crc, self.file.tell() - size)
 
-    def _write(self, sha, type, content):
-        if verbose:
-            log('>')
+    def _write(self, sha, type, content, meta=False):
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
-        if self.outbytes >= max_pack_size or self.count >= max_pack_objects:
-            self.breakpoint()
+        if meta or type != 'blob':
+            if self.meta_packs:
+                meta = self._meta_writer
+                if not meta:
+                    meta = self._meta_writer = PackWriter(
+                        objcache_maker=None,
+                        compression_level=self.meta_compression_level)
+                # So that it updates our object cache when its pack ends.
+                meta.objcache = self.objcache
+                return meta._write(sha, type, content)
+            (level, adaptive) = (self.meta_compression_level, None)
+        else:
+            (level, adaptive) = (self.compression_level, self.adaptive)
+        if self.jobs > 1:
+            if not self._pool:
+                self._pool = _CompressPool(self.jobs)
+            # content may be a view of a buffer that gets reused before
+            # the pool gets to it.
+            return self._write_later(sha, self._pool.submit(
+                    type, str(content), level, adaptive))
+        return self._write_encoded(sha, _encode_packobj(type, content,
+                                                        level, adaptive))
+
+    def _write_encoded(self, sha, datalist):
+        if self._pending:
+            # Keep the pack in order.
+            result = Queue.Queue(1)
+            result.put((True, datalist))
+            return self._write_later(sha, result)
+        if verbose:
+            log('>')
+        size, crc = self._raw_write(datalist, sha=sha)
+        self._maybe_breakpoint()
+        return sha
+
+    def _write_later(self, sha, result):
+        self._pending.append((sha, result))
+        self._write_pending(keep=2*self.jobs)
+        self._maybe_breakpoint()
         return sha
 
+    def _write_pending(self, keep=0):
+        """Write the objects at the head of the queue that have been
+        compressed, waiting for them if more than keep are queued."""
+        while self._pending and (len(self._pending) > keep
+                                 or not self._pending[0][1].empty()):
+            (sha, result) = self._pending.popleft()
+            (ok, datalist) = result.get()
+            if not ok:
+                self._drop_claims()
+                raise datalist[0], datalist[1], datalist[2]
+            if verbose:
+                log('>')
+            try:
+                self._raw_write(datalist, sha=sha)
+            except:
+                self._drop_claims()
+                raise
+
+    def _maybe_breakpoint(self):
+        if self.outbytes >= max_pack_size \
+                or self.count + len(self._pending) >= max_pack_objects:
+            self.breakpoint()
+
+    def _close_pool(self):
+        self._pending.clear()
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+
     def breakpoint(self):
         """Clear byte and object counts and return the last processed id."""
         id = self._end()
@@ -631,21 +1431,120 @@ class PackWriter:
 
     def exists(self, id, want_source=False):
         """Return non-empty if an object is found in the object cache."""
-        self._require_objcache()
-        return self.objcache.exists(id, want_source=want_source)
+        with self._lock:
+            self._require_objcache()
+            return self.objcache.exists(id, want_source=want_source)
 
-    def maybe_write(self, type, content):
+    def exists_many(self, ids, want_source=False):
+        """Return a list with what exists() would return for each of
+        ids; much faster than asking one at a time."""
+        with self._lock:
+            self._require_objcache()
+            return self.objcache.exists_many(ids, want_source=want_source)
+
+    def _claim(self, id):
+        """Return True if no one has written the object yet, in which
+        case it's up to us."""
+        self._require_objcache()
+        claims = self._claims
+        (new, claimer) = self.objcache.claim(id, claims)
+        if new:
+            claims.objcache = self.objcache
+            claims.shas.add(id)
+        elif claimer is not None and claimer is not claims:
+            self._borrowed[id] = claimer
+        return new
+
+    def _drop_claims(self, aborted=True):
+        """Let go of the objects claimed for the packs being written,
+        either because those packs ended, or because (with aborted)
+        they may not hold them after all, in which case anyone else is
+        free to store them again."""
+        claims = self._claims
+        self._claims = _Claims()
+        if aborted:
+            with self._lock:
+                self.repeats.clear()
+        if claims.objcache is not None:
+            claims.objcache.release(claims.shas, claims, discard=aborted)
+        claims.aborted = aborted
+        claims.ended.set()
+
+    def _wait_for_borrowed(self):
+        """Wait until the packs of other writers holding objects we left
+        to them have ended, and raise GitError if any were abandoned."""
+        borrowed = self._borrowed
+        self._borrowed = {}
+        lost = None
+        for (sha, claims) in borrowed.iteritems():
+            while not claims.ended.is_set():
+                claims.ended.wait(1)  # without a timeout, ^C can't get in
+            if claims.aborted:
+                lost = sha
+        if lost:
+            raise GitError('object %s was abandoned by another writer'
+                           % lost.encode('hex'))
+
+    def maybe_write(self, type, content, meta=False):
         """Write an object to the pack file if not present and return its id."""
+        with self._lock:
+            sha = self.repeats.get(type, content)
+        if sha:
+            return sha
         sha = calc_hash(type, content)
-        if not self.exists(sha):
-            self._write(sha, type, content)
-            self._require_objcache()
-            self.objcache.add(sha)
+        with self._lock:
+            if self._claim(sha):
+                try:
+                    self._write(sha, type, content, meta=meta)
+                except:
+                    self._drop_claims()
+                    raise
+            self.repeats.add(type, content, sha)
         return sha
 
-    def new_blob(self, blob):
-        """Create a blob object in the pack with the supplied content."""
-        return self.maybe_write('blob', blob)
+    def prepare_blob(self, blob):
+        """Hash and, if it's not already present, compress a blob.
+
+        This does the expensive part of new_blob() without touching the
+        pack file, so it may be called from several threads at once.
+        Pass the result to write_prepared() to actually add the blob.
+        """
+        with self._lock:
+            sha = self.repeats.get('blob', blob)
+        if sha:
+            return (sha, None, None)  # we know it exists
+        sha = calc_hash('blob', blob)
+        if self.exists(sha):
+            return (sha, blob, None)
+        return (sha, blob, list(_encode_packobj('blob', blob,
+                                                self.compression_level,
+                                                self.adaptive)))
+
+    def write_prepared(self, prepared):
+        """Write a blob returned by prepare_blob() and return its id."""
+        (sha, blob, datalist) = prepared
+        if blob is None:
+            return sha
+        with self._lock:
+            if self._claim(sha):
+                try:
+                    if datalist is None:
+                        datalist = _encode_packobj('blob', blob,
+                                                   self.compression_level,
+                                                   self.adaptive)
+                    self._write_encoded(sha, datalist)
+                except:
+                    self._drop_claims()
+                    raise
+            self.repeats.add('blob', blob, sha)
+        return sha
+
+    def new_blob(self, blob, meta=False):
+        """Create a blob object in the pack with the supplied content.
+
+        Pass meta=True for blobs holding metadata (like .bupm files)
+        rather than file contents."""
+        return self.maybe_write('blob', blob, meta=meta)
 
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
@@ -671,7 +1570,13 @@ class PackWriter:
         return commit
 
     def abort(self):
-        """Remove the pack file from disk."""
+        """Remove the pack file from disk, and let others store the
+        objects that were in it."""
+        self._close_pool()
+        self._drop_claims()
+        self._borrowed = {}
+        if self._meta_writer:
+            self._meta_writer.abort()
         f = self.file
         if f:
             self.idx = None
@@ -680,9 +1585,28 @@ class PackWriter:
             os.unlink(self.filename + '.pack')
 
     def _end(self, run_midx=True):
+        # The data pack goes first, since the metadata refers to it.
+        meta = self._meta_writer
+        try:
+            id = self._end_pack(run_midx=run_midx
+                                and not (meta and meta.file))
+            if meta:
+                meta_id = meta._end(run_midx=run_midx)
+                id = id or meta_id
+        except:
+            self._drop_claims()
+            raise
+        self._drop_claims(aborted=False)
+        return id
+
+    def _end_pack(self, run_midx=True):
+        self._write_pending()
         f = self.file
         if not f: return None
         self.file = None
+        objcache = self.objcache
+        if objcache is not None:
+            objcache = weakref.ref(objcache)
         self.objcache = None
         idx = self.idx
         self.idx = None
@@ -692,13 +1616,21 @@ class PackWriter:
         cp = struct.pack('!i', self.count)
         assert(len(cp) == 4)
         f.write(cp)
-
-        # calculate the pack sha1sum
-        f.seek(0)
-        sum = Sha1()
-        for b in chunkyreader(f):
-            sum.update(b)
-        packbin = sum.digest()
+        f.flush()
+
+        # calculate the pack sha1sum.  Closing a pack still reads all of
+        # it back once: the sum covers the header first, and the object
+        # count in it is only known now, so it can't be computed as the
+        # objects are written (SHA-1 state can't be patched afterwards).
+        # The pack was just written, so this normally comes out of the
+        # page cache rather than from the disk.  Only the idx is summed
+        # from memory; see _write_pack_idx_v2().
+        m = mmap_read(f, close=False)
+        try:
+            packbin = Sha1(m).digest()
+        finally:
+            m.close()
+        f.seek(0, 2)
         f.write(packbin)
         f.close()
 
@@ -709,54 +1641,53 @@ class PackWriter:
             os.unlink(self.filename + '.map')
         os.rename(self.filename + '.pack', nameprefix + '.pack')
         os.rename(self.filename + '.idx', nameprefix + '.idx')
+        bump_pack_generation(repo('objects/pack'))
 
         if run_midx:
             auto_midx(repo('objects/pack'))
+        # If other writers are sharing our object cache, it should find
+        # the new pack, and then it no longer has to remember its objects.
+        objcache = objcache and objcache()
+        if objcache is not None:
+            objcache.refresh()
+            objcache.forget(idx.shas())
         return nameprefix
 
+    def _close(self, run_midx=True):
+        try:
+            return self._end(run_midx=run_midx)
+        finally:
+            self._close_pool()
+
     def close(self, run_midx=True):
-        """Close the pack file and move it to its definitive path."""
-        return self._end(run_midx=run_midx)
+        """Close the pack file and move it to its definitive path, once
+        the objects left to other writers are stored too (see
+        PackWriter)."""
+        id = self._close(run_midx=run_midx)
+        self._wait_for_borrowed()
+        return id
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
-        ofs64_count = 0
-        for section in idx:
-            for entry in section:
-                if entry[2] >= 2**31:
-                    ofs64_count += 1
-
         # Length: header + fan-out + shas-and-crcs + overflow-offsets
-        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
+        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * idx.ofs64_count)
         idx_map = None
         idx_f = open(filename, 'w+b')
         try:
             idx_f.truncate(index_len)
             idx_map = mmap_readwrite(idx_f, close=False)
-            count = _helpers.write_idx(filename, idx_map, idx, self.count)
+            count = _helpers.write_idx(filename, idx_map, idx.data,
+                                       self.count)
             assert(count == self.count)
-        finally:
-            if idx_map: idx_map.close()
-            idx_f.close()
-
-        idx_f = open(filename, 'a+b')
-        try:
+            # Checksum what we just wrote while it's still in memory.
+            obj_list_sum = Sha1(buffer(idx_map, 8 + 4*256, 20*self.count))
+            idx_sum = Sha1(idx_map)
+            idx_sum.update(packbin)
+            idx_f.seek(0, 2)
             idx_f.write(packbin)
-            idx_f.seek(0)
-            idx_sum = Sha1()
-            b = idx_f.read(8 + 4*256)
-            idx_sum.update(b)
-
-            obj_list_sum = Sha1()
-            for b in chunkyreader(idx_f, 20*self.count):
-                idx_sum.update(b)
-                obj_list_sum.update(b)
-            namebase = obj_list_sum.hexdigest()
-
-            for b in chunkyreader(idx_f):
-                idx_sum.update(b)
             idx_f.write(idx_sum.digest())
-            return namebase
+            return obj_list_sum.hexdigest()
         finally:
+            if idx_map: idx_map.close()
             idx_f.close()
 
 
@@ -792,6 +1723,61 @@ def list_refs(refname = None, repo_dir = None):
             yield (name, sha.decode('hex'))
 
 
+def git_config_get(option, repo_dir=None):
+    """Return the value of a git config option, or None if it's not set."""
+    cmd = ('git', 'config', '--get', option)
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                         preexec_fn=_gitenv(repo_dir=repo_dir))
+    r = p.stdout.read()
+    rc = p.wait()
+    if rc == 0:
+        return r
+    if rc != 1:
+        raise GitError('%s returned %d' % (' '.join(cmd), rc))
+    return None
+
+
+def compression_levels(config_get, level=None, meta_level=None):
+    """Return the (compression_level, meta_compression_level) to use
+    for a repository.
+
+    level and meta_level (e.g. from the command line) take precedence
+    over the repository's bup.compression and bup.metacompression
+    config options, which config_get(name) must return, or None.  The
+    level defaults to 1, and the metadata level to the level.  Raises
+    ValueError for invalid values.
+    """
+    levels = []
+    for (name, v) in (('bup.compression', level),
+                      ('bup.metacompression', meta_level)):
+        if v is None:
+            v = config_get(name)
+            v = v and v.strip()
+        if v is None or v == '':
+            levels.append(None)
+            continue
+        try:
+            v = int(v)
+        except ValueError:
+            raise ValueError('%s must be an integer, not %r' % (name, v))
+        if not 0 <= v <= 9:
+            raise ValueError('%s must be from 0 to 9, not %d' % (name, v))
+        levels.append(v)
+    (level, meta_level) = levels
+    if level is None:
+        level = 1
+    if meta_level is None:
+        meta_level = level
+    return (level, meta_level)
+
+
+def git_config_set(option, value, repo_dir=None):
+    """Set a git config option in the repository."""
+    p = subprocess.Popen(['git', 'config', option, str(value)],
+                         stdout=sys.stderr, preexec_fn=_gitenv(repo_dir))
+    _git_wait('git config', p)
+
+
 def read_ref(refname, repo_dir = None):
     """Get the commit id of the most recent commit made on a given ref."""
     l = list(list_refs(refname, repo_dir))
@@ -1,95 +1,460 @@
-import math
+import errno, math, os, stat, sys, threading, time, Queue
+from collections import deque
 from bup import _helpers
 from bup.helpers import *
 
 BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
 BLOB_READ_SIZE = 1024*1024
 MAX_PER_TREE = 256
+CHUNKS_PER_JOB = 32  # chunks handed to a worker thread at a time
 progress_callback = None
 fanout = 16
 
+CHUNKERS = ('rollsum', 'gear')
+
+# The implementations of the rollsum chunker, which all find the same
+# split points.  The first one is the default; BUP_ROLLSUM can pick
+# another (e.g. "reference") if the default seems to misbehave.
+ROLLSUM_IMPLS = _helpers.ROLLSUM_IMPLS
+if os.environ.get('BUP_ROLLSUM'):
+    try:
+        _helpers.set_rollsum_impl(os.environ['BUP_ROLLSUM'])
+    except ValueError, e:
+        log('warning: BUP_ROLLSUM: %s; using %s\n'
+            % (e, _helpers.rollsum_impl()))
+
+
+def configure(blobbits, windowbits, chunker=_helpers.DEFAULT_CHUNKER):
+    """Split into chunks of 2^blobbits bytes on average, using the given
+    chunker (see CHUNKERS).  The rollsum chunker bases split points on
+    a rolling checksum of the last 2^windowbits bytes; the gear chunker
+    always looks at the last 64 bytes.
+
+    Raises ValueError if any value is invalid.
+    """
+    global BLOB_MAX, BLOB_READ_SIZE
+    _helpers.set_split_params(blobbits, windowbits, chunker)
+    BLOB_MAX = 4 << blobbits
+    BLOB_READ_SIZE = max(1024*1024, 4*BLOB_MAX)
+
+
+def split_params(config_get):
+    """Return the (blobbits, windowbits, chunker) configured for a
+    repository.
+
+    config_get(name) must return the value of the repository's git
+    config option name, or None.  Options that aren't set default to
+    the values bup has always used, so existing repositories keep
+    splitting the same way.  Raises ValueError for invalid values.
+    """
+    params = []
+    for (name, default) in (('bup.blobbits', _helpers.DEFAULT_BLOBBITS),
+                            ('bup.windowbits', _helpers.DEFAULT_WINDOWBITS)):
+        v = config_get(name)
+        v = v and v.strip()
+        if not v:
+            params.append(default)
+            continue
+        try:
+            params.append(int(v))
+        except ValueError:
+            raise ValueError('%s must be an integer, not %r' % (name, v))
+    v = config_get('bup.chunker')
+    v = v and v.strip()
+    if v and v not in CHUNKERS:
+        raise ValueError('bup.chunker must be one of %s, not %r'
+                         % (', '.join(CHUNKERS), v))
+    params.append(v or _helpers.DEFAULT_CHUNKER)
+    return tuple(params)
+
+
+def _bench_split(data):
+    """Return (seconds, chunk end offsets) for splitting data the way
+    hashsplit_iter() would if it were read from a file."""
+    secs = 0
+    ends = []
+    start = end = 0
+    while end < len(data):
+        end = min(end + BLOB_READ_SIZE, len(data))
+        t = time.time()
+        points = _helpers.splitbuf_all(buffer(data, start, end - start),
+                                       BLOB_MAX)
+        secs += time.time() - t
+        ends.extend(start + ofs for (ofs, bits) in points)
+        if points:
+            start += points[-1][0]
+    if start < len(data):
+        ends.append(len(data))
+    return (secs, ends)
+
+
+def bench_chunkers(datalist, chunkers=CHUNKERS):
+    """Split each string in datalist with each of the chunkers (and with
+    each of the ROLLSUM_IMPLS for the rollsum chunker).
+
+    Uses the current blobbits and windowbits, and returns a list of
+    (name, seconds, chunk count, unique bytes) in the order of
+    chunkers, where name is the chunker's name, followed by
+    "/implementation" for rollsum, seconds counts only the time spent
+    finding split points, and unique bytes is the total size of the
+    distinct chunks (so the total size divided by it is the
+    deduplication ratio).
+    """
+    params = (_helpers.blobbits(), _helpers.windowbits(), _helpers.chunker())
+    impl = _helpers.rollsum_impl()
+    results = []
+    try:
+        for chunker in chunkers:
+            configure(params[0], params[1], chunker)
+            for name in (chunker == 'rollsum' and ROLLSUM_IMPLS or [None]):
+                if name:
+                    _helpers.set_rollsum_impl(name)
+                secs = 0
+                count = 0
+                unique = {}
+                for data in datalist:
+                    (t, ends) = _bench_split(data)
+                    secs += t
+                    count += len(ends)
+                    start = 0
+                    for ofs in ends:
+                        chunk = buffer(data, start, ofs - start)
+                        unique[Sha1(chunk).digest()] = len(chunk)
+                        start = ofs
+                results.append((name and '%s/%s' % (chunker, name) or chunker,
+                                secs, count, sum(unique.itervalues())))
+    finally:
+        configure(*params)
+        _helpers.set_rollsum_impl(impl)
+    return results
+
+
 GIT_MODE_FILE = 0100644
 GIT_MODE_TREE = 040000
 GIT_MODE_SYMLINK = 0120000
 assert(GIT_MODE_TREE != 40000)  # 0xxx should be treated as octal
 
-# The purpose of this type of buffer is to avoid copying on peek(), get(),
-# and eat().  We do copy the buffer contents on put(), but that should
-# be ok if we always only put() large amounts of data at a time.
 class Buf:
+    """The data that has been read but not split yet.
+
+    The data lives in a bytearray block (see _new_block()), and peek()
+    and get() return buffer() views of it rather than copies.  When
+    the next block is put(), whatever is left of the current one
+    (which is less than BLOB_MAX once it has been split) is copied into
+    the headroom in front of the new block's data.  That's the only
+    copying we do; the input itself is read directly into the blocks.
+    """
     def __init__(self):
-        self.data = ''
-        self.start = 0
-
-    def put(self, s):
-        if s:
-            self.data = buffer(self.data, self.start) + s
-            self.start = 0
-            
+        self.block = None
+        self.start = self.end = 0
+        self.holes = []
+
+    def put(self, block, count, holes=()):
+        """Use the count bytes read into block (see _new_block()).
+
+        holes lists the (start, end) offsets of any ranges of those
+        bytes that were never read because they're known to be zeros.
+        """
+        remaining = self.used()
+        assert(remaining <= BLOB_MAX)
+        if remaining:
+            old = memoryview(self.block)[self.start:self.end]
+            memoryview(block)[BLOB_MAX - remaining:BLOB_MAX] = old
+        self.block = block
+        self.start = BLOB_MAX - remaining
+        self.end = BLOB_MAX + count
+        self.holes = [(BLOB_MAX + hs, BLOB_MAX + he) for (hs, he) in holes]
+
     def peek(self, count):
-        return buffer(self.data, self.start, count)
-    
+        return buffer(self.block, self.start, count)
+
     def eat(self, count):
         self.start += count
 
     def get(self, count):
-        v = buffer(self.data, self.start, count)
+        v = buffer(self.block, self.start, count)
         self.start += count
         return v
 
     def used(self):
-        return len(self.data) - self.start
+        return self.end - self.start
+
+    def in_hole(self, ofs, end):
+        """Return true if the bytes peek() would return from ofs to end
+        are all in one hole."""
+        for (hs, he) in self.holes:
+            if hs <= self.start + ofs and self.start + end <= he:
+                return True
+        return False
 
 
-def readfile_iter(files, progress=None):
+def _new_block():
+    """Return a bytearray that can hold BLOB_READ_SIZE bytes of new data
+    at offset BLOB_MAX, with room for an unsplit remainder in front."""
+    return bytearray(BLOB_MAX + BLOB_READ_SIZE)
+
+
+def _readinto(f, block, size):
+    """Read up to size (<= BLOB_READ_SIZE) bytes from f into block at
+    offset BLOB_MAX.
+
+    Returns the number of bytes read.
+    """
+    view = memoryview(block)[BLOB_MAX:BLOB_MAX + size]
+    if hasattr(f, 'readinto'):
+        return f.readinto(view)
+    b = f.read(size)
+    view[:len(b)] = b
+    return len(b)
+
+
+def _file_pos(f):
+    try:
+        return f.tell()
+    except (AttributeError, IOError):
+        return 0
+
+
+_zero_block = ''
+def _zeros(count):
+    """Return a buffer of count zero bytes (at most BLOB_READ_SIZE)."""
+    global _zero_block
+    if len(_zero_block) < count:
+        _zero_block = '\0' * BLOB_READ_SIZE
+    return buffer(_zero_block, 0, count)
+
+
+def _sparse_fd(f):
+    """Return f's file descriptor if f is a sparse file whose holes we
+    can find with lseek(), otherwise None."""
+    if not hasattr(_helpers, 'SEEK_HOLE') or not hasattr(f, 'fileno'):
+        return None
+    try:
+        fd = f.fileno()
+        st = os.fstat(fd)
+    except (IOError, OSError):
+        return None
+    if stat.S_ISREG(st.st_mode) and st.st_blocks * 512 < st.st_size:
+        return fd
+    return None
+
+
+def _readinto_sparse(f, fd, block, size, ofs):
+    """Like _readinto(), but for a sparse file that's at file offset ofs.
+
+    Holes are filled in with zeros rather than read.  Returns (count,
+    holes), where holes lists the (start, end) offsets of the holes
+    within the count bytes.
+    """
+    view = memoryview(block)[BLOB_MAX:]
+    end = min(ofs + size, os.fstat(fd).st_size)
+    pos = ofs
+    holes = []
+    while pos < end:
+        try:
+            data = min(os.lseek(fd, pos, _helpers.SEEK_DATA), end)
+        except OSError, e:
+            if e.errno != errno.ENXIO:
+                raise
+            data = end  # there's nothing but a hole left
+        if data > pos:
+            view[pos - ofs:data - ofs] = _zeros(data - pos)
+            holes.append((pos - ofs, data - ofs))
+            pos = data
+            continue
+        hole = min(os.lseek(fd, pos, _helpers.SEEK_HOLE), end)
+        f.seek(pos)
+        n = f.readinto(view[pos - ofs:hole - ofs])
+        pos += n
+        if pos < hole:
+            break  # the file must have been truncated
+    f.seek(pos)
+    return (pos - ofs, holes)
+
+
+def readfile_iter(files, progress=None, reuse=True):
+    """Yield (block, count, holes) for each block read from files.
+
+    Each block is a bytearray with count bytes of data at offset
+    BLOB_MAX.  If reuse is true, the same two blocks are used over and
+    over, so a block may only be used until the one after next has
+    been requested.  Otherwise each block is new.
+
+    The holes in sparse files are found with lseek(SEEK_HOLE) and
+    filled in with zeros instead of being read; holes lists the (start,
+    end) offsets of the ones in each block's data.
+
+    The blocks are aligned to multiples of BLOB_READ_SIZE in each file,
+    even if it isn't read from the beginning, so that splitting the
+    rest of a file from one of its old split points (see
+    append_point()) goes exactly like it did the first time.
+    """
+    blocks = reuse and [_new_block(), _new_block()]
     for filenum,f in enumerate(files):
-        ofs = 0
-        b = ''
+        ofs = _file_pos(f)
+        n = 0
+        fd = _sparse_fd(f)
+        holes = ()
         while 1:
             if progress:
-                progress(filenum, len(b))
+                progress(filenum, n)
             fadvise_done(f, max(0, ofs - 1024*1024))
-            b = f.read(BLOB_READ_SIZE)
-            ofs += len(b)
-            if not b:
+            if reuse:
+                block = blocks[0]
+            else:
+                block = _new_block()
+            size = BLOB_READ_SIZE - ofs % BLOB_READ_SIZE
+            if fd is None:
+                n = _readinto(f, block, size)
+            else:
+                (n, holes) = _readinto_sparse(f, fd, block, size, ofs)
+            ofs += n
+            if not n:
                 fadvise_done(f, ofs)
                 break
-            yield b
+            yield (block, n, holes)
+            if reuse:
+                blocks.reverse()
+
+
+class _Failure:
+    """An exception raised in a pipeline thread, to be re-raised later."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+    def reraise(self):
+        raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
+def _background_iter(it, depth):
+    """Run the iterator it in its own thread, queueing up to depth items.
+
+    Exceptions raised by it are re-raised in the consuming thread.
+    """
+    q = Queue.Queue(depth)
+    done = []
+    stop = []
+    def run():
+        try:
+            for item in it:
+                if stop:
+                    if hasattr(it, 'close'):
+                        it.close()
+                    return
+                q.put(item)
+            q.put(done)
+        except:
+            q.put(_Failure(sys.exc_info()))
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    try:
+        while 1:
+            item = q.get()
+            if item is done:
+                break
+            if isinstance(item, _Failure):
+                item.reraise()
+            yield item
+    finally:
+        # Unblock the producer if we're being abandoned early.
+        stop.append(1)
+        while t.is_alive():
+            try:
+                q.get_nowait()
+            except Queue.Empty:
+                t.join(0.01)
+
+
+def _parallel_map(func, it, nthreads):
+    """Yield func(x) for each x in it, using nthreads worker threads.
+
+    The results are yielded in the same order as the input, no matter
+    which worker finishes first.
+    """
+    tasks = Queue.Queue(nthreads)
+    def work():
+        while 1:
+            task = tasks.get()
+            if task is None:
+                return
+            (item, result) = task
+            try:
+                result.put(func(item))
+            except:
+                result.put(_Failure(sys.exc_info()))
+    threads = [threading.Thread(target=work) for i in xrange(nthreads)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    pending = deque()
+    def next_result():
+        r = pending.popleft().get()
+        if isinstance(r, _Failure):
+            r.reraise()
+        return r
+    try:
+        for item in it:
+            result = Queue.Queue(1)
+            tasks.put((item, result))
+            pending.append(result)
+            if len(pending) > 2*nthreads:
+                yield next_result()
+        while pending:
+            yield next_result()
+    finally:
+        for t in threads:
+            tasks.put(None)
+        for t in threads:
+            t.join()
+
+
+def _batches(it, n):
+    batch = []
+    for item in it:
+        batch.append(item)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def _splitbuf(buf, basebits, fanbits):
-    while 1:
-        b = buf.peek(buf.used())
-        (ofs, bits) = _helpers.splitbuf(b)
-        if ofs:
-            if ofs > BLOB_MAX:
-                ofs = BLOB_MAX
-                level = 0
-            else:
-                level = (bits-basebits)//fanbits  # integer division
-            buf.eat(ofs)
-            yield buffer(b, 0, ofs), level
+    b = buf.peek(buf.used())
+    start = 0
+    for (ofs, bits) in _helpers.splitbuf_all(b, BLOB_MAX):
+        if bits:
+            level = (bits-basebits)//fanbits  # integer division
         else:
-            break
-    while buf.used() >= BLOB_MAX:
-        # limit max blob size
-        yield buf.get(BLOB_MAX), 0
+            level = 0  # cut at BLOB_MAX
+        yield buffer(b, start, ofs - start), level, buf.in_hole(start, ofs)
+        start = ofs
+    buf.eat(start)
 
 
-def _hashsplit_iter(files, progress):
+def _hashsplit_iter(files, progress, readahead=False):
     assert(BLOB_READ_SIZE > BLOB_MAX)
     basebits = _helpers.blobbits()
     fanbits = int(math.log(fanout or 128, 2))
     buf = Buf()
-    for inblock in readfile_iter(files, progress):
-        buf.put(inblock)
-        for buf_and_level in _splitbuf(buf, basebits, fanbits):
-            yield buf_and_level
+    if readahead:
+        blocks = _background_iter(readfile_iter(files, progress, reuse=False),
+                                  2)
+    else:
+        # Each chunk is used up before we ask for the next one, so the
+        # blocks can be recycled.
+        blocks = readfile_iter(files, progress)
+    for (block, count, holes) in blocks:
+        buf.put(block, count, holes)
+        for chunk in _splitbuf(buf, basebits, fanbits):
+            yield chunk
     if buf.used():
-        yield buf.get(buf.used()), 0
+        zero = buf.in_hole(0, buf.used())
+        yield buf.get(buf.used()), 0, zero
 
 
-def _hashsplit_iter_keep_boundaries(files, progress):
+def _hashsplit_iter_keep_boundaries(files, progress, readahead=False):
     for real_filenum,f in enumerate(files):
         if progress:
             def prog(filenum, nbytes):
@@ -98,22 +463,93 @@ def _hashsplit_iter_keep_boundaries(files, progress):
                 return progress(real_filenum, nbytes)
         else:
             prog = None
-        for buf_and_level in _hashsplit_iter([f], progress=prog):
-            yield buf_and_level
+        for chunk in _hashsplit_iter([f], progress=prog, readahead=readahead):
+            yield chunk
 
 
-def hashsplit_iter(files, keep_boundaries, progress):
+def _chunk_iter(files, keep_boundaries, progress, readahead=False):
+    """Yield (chunk, level, zero) for the hashsplit chunks of files,
+    where zero is true if the chunk came from a hole in a sparse file
+    (and so is all zeros)."""
     if keep_boundaries:
-        return _hashsplit_iter_keep_boundaries(files, progress)
+        return _hashsplit_iter_keep_boundaries(files, progress, readahead)
     else:
-        return _hashsplit_iter(files, progress)
+        return _hashsplit_iter(files, progress, readahead)
+
+
+def hashsplit_iter(files, keep_boundaries, progress, readahead=False):
+    """Yield (chunk, level) for the hashsplit chunks of files.
+
+    If readahead is true, the files are read in a separate thread, so
+    reading can overlap with splitting.
+    """
+    for (chunk, level, zero) in _chunk_iter(files, keep_boundaries, progress,
+                                            readahead):
+        yield (chunk, level)
+
+
+def _prepare_chunk(prepare, blob, level, zero):
+    # Chunks from holes are only prepared if they're needed; see
+    # split_to_blobs().
+    if zero:
+        return (blob, level, zero, None)
+    return (blob, level, zero, prepare(blob))
+
+
+def _prepared_iter(files, keep_boundaries, progress, prepare, jobs):
+    """Yield (chunk, level, zero, prepare(chunk)) for the chunks of files,
+    except that the last item is None for zero chunks (see
+    _chunk_iter()).
+
+    With jobs > 1, reading, splitting, and prepare() all run in
+    separate threads (prepare() in a pool of jobs threads), but the
+    results are still yielded in file order.
+    """
+    if jobs <= 1:
+        for (blob, level, zero) in _chunk_iter(files, keep_boundaries,
+                                               progress):
+            yield _prepare_chunk(prepare, blob, level, zero)
+        return
+    def prepare_batch(batch):
+        return [_prepare_chunk(prepare, blob, level, zero)
+                for (blob, level, zero) in batch]
+    it = _chunk_iter(files, keep_boundaries, progress, readahead=True)
+    batches = _background_iter(_batches(it, CHUNKS_PER_JOB), jobs)
+    for batch in _parallel_map(prepare_batch, batches, jobs):
+        for x in batch:
+            yield x
+
+
+def _noprepare(blob):
+    return blob
 
 
 total_split = 0
-def split_to_blobs(makeblob, files, keep_boundaries, progress):
+def split_to_blobs(makeblob, files, keep_boundaries, progress,
+                   prepare=None, jobs=1):
+    """Write the hashsplit chunks of files and yield (sha, size, level).
+
+    Each chunk is passed through prepare() (if given) and the result
+    handed to makeblob(), which must return the chunk's sha.  prepare()
+    must be thread-safe: with jobs > 1 it is called from a pool of
+    worker threads, while makeblob() is always called from the calling
+    thread, in order.
+
+    Runs of zeros that come from holes in sparse files are only passed
+    to prepare() and makeblob() the first time we see a chunk of each
+    size; after that we already know the sha.
+    """
     global total_split
-    for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
-        sha = makeblob(blob)
+    prepare = prepare or _noprepare
+    zero_shas = {}
+    for (blob, level, zero, item) in _prepared_iter(files, keep_boundaries,
+                                                    progress, prepare, jobs):
+        if not zero:
+            sha = makeblob(item)
+        else:
+            sha = zero_shas.get(len(blob))
+            if not sha:
+                sha = zero_shas[len(blob)] = makeblob(prepare(blob))
         total_split += len(blob)
         if progress_callback:
             progress_callback(len(blob))
@@ -122,7 +558,6 @@ def split_to_blobs(makeblob, files, keep_boundaries, progress):
 
 def _make_shalist(l):
     ofs = 0
-    l = list(l)
     total = sum(size for mode,sha,size, in l)
     vlen = len('%x' % total)
     shalist = []
@@ -134,6 +569,11 @@ def _make_shalist(l):
 
 
 def _squish(maketree, stacks, n):
+    """Close levels 0 to n-1 of the chunk tree: each stacks[i] (if
+    there's more than one thing in it) becomes a tree in stacks[i+1].
+    Levels that have grown to MAX_PER_TREE entries are closed too, so
+    stacks never holds more than len(stacks) * MAX_PER_TREE entries,
+    however big the file is."""
     i = 0
     while i < n or len(stacks[i]) >= MAX_PER_TREE:
         while len(stacks) <= i+1:
@@ -149,8 +589,18 @@ def _squish(maketree, stacks, n):
 
 
 def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+                     keep_boundaries, progress=None, prepare=None, jobs=1,
+                     stacks=None):
+    """Split files and return the shalist of the top of the chunk tree.
+
+    Each subtree is written with maketree() as soon as it's complete,
+    so only the entries of the unfinished trees along the right edge
+    are kept in memory (in stacks, a list of them for each level).  If
+    stacks is given, carry on building the tree from there (see
+    append_point()).
+    """
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress,
+                        prepare=prepare, jobs=jobs)
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -158,7 +608,8 @@ def split_to_shalist(makeblob, maketree, files,
             shal.append((GIT_MODE_FILE, sha, size))
         return _make_shalist(shal)[0]
     else:
-        stacks = [[]]
+        if stacks is None:
+            stacks = [[]]
         for (sha,size,level) in sl:
             stacks[0].append((GIT_MODE_FILE, sha, size))
             _squish(maketree, stacks, level)
@@ -169,17 +620,109 @@ def split_to_shalist(makeblob, maketree, files,
 
 
 def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
-    shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+                          keep_boundaries, progress=None,
+                          prepare=None, jobs=1, stacks=None):
+    shalist = split_to_shalist(makeblob, maketree,
+                               files, keep_boundaries, progress,
+                               prepare=prepare, jobs=jobs, stacks=stacks)
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
-        return (GIT_MODE_FILE, makeblob(''))
+        return (GIT_MODE_FILE, makeblob((prepare or _noprepare)('')))
     else:
         return (GIT_MODE_TREE, maketree(shalist))
 
 
+def _chunk_tree_entries(readtree, sha, start):
+    """Return [(mode, sha, ofs)] for the chunk tree sha that starts at
+    file offset start, or None if it might be an overflow tree (see
+    _squish()), whose entries don't tell us anything about levels."""
+    entries = [(mode, sha, start + int(name, 16))
+               for (mode, name, sha) in readtree(sha)]
+    if not entries or len(entries) >= MAX_PER_TREE or entries[0][2] != start:
+        return None
+    return entries
+
+
+def _end_level(f, readtree, mode, sha, start, end, basebits, fanbits):
+    """Return (level, natural) for the split at the end of the chunk
+    (tree) sha at file offsets [start, end), or None if f doesn't have
+    the same data there any more.  natural is false for chunks that
+    were cut at BLOB_MAX."""
+    while mode == GIT_MODE_TREE:
+        entries = _chunk_tree_entries(readtree, sha, start)
+        if not entries:
+            return None
+        (mode, sha, start) = entries[-1]
+    if mode != GIT_MODE_FILE or not start < end <= start + BLOB_MAX:
+        return None
+    f.seek(start)
+    data = f.read(end - start)
+    if Sha1('blob %d\0%s' % (len(data), data)).digest() != sha:
+        return None
+    (ofs, bits) = _helpers.splitbuf(data)
+    if ofs == len(data):
+        return ((bits-basebits)//fanbits, True)
+    elif not ofs and len(data) == BLOB_MAX:
+        return (0, False)
+    return None
+
+
+def append_point(f, mode, sha, readtree):
+    """Find where to pick up splitting file f, which was saved as (mode,
+    sha) and has only been appended to since.
+
+    readtree(sha) must return the list of (mode, name, sha) in the
+    given tree.  Returns (ofs, stacks) and leaves f at ofs, so that
+    split_to_blob_or_tree(..., stacks=stacks) on the rest of f gives
+    the same result as splitting all of it again, or returns None (with
+    f anywhere) if the whole file has to be split.
+
+    Everything before the last chunk is reused; we just check that the
+    chunk before that is still there and still ends in a split, since
+    that's where splitting starts over.  (If a run of data with no
+    split points was cut at BLOB_MAX and one of those cuts happens to
+    look like a natural split, the new tree can differ from a full
+    split; it's still a correct backup of the file.)
+    """
+    if mode != GIT_MODE_TREE or not fanout:
+        return None
+    basebits = _helpers.blobbits()
+    fanbits = int(math.log(fanout, 2))
+    lists = []
+    start = 0
+    natural = False
+    try:
+        while mode == GIT_MODE_TREE:
+            entries = _chunk_tree_entries(readtree, sha, start)
+            if not entries or len(entries) < 2:
+                return None
+            items = []
+            for ((mode, sha, ofs), (nmode, nsha, end)) in zip(entries,
+                                                               entries[1:]):
+                if end <= ofs:
+                    return None
+                items.append((mode, sha, end - ofs))
+            (mode, sha, ofs) = entries[-2]
+            r = _end_level(f, readtree, mode, sha, ofs, end, basebits, fanbits)
+            if not r:
+                return None
+            (level, natural) = r
+            if lists and level >= lists[-1][0]:
+                return None
+            lists.append((level, items))
+            (mode, sha, start) = entries[-1]
+    except ValueError:  # not a chunk tree after all
+        return None
+    if mode != GIT_MODE_FILE or not natural:
+        return None
+    stacks = [[] for i in xrange(lists[0][0] + 1)]
+    for (level, items) in lists:
+        stacks[level] = items
+    f.seek(start)
+    return (start, stacks)
+
+
 def open_noatime(name):
     fd = _helpers.open_noatime(name)
     try:
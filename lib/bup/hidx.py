@@ -0,0 +1,225 @@
+"""A hash index (bup.hidx) is an optional, repository-wide table of every
+object in the .idx files of a directory, which finds an object, its
+pack and its offset in about one memory access, however many packs or
+midx files there are.
+
+It's an open addressing hash table of 2^bits 32-byte slots, each with a
+sha, the number of the .idx file it came from (counting from 1; 0
+marks an empty slot) and its offset in that .idx's pack.  Since shas
+are already evenly distributed, the first bits of a sha are the slot it
+belongs in, and when that's taken it goes in the next free one.  With
+the table at most MAX_LOAD full, a lookup takes about 1.5 probes if the
+object is there and 2.5 if it isn't, usually all in one cache line.
+The price is space: 64 to 128 bytes per object, against about 28 for a
+midx.
+
+New .idx files are added in place until the table gets too full, and
+then it's rebuilt twice as big from the old table, without opening the
+.idx files it already covers; see git.update_hidx().  A hash index
+that's being updated is marked as such in its header and ignored until
+the update is done.
+"""
+import math, struct
+from bup import _helpers
+from bup.helpers import *
+
+HIDX_VERSION = 1
+HIDX_HEADERLEN = 24
+SLOT_SIZE = 32
+MAX_LOAD = 0.5
+MIN_BITS = 10
+MAX_BITS = 40
+
+FLAG_UPDATING = 1
+
+_total_searches = 0
+_total_steps = 0
+
+
+def bits_for(count):
+    """Return the table size (in bits of address) for a hash index that
+    should hold count objects, leaving room for as many again."""
+    bits = int(math.ceil(math.log(max(count, 1) * 2 / MAX_LOAD, 2)))
+    return min(max(bits, MIN_BITS), MAX_BITS)
+
+
+class PackHidx:
+    """An open hash index file; see the module documentation."""
+    def __init__(self, filename, readwrite=False):
+        self.name = filename
+        self.map = None
+        self.rwfile = None
+        assert(filename.endswith('.hidx'))
+        f = open(filename, readwrite and 'r+b' or 'rb')
+        head = f.read(HIDX_HEADERLEN)
+        if len(head) < HIDX_HEADERLEN or head[0:4] != 'HIDX':
+            log('Warning: invalid HIDX header in %r\n' % filename)
+            f.close()
+            return self._init_failed()
+        ver, self.bits, self.flags, self.count \
+            = struct.unpack('!IIIQ', head[4:])
+        if ver != HIDX_VERSION:
+            log('Warning: ignoring %s (v%d) hidx %r\n'
+                % (ver < HIDX_VERSION and 'old-style' or 'too-new',
+                   ver, filename))
+            f.close()
+            return self._init_failed()
+        if self.bits > MAX_BITS:
+            log('Warning: invalid table size in hidx %r\n' % filename)
+            f.close()
+            return self._init_failed()
+        self.table_end = HIDX_HEADERLEN + SLOT_SIZE * 2**self.bits
+        # Only the header and table are mapped: the names that follow are
+        # rewritten whenever an .idx is added.
+        f.seek(self.table_end)
+        names = f.read()
+        self.idxnames = names and names.split('\0') or []
+        if readwrite:
+            self.rwfile = f
+            self.map = mmap_readwrite(f, self.table_end, close=False)
+        else:
+            self.map = mmap_read(f, self.table_end)
+
+    def __del__(self):
+        self.close()
+
+    def _init_failed(self):
+        self.bits = 0
+        self.flags = 0
+        self.count = 0
+        self.idxnames = []
+
+    def valid(self):
+        """Return true if the hash index can be used: it was read
+        correctly and isn't in the middle of an update."""
+        return self.map is not None and not self.flags & FLAG_UPDATING
+
+    def close(self):
+        if self.map is not None and self.rwfile:
+            self._set_flags(self.flags & ~FLAG_UPDATING)
+            self.rwfile.close()
+            self.rwfile = None
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def _set_flags(self, flags):
+        self.flags = flags
+        self.map[12:24] = struct.pack('!IQ', flags, self.count)
+        self.map.flush()
+
+    def room(self):
+        """Return how many objects can be added without making the table
+        too full."""
+        return max(0, int(MAX_LOAD * 2**self.bits) - self.count)
+
+    def _start_update(self):
+        assert(self.rwfile)
+        if not self.flags & FLAG_UPDATING:
+            self._set_flags(self.flags | FLAG_UPDATING)
+
+    def _write_names(self):
+        # The list only ever grows, so rewrite it in place: truncating it
+        # first would let a reader see no names at all.
+        self.rwfile.seek(self.table_end)
+        self.rwfile.write('\0'.join(self.idxnames))
+        self.rwfile.flush()
+
+    def add_idx(self, ix):
+        """Add the objects of an open PackIdx that aren't already in the
+        table, and return how many there were."""
+        self._start_update()
+        self.idxnames.append(os.path.basename(ix.name))
+        if ix.entry_size == 24:
+            ofs, ofs64 = '', ''
+        else:
+            ofs, ofs64 = ix.ofstable, ix.ofs64table
+        added = _helpers.hidx_add(self.map, self.bits, ix.shatable,
+                                  ix.entry_size, ofs, ofs64,
+                                  len(self.idxnames))
+        self.count += added
+        self._write_names()
+        return added
+
+    def add_from(self, other):
+        """Copy everything in the open PackHidx other into this new,
+        empty table."""
+        assert(not self.idxnames)  # the idx numbers are copied as they are
+        self._start_update()
+        self.idxnames.extend(other.idxnames)
+        self.count += _helpers.hidx_rehash(self.map, self.bits,
+                                           other.map, other.bits)
+        self._write_names()
+
+    def _slot_from_hash(self, hash):
+        global _total_searches, _total_steps
+        _total_searches += 1
+        if self.map is None:
+            return None
+        slot, steps = _helpers.hidx_find(self.map, self.bits, str(hash))
+        _total_steps += steps
+        return slot
+
+    def _slot(self, slot):
+        start = HIDX_HEADERLEN + slot*SLOT_SIZE
+        return struct.unpack('!20sIQ', self.map[start:start+SLOT_SIZE])
+
+    def _idxname(self, which):
+        if which > len(self.idxnames):
+            # An update added it since we read the names.
+            with open(self.name, 'rb') as f:
+                f.seek(self.table_end)
+                self.idxnames = f.read().split('\0')
+        return self.idxnames[which-1]
+
+    def exists(self, hash, want_source=False):
+        """Return nonempty if the object is in the hash index."""
+        slot = self._slot_from_hash(hash)
+        if slot is None:
+            return None
+        if want_source:
+            return self._idxname(self._slot(slot)[1])
+        return True
+
+    def exists_many(self, hashes, want_source=False):
+        """Like exists() for each of hashes."""
+        return [self.exists(hash, want_source) for hash in hashes]
+
+    def find_offset(self, hash):
+        """Get the offset of an object inside the pack it's in (see
+        find_pack_and_offset())."""
+        found = self.find_pack_and_offset(hash)
+        return found and found[1]
+
+    def find_pack_and_offset(self, hash):
+        """Return the name of the .idx of the pack that contains the
+        object and the object's offset in it, or None."""
+        slot = self._slot_from_hash(hash)
+        if slot is None:
+            return None
+        sha, which, ofs = self._slot(slot)
+        return self._idxname(which), ofs
+
+    def __iter__(self):
+        """Yield the shas in the table, in no particular order."""
+        for slot in xrange(2**self.bits):
+            sha, which, ofs = self._slot(slot)
+            if which:
+                yield sha
+
+    def __len__(self):
+        return int(self.count)
+
+
+def create(name, bits):
+    """Create and return an empty, writable hash index of 2^bits slots."""
+    assert(MIN_BITS <= bits <= MAX_BITS)
+    debug1('hidx: using 2^%d slots (%d bytes)\n' % (bits, SLOT_SIZE*2**bits))
+    with open(name, 'w+b') as f:
+        f.write('HIDX')
+        f.write(struct.pack('!IIIQ', HIDX_VERSION, bits, FLAG_UPDATING, 0))
+        assert(f.tell() == HIDX_HEADERLEN)
+        # NOTE: On some systems this will not extend+zerofill, but it does
+        # on darwin, linux, bsd and solaris.
+        f.truncate(HIDX_HEADERLEN + SLOT_SIZE*2**bits)
+    return PackHidx(name, readwrite=True)
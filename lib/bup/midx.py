@@ -1,10 +1,11 @@
-import mmap
+import mmap, math
 from bup import _helpers
 from bup.helpers import *
 
-MIDX_VERSION = 4
+MIDX_VERSION = 5
+PAGE_SIZE = 4096
+SHA_PER_PAGE = PAGE_SIZE/20.
 
-extract_bits = _helpers.extract_bits
 _total_searches = 0
 _total_steps = 0
 
@@ -38,14 +39,20 @@ class PackMidx:
             return self._init_failed()
 
         self.bits = _helpers.firstword(self.map[8:12])
+        self.ofs64_count = _helpers.firstword(self.map[12:16])
         self.entries = 2**self.bits
-        self.fanout = buffer(self.map, 12, self.entries*4)
-        self.sha_ofs = 12 + self.entries*4
+        self.fanout = buffer(self.map, 16, self.entries*4)
+        self.sha_ofs = 16 + self.entries*4
         self.nsha = nsha = self._fanget(self.entries-1)
         self.shatable = buffer(self.map, self.sha_ofs, nsha*20)
         self.which_ofs = self.sha_ofs + 20*nsha
         self.whichlist = buffer(self.map, self.which_ofs, nsha*4)
-        self.idxnames = str(self.map[self.which_ofs + 4*nsha:]).split('\0')
+        self.ofs_ofs = self.which_ofs + 4*nsha
+        self.ofstable = buffer(self.map, self.ofs_ofs, nsha*4)
+        self.ofs64_ofs = self.ofs_ofs + 4*nsha
+        self.ofs64table = buffer(self.map, self.ofs64_ofs, self.ofs64_count*8)
+        self.idxnames = str(self.map[self.ofs64_ofs
+                                     + 8*self.ofs64_count:]).split('\0')
 
     def __del__(self):
         self.close()
@@ -71,6 +78,22 @@ class PackMidx:
     def _get_idxname(self, i):
         return self.idxnames[self._get_idx_i(i)]
 
+    def _ofs_from_idx(self, i):
+        ofs = struct.unpack('!I', str(buffer(self.ofstable, i*4, 4)))[0]
+        if ofs & 0x80000000:
+            idx64 = ofs & 0x7fffffff
+            ofs = struct.unpack('!Q',
+                                str(buffer(self.ofs64table, idx64*8, 8)))[0]
+        return ofs
+
+    def _idx_from_hash(self, hash):
+        global _total_searches, _total_steps
+        _total_searches += 1
+        i, steps = _helpers.find_sha(self.fanout, self.bits, self.shatable,
+                                     20, str(hash))
+        _total_steps += steps
+        return i
+
     def close(self):
         if self.map is not None:
             self.map.close()
@@ -78,38 +101,39 @@ class PackMidx:
 
     def exists(self, hash, want_source=False):
         """Return nonempty if the object exists in the index files."""
-        global _total_searches, _total_steps
-        _total_searches += 1
-        want = str(hash)
-        el = extract_bits(want, self.bits)
-        if el:
-            start = self._fanget(el-1)
-            startv = el << (32-self.bits)
-        else:
-            start = 0
-            startv = 0
-        end = self._fanget(el)
-        endv = (el+1) << (32-self.bits)
-        _total_steps += 1   # lookup table is a step
-        hashv = _helpers.firstword(hash)
-        #print '(%08x) %08x %08x %08x' % (extract_bits(want, 32), startv, hashv, endv)
-        while start < end:
-            _total_steps += 1
-            #print '! %08x %08x %08x   %d - %d' % (startv, hashv, endv, start, end)
-            mid = start + (hashv-startv)*(end-start-1)/(endv-startv)
-            #print '  %08x %08x %08x   %d %d %d' % (startv, hashv, endv, start, mid, end)
-            v = self._get(mid)
-            #print '    %08x' % self._num(v)
-            if v < want:
-                start = mid+1
-                startv = _helpers.firstword(v)
-            elif v > want:
-                end = mid
-                endv = _helpers.firstword(v)
-            else: # got it!
-                return want_source and self._get_idxname(mid) or True
+        i = self._idx_from_hash(hash)
+        if i is not None:
+            return want_source and self._get_idxname(i) or True
         return None
 
+    def find_offset(self, hash):
+        """Get the offset of an object inside the pack it's in (see
+        find_pack_and_offset())."""
+        i = self._idx_from_hash(hash)
+        if i is not None:
+            return self._ofs_from_idx(i)
+        return None
+
+    def find_pack_and_offset(self, hash):
+        """Return the name of the .idx of the pack that contains the
+        object and the object's offset in it, or None."""
+        i = self._idx_from_hash(hash)
+        if i is not None:
+            return self._get_idxname(i), self._ofs_from_idx(i)
+        return None
+
+    def exists_many(self, hashes, want_source=False):
+        """Like exists() for each of the sorted list hashes, but in one
+        pass over the index."""
+        global _total_searches
+        _total_searches += len(hashes)
+        table = buffer(self.shatable, 0, len(self)*20)
+        found = _helpers.find_shas(table, 20, ''.join(hashes))
+        if want_source:
+            return [i is not None and self._get_idxname(i) or None
+                    for i in found]
+        return [i is not None or None for i in found]
+
     def __iter__(self):
         for i in xrange(self._fanget(self.entries-1)):
             yield buffer(self.shatable, i*20, 20)
@@ -118,3 +142,55 @@ class PackMidx:
         return int(self._fanget(self.entries-1))
 
 
+
+
+def write(outfilename, idxs):
+    """Write a midx file covering the given open PackIdx and PackMidx
+    objects, replacing any existing outfilename, and return the number
+    of objects in it."""
+    inp = []
+    total = 0
+    ofs64_max = 0
+    allfilenames = []
+    for ix in idxs:
+        inp.append((
+            ix.map,
+            len(ix),
+            ix.sha_ofs,
+            isinstance(ix, PackMidx) and ix.which_ofs or 0,
+            len(allfilenames),
+            ix.ofs_ofs,
+            ix.ofs64_ofs,
+        ))
+        for n in ix.idxnames:
+            allfilenames.append(os.path.basename(n))
+        total += len(ix)
+        ofs64_max += ix.ofs64_count
+    inp.sort(lambda x,y: cmp(str(y[0][y[2]:y[2]+20]),str(x[0][x[2]:x[2]+20])))
+
+    pages = int(total/SHA_PER_PAGE) or 1
+    bits = int(math.ceil(math.log(pages, 2)))
+    entries = 2**bits
+    debug1('midx: table size: %d (%d bits)\n' % (entries*4, bits))
+
+    unlink(outfilename)
+    with atomically_replaced_file(outfilename, 'wb') as f:
+        f.write('MIDX')
+        f.write(struct.pack('!III', MIDX_VERSION, bits, 0))
+        assert(f.tell() == 16)
+
+        # Leave room for every 64-bit offset of the inputs; the unused
+        # part is cut off again below.
+        end = 16 + 4*entries + 20*total + 4*total + 4*total
+        f.truncate(end + 8*ofs64_max)
+        f.flush()
+        fdatasync(f.fileno())
+
+        fmap = mmap_readwrite(f, close=False)
+
+        count, ofs64_count = _helpers.merge_into(fmap, bits, total, inp)
+        fmap.close()
+        f.truncate(end + 8*ofs64_count)
+        f.seek(0, os.SEEK_END)
+        f.write('\0'.join(allfilenames))
+    return total
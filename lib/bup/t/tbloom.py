@@ -1,5 +1,5 @@
 import errno, platform, tempfile
-from bup import bloom
+from bup import bloom, _helpers
 from bup.helpers import *
 from wvtest import *
 
@@ -16,12 +16,14 @@ def test_bloom():
     ix = Idx()
     ix.name='dummy.idx'
     ix.shatable = ''.join(hashes)
-    for k in (4, 5):
-        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k)
+    for version, k in ((2, 4), (2, 5), (3, 5), (3, 6)):
+        b = bloom.create(tmpdir + '/pybuptest.bloom', expected=100, k=k,
+                         version=version)
         b.add_idx(ix)
         WVPASSLT(b.pfalse_positive(), .1)
         b.close()
         b = bloom.ShaBloom(tmpdir + '/pybuptest.bloom')
+        WVPASSEQ((b.version, b.k), (version, k))
         all_present = True
         for h in hashes:
             all_present &= b.exists(h)
@@ -44,7 +46,8 @@ def test_bloom():
     tf = tempfile.TemporaryFile()
     skip_test = False
     try:
-        b = bloom.create('bup.bloom', f=tf, expected=2**28, delaywrite=False)
+        b = bloom.create('bup.bloom', f=tf, expected=2**28, delaywrite=False,
+                         version=2)
     except EnvironmentError, ex:
         (ptr_width, linkage) = platform.architecture()
         if ptr_width == '32bit' and ex.errno == errno.ENOMEM:
@@ -57,3 +60,37 @@ def test_bloom():
         WVPASSEQ(b.k, 4)
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_bloom3():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tbloom-')
+    hashes = [os.urandom(20) for i in range(20000)]
+    class Idx:
+        pass
+    ix = Idx()
+    ix.name='dummy.idx'
+    ix.shatable = ''.join(hashes)
+    # Undersize the filter so there are enough false positives to count.
+    b = bloom.create(tmpdir + '/pybuptest.bloom', expected=len(hashes) / 4)
+    WVPASSEQ((b.version, b.k), (3, 5))
+    b.add_idx(ix)
+    b.close()
+    b = bloom.ShaBloom(tmpdir + '/pybuptest.bloom')
+    WVPASS(not [h for h in hashes if not b.exists(h)])
+    # The false positive rate matches the estimate.
+    others = [os.urandom(20) for i in range(20000)]
+    false_positives = 100. * len([h for h in others if b.exists(h)]) / len(others)
+    WVPASS(.8 < false_positives / b.pfalse_positive() < 1.25)
+    # All the bits of an entry are in the block its first bits pick.
+    b = bloom.create(tmpdir + '/one.bloom', expected=len(hashes))
+    ix.shatable = hashes[0]
+    b.add_idx(ix)
+    block = _helpers.extract_bits(hashes[0], b.bits - 6)
+    bits = str(b.map[16:16 + 2**b.bits])
+    WVPASS(bits[:block*64] + bits[(block+1)*64:] == '\0' * (2**b.bits - 64))
+    WVPASS(bits[block*64:(block+1)*64] != '\0' * 64)
+    b.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
@@ -143,6 +143,30 @@ def test_midx_refreshing():
         subprocess.call(['rm', '-rf', tmpdir])
 
 
+@wvtest
+def test_config_get():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tclient-')
+    os.environ['BUP_MAIN_EXE'] = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir
+    git.init_repo(bupdir)
+    git.git_config_set('bup.compression', 7, repo_dir=bupdir)
+    c = client.Client(bupdir, create=True)
+    WVPASS('config-get' in c.server_commands())
+    WVPASSEQ(c.config_get('bup.compression'), '7')
+    WVPASSEQ(c.config_get('bup.blobbits'), None)
+    WVPASSEQ(git.compression_levels(c.config_get), (7, 7))
+    # An older server isn't asked, so the defaults apply, and the
+    # connection stays usable.
+    c._commands.discard('config-get')
+    WVPASSEQ(c.config_get('bup.compression'), None)
+    WVPASSEQ(git.compression_levels(c.config_get), (1, 1))
+    WVPASSEQ(c.read_ref('refs/heads/master'), None)
+    c.close()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_remote_parsing():
     tests = (
@@ -1,5 +1,5 @@
-import struct, os, tempfile, time
-from bup import git
+import glob, struct, os, tempfile, threading, time
+from bup import git, bloom, midx, hidx, _helpers
 from bup.helpers import *
 from wvtest import *
 
@@ -96,6 +96,605 @@ def testpacks():
     if wvfailure_count() == initial_failures:
         subprocess.call(['rm', '-rf', tmpdir])
 
+
+@wvtest
+def test_prepared_blobs():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+
+    w = git.PackWriter()
+    a = w.prepare_blob('a')
+    a2 = w.prepare_blob('a')
+    WVPASSEQ(a[0], git.calc_hash('blob', 'a'))
+    WVPASS(a[2])
+    WVPASSEQ(w.write_prepared(a), a[0])
+    WVPASSEQ(w.write_prepared(a2), a[0])
+    WVPASSEQ(w.count, 1)
+    b = w.prepare_blob('a')
+    WVPASSEQ(b[2], None)
+    WVPASSEQ(w.new_blob('b'), w.write_prepared(w.prepare_blob('b')))
+    WVPASSEQ(w.count, 2)
+    nameprefix = w.close()
+    r = git.open_idx(nameprefix + '.idx')
+    WVPASS(r.exists(a[0]))
+    WVPASSEQ(len(r), 2)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_compression_pool():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    blobs = [os.urandom(n) for n in xrange(0, 50000, 997)]
+    blobs += [('%d\n' % i) * 1000 for i in xrange(20)]
+
+    def write_all(jobs):
+        os.environ['BUP_DIR'] = bupdir = '%s/bup%d' % (tmpdir, jobs)
+        git.init_repo(bupdir)
+        w = git.PackWriter(compression_level=9, jobs=jobs)
+        shas = []
+        for (i, blob) in enumerate(blobs):
+            if i % 3:
+                shas.append(w.new_blob(blob))
+            else:
+                shas.append(w.write_prepared(w.prepare_blob(blob)))
+        shas.append(w.new_tree([(0100644, '%d' % i, sha)
+                                for (i, sha) in enumerate(shas)]))
+        w.new_blob(blobs[-1])  # already there
+        w.new_blob('last one')
+        w.close()
+        packs = {}
+        for name in glob.glob(bupdir + '/objects/pack/*.pack'):
+            data = open(name).read()
+            packs[os.path.basename(name)] = (Sha1(data).hexdigest(),
+                                             struct.unpack('!I', data[8:12])[0])
+        r = git.PackIdxList(bupdir + '/objects/pack')
+        WVPASS(not [sha for sha in shas if not r.exists(sha)])
+        return (shas, packs)
+
+    old_max = git.max_pack_objects
+    try:
+        git.max_pack_objects = 7
+        (shas, packs) = write_all(1)
+        # The pool compresses in the background, but we end up with
+        # exactly the same packs.
+        (shas4, packs4) = write_all(4)
+        WVPASS(shas4 == shas)
+        WVPASSEQ(packs4, packs)
+        WVPASSEQ(len(shas), len(blobs) + 1)
+        counts = sorted(count for (sha, count) in packs.itervalues())
+        WVPASSEQ(sum(counts), len(shas) + 1)
+        WVPASSEQ(counts[1:], [7] * (len(counts) - 1))
+    finally:
+        git.max_pack_objects = old_max
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_adaptive_compression():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    noise = [os.urandom(8192) for i in xrange(20)]
+    text = [('%d\n' % i) * 4000 for i in xrange(20)]
+
+    w = git.PackWriter(adaptive=True)
+    shas = [w.new_blob(blob) for blob in noise]
+    WVPASSEQ(w.adaptive.stored, len(noise))
+    WVPASSEQ(w.adaptive.stored_bytes, 8192 * len(noise))
+    WVPASS(w.adaptive.sampled < len(noise))
+    # Only every SKIP'th object is sampled by now, so a few of the text
+    # blobs are stored uncompressed before we notice the change.
+    shas += [w.new_blob(blob) for blob in text]
+    shas.append(w.new_blob('small'))
+    skip = git._Compressibility.SKIP
+    WVPASS(len(noise) < w.adaptive.stored < len(noise) + skip)
+    w.close()
+    WVPASS(w.outbytes > 8192 * len(noise))
+    WVPASS(w.outbytes < 8192 * len(noise) + len(text[-1]) * skip)
+
+    WVPASSEQ(shas, [git.calc_hash('blob', blob)
+                    for blob in noise + text + ['small']])
+    cp = git.CatPipe()
+    for (sha, blob) in zip(shas, noise + text + ['small']):
+        if Sha1(''.join(cp.join(sha.encode('hex')))).digest() \
+                != Sha1(blob).digest():
+            WVFAIL('blob %s differs' % sha.encode('hex'))
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_meta_compression():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w = git.PackWriter(compression_level=0, meta_compression_level=9)
+    WVPASSEQ(git.PackWriter().meta_compression_level, 1)
+    WVPASSEQ(git.PackWriter(compression_level=5).meta_compression_level, 5)
+    data = 'file data\n' * 10000
+    blob = w.new_blob(data)
+    WVPASS(w.outbytes > len(data))
+    size = w.outbytes
+    meta = w.new_blob('metadata\n' * 10000, meta=True)
+    WVPASS(w.outbytes - size < 1000)
+    size = w.outbytes
+    shalist = [(0100644, '%d' % i, blob) for i in xrange(1000)]
+    tree = w.new_tree(shalist)
+    WVPASS(w.outbytes - size < len(git.tree_encode(shalist)) / 4)
+    w.close()
+    cp = git.CatPipe()
+    WVPASS(''.join(cp.join(meta.encode('hex'))) == 'metadata\n' * 10000)
+    WVPASS(''.join(cp.join(blob.encode('hex'))) == data)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_meta_packs():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    cache = git.shared_pack_idx_list(bupdir + '/objects/pack')
+    old_max = git.max_pack_objects
+    try:
+        git.max_pack_objects = 10
+        w = git.PackWriter(meta_packs=True, jobs=2)
+        data = [w.new_blob('data %d' % i) for i in xrange(25)]
+        meta = [w.new_blob('meta %d' % i, meta=True) for i in xrange(5)]
+        meta.append(w.new_tree([(0100644, '%d' % i, sha)
+                                for (i, sha) in enumerate(data + meta)]))
+        meta.append(w.new_commit(None, meta[-1], 0, 'msg'))
+        WVPASSEQ(w.new_blob('data 3'), data[3])
+        WVPASSEQ(w.new_blob('meta 3', meta=True), meta[3])
+        w.close()
+        # The shared object cache found the meta pack too.
+        WVPASSEQ(len(cache.also), 0)
+        WVPASS(cache.exists(meta[-1]))
+        # A meta pack that fills up is finished on its own.
+        w = git.PackWriter(meta_packs=True)
+        meta2 = [w.new_blob('meta2 %d' % i, meta=True) for i in xrange(12)]
+        WVPASSEQ(sorted(cache.also), sorted(meta2[10:]))
+        w.close()
+        WVPASSEQ(len(cache.also), 0)
+    finally:
+        git.max_pack_objects = old_max
+    idxs = [git.open_idx(name)
+            for name in glob.glob(bupdir + '/objects/pack/*.idx')]
+    meta_idxs = [idx for idx in idxs if idx.exists(meta[0])]
+    WVPASSEQ(len(meta_idxs), 1)
+    WVPASSEQ(sorted(str(sha) for sha in meta_idxs[0]), sorted(meta))
+    WVPASSEQ(len(idxs), 6)
+    WVPASSEQ(sum(len(idx) for idx in idxs),
+             len(data) + len(meta) + len(meta2))
+    r = git.PackIdxList(bupdir + '/objects/pack')
+    WVPASS(not [sha for sha in data + meta + meta2 if not r.exists(sha)])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_shared_objcache():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    w1 = git.PackWriter()
+    w2 = git.PackWriter()
+    sha = w1.new_blob('both')
+    WVPASS(w2.exists(sha))
+    WVPASS(w1.objcache is w2.objcache)
+    WVPASSEQ(w2.new_blob('both'), sha)
+    WVPASSEQ(w2.count, 0)
+    w1.close()
+    # The cache now finds it in w1's pack instead.
+    WVPASS(w2.exists(sha))
+    WVPASS(sha not in w2.objcache.also)
+    sha2 = w2.new_blob('just w2')
+    w2.close()
+    r = git.PackIdxList(bupdir + '/objects/pack')
+    WVPASS(r.exists(sha) and r.exists(sha2))
+    WVPASSEQ(len(r), 2)
+
+    # Several threads writing the same objects store each one once, and
+    # each close() waits for the packs holding what it left to others.
+    blobs = ['blob %d' % i for i in xrange(200)]
+    writers = [git.PackWriter() for i in xrange(4)]
+    counts = []
+    stored = []
+    def write(w, blobs):
+        for blob in blobs:
+            w.new_blob(blob)
+        counts.append(w.count)
+        w.close()
+        r = git.PackIdxList(bupdir + '/objects/pack')
+        stored.append(not [b for b in blobs
+                           if not r.exists(git.calc_hash('blob', b))])
+    threads = [threading.Thread(target=write, args=(w, blobs[i::3] + blobs))
+               for (i, w) in enumerate(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    WVPASSEQ(sum(counts), len(blobs))
+    WVPASSEQ(stored, [True] * len(writers))
+    r = git.PackIdxList(bupdir + '/objects/pack')
+    WVPASSEQ(len(r), len(blobs) + 2)
+
+    # What an aborted writer claimed is left to the others again, and
+    # a writer that relied on it can't close.
+    w1 = git.PackWriter()
+    w2 = git.PackWriter()
+    sha = w1.new_blob('aborted')
+    w2.new_blob('aborted')
+    WVPASSEQ(w2.count, 0)
+    w1.abort()
+    WVPASS(not w2.exists(sha))
+    WVEXCEPT(git.GitError, w2.close)
+    w3 = git.PackWriter()
+    WVPASSEQ(w3.new_blob('aborted'), sha)
+    WVPASSEQ(w3.count, 1)
+    w4 = git.PackWriter()
+    w4.new_blob('aborted')
+    WVPASSEQ(w4.count, 0)
+    w3.close()
+    w4.close()
+    r = git.PackIdxList(bupdir + '/objects/pack')
+    WVPASS(r.exists(sha))
+
+    # So is what a writer claimed before a write failed.
+    w1 = git.PackWriter()
+    w1.new_blob('fine')
+    def fail(datalist, sha):
+        raise git.GitError('disk full')
+    w1._raw_write = fail
+    WVEXCEPT(git.GitError, w1.new_blob, 'failed')
+    w2 = git.PackWriter()
+    w2.new_blob('fine')
+    w2.new_blob('failed')
+    WVPASSEQ(w2.count, 2)
+    w2.close()
+    w1.abort()
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_auto_midx():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+    old_max = git.max_pack_objects
+    try:
+        git.max_pack_objects = 500
+        w = git.PackWriter()
+        shas = [w.new_blob('blob %d' % i) for i in xrange(10000)]
+        w.close()
+    finally:
+        git.max_pack_objects = old_max
+    idxs = glob.glob(packdir + '/*.idx')
+    WVPASSEQ(len(idxs), 20)
+    # Every pack is in the bloom filter, and few enough indexes are left.
+    # The filter grew by adding layers rather than being regenerated.
+    b = bloom.LayeredBloom(packdir + '/bup.bloom')
+    WVPASSEQ(sorted(b.idxnames), sorted(os.path.basename(n) for n in idxs))
+    WVPASS(len(b.layers) > 1)
+    WVPASS(len(b.layers) < 10)
+    WVPASSEQ(len(b.layers[0].idxnames), 1)
+    WVPASSEQ([l.name for l in b.layers[1:]],
+             bloom.layer_filenames(packdir + '/bup.bloom'))
+    WVPASSEQ(len(b), len(shas))
+    WVPASS(not [sha for sha in shas if not b.exists(sha)])
+    r = git.PackIdxList(packdir)
+    WVPASSEQ(len(r.bloom.layers), len(b.layers))
+    WVPASS(len(r.packs) <= 5)
+    WVPASS(not [sha for sha in shas if not r.exists(sha)])
+    WVPASSEQ(git.update_midx(packdir), [])
+
+    # An incremental update only adds what's new, and the full update
+    # then merges the layers into one filter.
+    w = git.PackWriter()
+    sha = w.new_blob('one more')
+    w.close(run_midx=False)
+    git.update_bloom(packdir, incremental=True)
+    b = bloom.LayeredBloom(packdir + '/bup.bloom')
+    WVPASSEQ(len(b), len(shas) + 1)
+    WVPASS(b.exists(sha))
+    git.update_bloom(packdir)
+    WVPASSEQ(bloom.layer_filenames(packdir + '/bup.bloom'), [])
+    b = bloom.ShaBloom(packdir + '/bup.bloom')
+    WVPASSEQ(len(b), len(shas) + 1)
+    WVPASS(not [s for s in shas + [sha] if not b.exists(s)])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_find_sha():
+    def table(shas, bits, prefix=''):
+        shas = sorted(shas)
+        counts = [0] * 2**bits
+        for sha in shas:
+            counts[struct.unpack('!I', sha[:4])[0] >> (32 - bits)] += 1
+        fanout = []
+        for c in counts:
+            fanout.append((fanout and fanout[-1] or 0) + c)
+        return (struct.pack('!%dI' % len(fanout), *fanout),
+                ''.join(prefix + sha for sha in shas))
+    # Many shas share their first 32 bits, which the interpolation
+    # can't tell apart.
+    shas = [os.urandom(20) for i in xrange(500)]
+    shas += ['\x42\x42\x42\x42' + os.urandom(16) for i in xrange(50)]
+    missing = [os.urandom(20) for i in xrange(100)]
+    missing += ['\x42\x42\x42\x42' + os.urandom(16) for i in xrange(10)]
+    missing += ['\0' * 20, '\xff' * 20]
+    for bits, prefix in ((8, ''), (8, 'xxxx'), (4, ''), (0, '')):
+        fanout, shatable = table(shas, bits, prefix)
+        entry_size = 20 + len(prefix)
+        found = [_helpers.find_sha(fanout, bits, shatable, entry_size, sha)[0]
+                 for sha in shas]
+        WVPASS(found == [sorted(shas).index(sha) for sha in shas])
+        WVPASS(not [sha for sha in missing
+                    if _helpers.find_sha(fanout, bits, shatable, entry_size,
+                                         sha)[0] is not None])
+    WVEXCEPT(ValueError, _helpers.find_sha, fanout[:-4], 0, shatable, 20,
+             shas[0])
+    WVEXCEPT(ValueError, _helpers.find_sha, fanout, 0, shatable[:-4], 20,
+             shas[0])
+
+
+@wvtest
+def test_exists_many():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+    shas = []
+    for i in xrange(3):
+        w = git.PackWriter()
+        shas.extend(w.new_blob('blob %d %d' % (i, j)) for j in xrange(100))
+        w.close(run_midx=False)
+    git.update_midx(packdir, auto=False, force=True)
+    w = git.PackWriter()
+    shas.extend(w.new_blob('blob idx %d' % j) for j in xrange(100))
+    w.close(run_midx=False)
+    missing = [git.calc_hash('blob', 'missing %d' % j) for j in xrange(100)]
+    queries = shas[::3] + missing + shas[1::3] + shas[:5]
+    r = git.PackIdxList(packdir)
+    WVPASS([p for p in r.packs if isinstance(p, midx.PackMidx)])
+    WVPASS([p for p in r.packs if isinstance(p, git.PackIdx)])
+    for want_source in (False, True):
+        WVPASS(r.exists_many(queries, want_source=want_source)
+               == [r.exists(q, want_source=want_source) for q in queries])
+    WVPASSEQ(r.exists_many([]), [])
+    r.add(missing[0])
+    WVPASSEQ(r.exists_many(missing[:2]), [True, None])
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_hidx():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+    hname = packdir + '/bup.hidx'
+    shas = []
+    for i in xrange(2):
+        w = git.PackWriter()
+        shas.extend(w.new_blob('blob %d %d' % (i, j)) for j in xrange(100))
+        w.close()
+    # Nothing happens until there's a hash index.
+    WVPASSEQ(git.update_hidx(packdir), None)
+    WVPASS(not os.path.exists(hname))
+    WVPASSEQ(git.update_hidx(packdir, create=True), hname)
+    h = hidx.PackHidx(hname)
+    WVPASS(h.valid())
+    WVPASSEQ(h.bits, hidx.MIN_BITS)
+    WVPASSEQ(len(h), len(shas))
+
+    # A pack added in place is found by a reader that was already open.
+    w = git.PackWriter()
+    sha = w.new_blob('in place')
+    name = os.path.basename(w.close()) + '.idx'
+    shas.append(sha)
+    WVPASSEQ(h.exists(sha, want_source=True), name)
+    WVPASSEQ(os.path.getsize(hname), h.table_end + len('\0'.join(h.idxnames)))
+    h.close()
+
+    # New packs are added in place, then the table grows.
+    old_max = git.max_pack_objects
+    try:
+        git.max_pack_objects = 100
+        w = git.PackWriter()
+        shas.extend(w.new_blob('blob %d' % j) for j in xrange(1000))
+        w.close()
+    finally:
+        git.max_pack_objects = old_max
+    idxs = glob.glob(packdir + '/*.idx')
+    h = hidx.PackHidx(hname)
+    WVPASS(h.valid())
+    WVPASS(h.bits > hidx.MIN_BITS)
+    WVPASSEQ(len(h), len(shas))
+    WVPASSEQ(sorted(h.idxnames), sorted(os.path.basename(n) for n in idxs))
+    WVPASS(sorted(str(sha) for sha in h) == sorted(shas))
+
+    # It answers for the packs, and for the objects that aren't there.
+    r = git.PackIdxList(packdir)
+    WVPASS(r.hidx is not None)
+    old = git.PackIdxList(packdir)
+    old.refresh(skip_midx=True)
+    WVPASS(old.hidx is None)
+    missing = [git.calc_hash('blob', 'missing %d' % j) for j in xrange(100)]
+    for want_source in (False, True):
+        WVPASS([r.exists(s, want_source=want_source) for s in shas + missing]
+               == [old.exists(s, want_source=want_source)
+                   for s in shas + missing])
+    WVPASS(r.exists_many(shas + missing)
+           == [True] * len(shas) + [None] * len(missing))
+    WVPASS([r.find_pack_and_offset(s) for s in shas + missing]
+           == [old.find_pack_and_offset(s) for s in shas + missing])
+
+    # A pack it doesn't know about keeps it from being used, and one
+    # that's gone gets it rebuilt.
+    w = git.PackWriter()
+    sha = w.new_blob('one more')
+    w.close(run_midx=False)
+    r.refresh()
+    WVPASS(r.hidx is None)
+    WVPASS(r.exists(sha))
+    gone = list(git.open_idx(idxs[0]))
+    os.unlink(idxs[0])
+    git.update_hidx(packdir)
+    h = hidx.PackHidx(hname)
+    WVPASS(h.exists(sha))
+    WVPASS(os.path.basename(idxs[0]) not in h.idxnames)
+    WVPASSEQ(len(h), len(shas) + 1 - len(gone))
+    WVPASS(not [s for s in gone if h.exists(s)])
+    r = git.PackIdxList(packdir)
+    WVPASS(r.hidx is not None)
+    WVPASS(r.exists(sha))
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_pack_generation():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+    packdir = bupdir + '/objects/pack'
+    genfile = packdir + '/bup.gen'
+    w = git.PackWriter()
+    sha1 = w.new_blob('blob 1')
+    w.close()
+    # A recently changed directory can't be trusted.
+    WVPASSEQ(git.pack_generation(packdir), None)
+    t = time.time() - 10
+    os.utime(packdir, (t, t))
+    gen = git.pack_generation(packdir)
+    WVPASS(gen)
+    WVPASSEQ(git.pack_generation(packdir), gen)
+    git.bump_pack_generation(packdir)
+    os.utime(packdir, (t, t))
+    WVPASS(git.pack_generation(packdir) != gen)
+
+    # When nothing seems to have changed, a refresh does nothing...
+    r = git.PackIdxList(packdir)
+    WVPASS(r.exists(sha1))
+    old = open(genfile).read()
+    w = git.PackWriter()
+    sha2 = w.new_blob('blob 2')
+    w.close(run_midx=False)
+    with open(genfile, 'w') as f:
+        f.write(old)
+    os.utime(packdir, (t, t))
+    r.refresh()
+    WVPASS(not r.exists(sha2))
+    # ...until bup records that something did.
+    git.bump_pack_generation(packdir)
+    os.utime(packdir, (t, t))
+    r.refresh()
+    WVPASS(r.exists(sha2))
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
+@wvtest
+def test_compression_levels():
+    def config(values):
+        return lambda name: values.get(name)
+    WVPASSEQ(git.compression_levels(config({})), (1, 1))
+    WVPASSEQ(git.compression_levels(config({}), 9), (9, 9))
+    WVPASSEQ(git.compression_levels(config({}), None, 9), (1, 9))
+    c = config({'bup.compression': '2\n', 'bup.metacompression': '8\n'})
+    WVPASSEQ(git.compression_levels(c), (2, 8))
+    WVPASSEQ(git.compression_levels(c, 0), (0, 8))
+    WVPASSEQ(git.compression_levels(c, 0, 0), (0, 0))
+    c = config({'bup.compression': '6\n'})
+    WVPASSEQ(git.compression_levels(c), (6, 6))
+    WVPASSEQ(git.compression_levels(c, 3), (3, 3))
+    WVEXCEPT(ValueError, git.compression_levels, config({}), 10)
+    WVEXCEPT(ValueError, git.compression_levels,
+             config({'bup.metacompression': 'high'}))
+
+
+@wvtest
+def test_repeat_cache():
+    initial_failures = wvfailure_count()
+    tmpdir = tempfile.mkdtemp(dir=bup_tmp, prefix='bup-tgit-')
+    os.environ['BUP_MAIN_EXE'] = bupmain = '../../../bup'
+    os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+    git.init_repo(bupdir)
+
+    zeros = '\0' * 65536
+    w = git.PackWriter()
+    sha = git.calc_hash('blob', zeros)
+    WVPASSEQ(w.new_blob(zeros), sha)
+    WVPASSEQ(w.new_blob(buffer(zeros)), sha)
+    WVPASSEQ(w.repeats.hits, 0)
+    WVPASSEQ(w.count, 1)
+    # From now on we don't even look it up.
+    w.objcache = None
+    w.objcache_maker = None
+    WVPASSEQ(w.new_blob(buffer('x' + zeros, 1)), sha)
+    WVPASSEQ(w.write_prepared(w.prepare_blob(zeros)), sha)
+    WVPASSEQ(w.repeats.hits, 2)
+    # Same size, start, and end, but different content.
+    other = zeros[:100] + 'x' + zeros[101:]
+    WVEXCEPT(git.GitError, w.new_blob, other)
+    WVPASSEQ(w.repeats.hits, 2)
+    WVPASSEQ(w.repeats.get('tree', zeros), None)
+    WVPASSEQ(w.count, 1)
+    w.abort()
+    WVPASSEQ(w.repeats.get('blob', zeros), None)
+
+    # Only blobs are kept, all-zero ones without a copy of their content,
+    # and other ones up to a size and total byte limit.
+    c = git._RepeatCache(max_size=1000, max_bytes=2500)
+    big_zeros = '\0' * (1024 * 1024 + 1)
+    blobs = [big_zeros, 'x' * 1001] + [chr(i) * 1000 for i in range(1, 4)]
+    for blob in blobs:
+        c.add('blob', blob, git.calc_hash('blob', blob))
+        c.add('blob', blob, git.calc_hash('blob', blob))
+    c.add('tree', zeros, 'a' * 20)
+    c.add('tree', zeros, 'a' * 20)
+    WVPASSEQ(c.get('blob', big_zeros), git.calc_hash('blob', big_zeros))
+    WVPASSEQ(c.get('blob', big_zeros[:500000] + 'x' + big_zeros[500001:]),
+             None)
+    WVPASSEQ(c.get('blob', 'x' * 1001), None)
+    WVPASSEQ(c.get('blob', '\1' * 1000), None)
+    WVPASSEQ(c.get('blob', '\2' * 1000), git.calc_hash('blob', '\2' * 1000))
+    WVPASSEQ(c.get('blob', '\3' * 1000), git.calc_hash('blob', '\3' * 1000))
+    WVPASSEQ(c.get('tree', zeros), None)
+    WVPASSEQ(c.kept_bytes, 2000)
+    if wvfailure_count() == initial_failures:
+        subprocess.call(['rm', '-rf', tmpdir])
+
+
 @wvtest
 def test_pack_name_lookup():
     initial_failures = wvfailure_count()
@@ -141,10 +740,10 @@ def test_long_index():
             0x22334455, 0x66778899, 0x00112233, 0x44556677, 0x88990011)
     pack_bin = struct.pack('!IIIII',
             0x99887766, 0x55443322, 0x11009988, 0x77665544, 0x33221100)
-    idx = list(list() for i in xrange(256))
-    idx[0].append((obj_bin, 1, 0xfffffffff))
-    idx[0x11].append((obj2_bin, 2, 0xffffffffff))
-    idx[0x22].append((obj3_bin, 3, 0xff))
+    idx = git._IdxEntries()
+    idx.add(obj2_bin, 2, 0xffffffffff)
+    idx.add(obj_bin, 1, 0xfffffffff)
+    idx.add(obj3_bin, 3, 0xff)
     (fd,name) = tempfile.mkstemp(suffix='.idx', dir=git.repo('objects'))
     os.close(fd)
     w.count = 3
@@ -153,6 +752,42 @@ def test_long_index():
     WVPASSEQ(i.find_offset(obj_bin), 0xfffffffff)
     WVPASSEQ(i.find_offset(obj2_bin), 0xffffffffff)
     WVPASSEQ(i.find_offset(obj3_bin), 0xff)
+    WVPASSEQ(i.ofs64_count, 2)
+
+    # A midx knows the offsets too, also when it's made from another
+    # midx.
+    w = git.PackWriter()
+    shas = [w.new_blob('blob %d' % j) for j in xrange(10)]
+    packname = w.close(run_midx=False)
+    other = git.open_idx(packname + '.idx')
+    m1 = git.repo('objects/m1.midx')
+    midx.write(m1, [i])
+    m2 = git.repo('objects/m2.midx')
+    midx.write(m2, [midx.PackMidx(m1), other])
+    for m in (m1, m2):
+        m = midx.PackMidx(m)
+        WVPASSEQ(m.ofs64_count, 2)
+        WVPASSEQ(m.find_offset(obj_bin), 0xfffffffff)
+        WVPASSEQ(m.find_pack_and_offset(obj2_bin),
+                 (os.path.basename(name), 0xffffffffff))
+        WVPASSEQ(m.find_offset(obj3_bin), 0xff)
+        WVPASSEQ(m.find_pack_and_offset('\0' * 20), None)
+    WVPASS(not [sha for sha in shas
+                if m.find_pack_and_offset(sha)
+                   != other.find_pack_and_offset(sha)])
+    WVPASS(os.path.basename(packname) + '.idx' in m.idxnames)
+
+    # So does a hash index.
+    h = hidx.create(git.repo('objects/test.hidx'), hidx.MIN_BITS)
+    h.add_idx(i)
+    h.close()
+    h = hidx.PackHidx(git.repo('objects/test.hidx'))
+    WVPASSEQ(len(h), 3)
+    WVPASSEQ(h.find_offset(obj_bin), 0xfffffffff)
+    WVPASSEQ(h.find_pack_and_offset(obj2_bin),
+             (os.path.basename(name), 0xffffffffff))
+    WVPASSEQ(h.find_offset(obj3_bin), 0xff)
+    WVPASSEQ(h.find_pack_and_offset('\0' * 20), None)
     if wvfailure_count() == initial_failures:
         os.remove(name)
         subprocess.call(['rm', '-rf', tmpdir])
@@ -1,7 +1,12 @@
+import os, tempfile
 from bup import hashsplit, _helpers
+from bup.helpers import Sha1, mkdirp
 from wvtest import *
 from cStringIO import StringIO
 
+bup_tmp = os.path.realpath('../../../t/tmp')
+mkdirp(bup_tmp)
+
 @wvtest
 def test_rolling_sums():
     WVPASS(_helpers.selftest())
@@ -20,8 +25,25 @@ def test_fanout_behaviour():
                 return ofs, ord(c)
         return 0, 0
 
-    old_splitbuf = _helpers.splitbuf
-    _helpers.splitbuf = splitbuf
+    # Same as _helpers.splitbuf_all, but built on splitbuf above.
+    def splitbuf_all(buf, blob_max):
+        points = []
+        start = 0
+        while 1:
+            ofs, bits = splitbuf(buffer(buf, start))
+            if not ofs:
+                break
+            if ofs > blob_max:
+                ofs, bits = blob_max, 0
+            start += ofs
+            points.append((start, bits))
+        while len(buf) - start >= blob_max:
+            start += blob_max
+            points.append((start, 0))
+        return points
+
+    old_splitbuf_all = _helpers.splitbuf_all
+    _helpers.splitbuf_all = splitbuf_all
     old_BLOB_MAX = hashsplit.BLOB_MAX
     hashsplit.BLOB_MAX = 4
     old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
@@ -47,7 +69,326 @@ def test_fanout_behaviour():
     WVPASSEQ(levels(split_many),
         [(1, 1), (4, 2), (4, 0), (1, 0), (4, 0), (1, 5), (1, 0)])
 
-    _helpers.splitbuf = old_splitbuf
+    _helpers.splitbuf_all = old_splitbuf_all
     hashsplit.BLOB_MAX = old_BLOB_MAX
     hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
     hashsplit.fanout = old_fanout
+
+
+@wvtest
+def test_tree_memory():
+    # The chunk tree is written out as we go, and we only keep a bounded
+    # number of entries around, however many chunks there are.
+    class RandomFile:
+        def __init__(self, size):
+            self.left = size
+        def read(self, size):
+            size = min(size, self.left)
+            self.left -= size
+            return os.urandom(size)
+
+    f = RandomFile(16*1024*1024)
+    stacks = [[]]
+    trees = []
+    def maketree(shalist):
+        WVPASS(len(shalist) <= hashsplit.MAX_PER_TREE)
+        WVPASS(sum(len(l) for l in stacks) <= 2 * hashsplit.MAX_PER_TREE)
+        trees.append(f.left)
+        return Sha1(repr(shalist)).digest()
+
+    old_fanout = hashsplit.fanout
+    try:
+        # With a huge fanout, every chunk is on level 0, so all the
+        # trees come from hitting MAX_PER_TREE.
+        hashsplit.fanout = 1 << 20
+        hashsplit.configure(10, _helpers.DEFAULT_WINDOWBITS)
+        (mode, sha) = hashsplit.split_to_blob_or_tree(
+            lambda b: Sha1(b).digest(), maketree, [f], False, stacks=stacks)
+    finally:
+        hashsplit.fanout = old_fanout
+        hashsplit.configure(_helpers.DEFAULT_BLOBBITS,
+                            _helpers.DEFAULT_WINDOWBITS)
+    WVPASSEQ(mode, hashsplit.GIT_MODE_TREE)
+    WVPASSEQ(len(stacks), 2)
+    WVPASS(len(trees) > 16*1024 / 4 / hashsplit.MAX_PER_TREE)
+    # Most trees were written while there was still lots left to read.
+    WVPASS(trees[len(trees)//2] > 4*1024*1024)
+
+
+@wvtest
+def test_splitbuf_all():
+    data = os.urandom(1024*1024) + '\0'*(5*hashsplit.BLOB_MAX + 7)
+    points = _helpers.splitbuf_all(data, hashsplit.BLOB_MAX)
+    expected = []
+    start = 0
+    while 1:
+        ofs, bits = _helpers.splitbuf(buffer(data, start))
+        if not ofs:
+            break
+        if ofs > hashsplit.BLOB_MAX:
+            ofs, bits = hashsplit.BLOB_MAX, 0
+        start += ofs
+        expected.append((start, bits))
+    while len(data) - start >= hashsplit.BLOB_MAX:
+        start += hashsplit.BLOB_MAX
+        expected.append((start, 0))
+    WVPASS(len(points) > 100)
+    WVPASSEQ(points, expected)
+    WVPASSEQ(_helpers.splitbuf_all('', hashsplit.BLOB_MAX), [])
+    WVPASSEQ(_helpers.splitbuf_all('\0'*10, 4), [(4, 0), (8, 0)])
+
+
+@wvtest
+def test_multiple_files():
+    # The read blocks are recycled, which mustn't clobber data that
+    # hasn't been split yet, e.g. when switching files.
+    data = os.urandom(int(2.5*hashsplit.BLOB_READ_SIZE))
+    parts = [data[:5], data[5:7], '', data[7:hashsplit.BLOB_READ_SIZE + 9],
+             data[hashsplit.BLOB_READ_SIZE + 9:]]
+    for readahead in (False, True):
+        chunks = [str(b) for (b, level) in
+                  hashsplit.hashsplit_iter([StringIO(p) for p in parts],
+                                           False, None, readahead=readahead)]
+        WVPASSEQ(''.join(chunks), data)
+        whole = [str(b) for (b, level) in
+                 hashsplit.hashsplit_iter([StringIO(data)], False, None)]
+        WVPASSEQ(chunks, whole)
+
+
+@wvtest
+def test_threaded_split():
+    data = os.urandom(3*1024*1024) + '\0'*100000 + os.urandom(500000)
+    def makeblob(b):
+        return Sha1(str(b)).digest()
+    def split(jobs):
+        return list(hashsplit.split_to_blobs(makeblob, [StringIO(data)],
+                                             keep_boundaries=False,
+                                             progress=None, jobs=jobs))
+    serial = split(1)
+    WVPASS(len(serial) > 100)
+    WVPASSEQ(split(4), serial)
+
+    # makeblob() gets whatever prepare() returned, in order.
+    prepared = list(hashsplit.split_to_blobs(lambda x: x,
+                                             [StringIO(data)],
+                                             keep_boundaries=False,
+                                             progress=None,
+                                             prepare=makeblob, jobs=3))
+    WVPASSEQ(prepared, serial)
+
+    def fail(b):
+        raise ValueError('prepare failed')
+    WVEXCEPT(ValueError, list, hashsplit.split_to_blobs(lambda x: x,
+                                                         [StringIO(data)],
+                                                         False, None,
+                                                         prepare=fail,
+                                                         jobs=2))
+
+
+@wvtest
+def test_split_params():
+    config = {}
+    WVPASSEQ(hashsplit.split_params(config.get),
+             (_helpers.DEFAULT_BLOBBITS, _helpers.DEFAULT_WINDOWBITS,
+              'rollsum'))
+    config['bup.blobbits'] = '16\n'
+    config['bup.chunker'] = 'gear'
+    WVPASSEQ(hashsplit.split_params(config.get),
+             (16, _helpers.DEFAULT_WINDOWBITS, 'gear'))
+    config['bup.chunker'] = 'buzhash'
+    WVEXCEPT(ValueError, hashsplit.split_params, config.get)
+    del config['bup.chunker']
+    config['bup.windowbits'] = 'x'
+    WVEXCEPT(ValueError, hashsplit.split_params, config.get)
+
+    WVEXCEPT(ValueError, hashsplit.configure, 9, 6)
+    WVEXCEPT(ValueError, hashsplit.configure, 13, 13)
+    WVEXCEPT(ValueError, hashsplit.configure, 13, 6, 'buzhash')
+    WVPASSEQ(_helpers.blobbits(), _helpers.DEFAULT_BLOBBITS)
+
+    data = os.urandom(4*1024*1024)
+    def chunks():
+        return [len(b) for (b, level) in
+                hashsplit.hashsplit_iter([StringIO(data)], False, None)]
+    default_chunks = chunks()
+    try:
+        hashsplit.configure(16, 7)
+        WVPASSEQ((_helpers.blobbits(), _helpers.windowbits()), (16, 7))
+        WVPASSEQ(hashsplit.BLOB_MAX, 4*65536)
+        big_chunks = chunks()
+        WVPASSEQ(sum(big_chunks), len(data))
+        WVPASSLT(len(big_chunks)*4, len(default_chunks))
+        WVPASS(max(big_chunks) > 8192*4)
+    finally:
+        hashsplit.configure(_helpers.DEFAULT_BLOBBITS,
+                            _helpers.DEFAULT_WINDOWBITS)
+    WVPASSEQ(hashsplit.BLOB_MAX, 8192*4)
+    WVPASSEQ(hashsplit.BLOB_READ_SIZE, 1024*1024)
+    WVPASSEQ(chunks(), default_chunks)
+
+
+@wvtest
+def test_rollsum_impls():
+    WVPASS(len(hashsplit.ROLLSUM_IMPLS) >= 2)
+    WVPASS('reference' in hashsplit.ROLLSUM_IMPLS)
+    WVPASSEQ(_helpers.rollsum_impl(), hashsplit.ROLLSUM_IMPLS[0])
+    WVEXCEPT(ValueError, _helpers.set_rollsum_impl, 'nonesuch')
+    # Different parameters, short inputs, and runs of zeros.
+    data = os.urandom(200000) + '\0' * 100000 + os.urandom(300)
+    try:
+        for (blobbits, windowbits) in ((13, 6), (10, 4), (13, 12)):
+            hashsplit.configure(blobbits, windowbits)
+            points = []
+            for impl in hashsplit.ROLLSUM_IMPLS:
+                _helpers.set_rollsum_impl(impl)
+                points.append([_helpers.splitbuf(data[:n])
+                               for n in (0, 1, 15, 4095, 4097)]
+                              + _helpers.splitbuf_all(data, hashsplit.BLOB_MAX))
+            for p in points[1:]:
+                WVPASS(p == points[0])
+    finally:
+        _helpers.set_rollsum_impl(hashsplit.ROLLSUM_IMPLS[0])
+        hashsplit.configure(_helpers.DEFAULT_BLOBBITS,
+                            _helpers.DEFAULT_WINDOWBITS)
+
+
+@wvtest
+def test_gear_chunker():
+    data = os.urandom(2*1024*1024)
+    def chunks(data):
+        return [str(b) for (b, level) in
+                hashsplit.hashsplit_iter([StringIO(data)], False, None)]
+    rollsum_chunks = chunks(data)
+    try:
+        hashsplit.configure(_helpers.DEFAULT_BLOBBITS,
+                            _helpers.DEFAULT_WINDOWBITS, 'gear')
+        WVPASSEQ(_helpers.chunker(), 'gear')
+        gear_chunks = chunks(data)
+        WVPASSEQ(''.join(gear_chunks), data)
+        WVPASS(gear_chunks != rollsum_chunks)
+        # Never shorter than a quarter of the average, except at the end.
+        WVPASS(min(len(c) for c in gear_chunks[:-1]) > 2048)
+        WVPASS(len(data)/16384 < len(gear_chunks) < len(data)/4096)
+        # Inserting data only changes the chunks around it.
+        shifted = chunks(os.urandom(100) + data)
+        WVPASS(len(set(gear_chunks) & set(shifted)) > len(gear_chunks) - 10)
+    finally:
+        hashsplit.configure(_helpers.DEFAULT_BLOBBITS,
+                            _helpers.DEFAULT_WINDOWBITS)
+    WVPASSEQ(_helpers.chunker(), 'rollsum')
+
+
+@wvtest
+def test_bench_chunkers():
+    data = os.urandom(1024*1024)
+    results = hashsplit.bench_chunkers([data, data])
+    WVPASSEQ([r[0] for r in results],
+             ['rollsum/%s' % x for x in hashsplit.ROLLSUM_IMPLS] + ['gear'])
+    for (chunker, secs, count, unique) in results:
+        WVPASS(secs >= 0)
+        WVPASS(count > 2*len(data)/(4*8192))
+        WVPASSEQ(unique, len(data))
+    WVPASSEQ(_helpers.chunker(), 'rollsum')
+    WVPASSEQ(_helpers.rollsum_impl(), hashsplit.ROLLSUM_IMPLS[0])
+    # All the rollsum implementations split the same way.
+    WVPASSEQ(len(set(r[2] for r in results[:-1])), 1)
+    WVPASSEQ(results[0][2],
+             2*len(list(hashsplit.hashsplit_iter([StringIO(data)],
+                                                 False, None))))
+
+
+@wvtest
+def test_sparse_files():
+    # A file with holes must split exactly like the same data read from
+    # a regular file, but the holes shouldn't be read or hashed.
+    data = os.urandom(300000)
+    tf = tempfile.NamedTemporaryFile(dir=bup_tmp, prefix='bup-thashsplit-')
+    tf.write(data)
+    tf.seek(5*1024*1024 + 12345)
+    tf.write(data)
+    tf.truncate(8*1024*1024)
+    tf.flush()
+    content = data + '\0' * (5*1024*1024 + 12345 - len(data)) + data
+    content += '\0' * (8*1024*1024 - len(content))
+
+    def chunks(f, readahead=False):
+        return [(Sha1(b).hexdigest(), len(b), level, zero) for
+                (b, level, zero) in hashsplit._chunk_iter([f], False, None,
+                                                          readahead)]
+    expected = chunks(StringIO(content))
+    WVPASSEQ(sum(c[1] for c in expected), len(content))
+    WVPASS(not [c for c in expected if c[3]])
+    for readahead in (False, True):
+        sparse = chunks(open(tf.name), readahead)
+        WVPASSEQ([c[:3] for c in sparse], [c[:3] for c in expected])
+    if not hashsplit._sparse_fd(open(tf.name)):
+        return  # the filesystem (or the OS) doesn't do holes
+    zeros = [c for c in sparse if c[3]]
+    WVPASS(len(zeros) > 100)
+    WVPASSEQ(set(c[0] for c in zeros),
+             set(Sha1('\0' * c[1]).hexdigest() for c in zeros))
+
+    # Each size of zero chunk is only prepared and written once.
+    for jobs in (1, 3):
+        written = []
+        def makeblob(b):
+            written.append(len(b))
+            return Sha1(b).hexdigest()
+        shas = list(hashsplit.split_to_blobs(makeblob, [open(tf.name)],
+                                             False, None, jobs=jobs))
+        WVPASSEQ(shas, [c[:3] for c in expected])
+        WVPASSEQ(len(written), len(expected) - len(zeros)
+                 + len(set(c[1] for c in zeros)))
+
+
+@wvtest
+def test_append_point():
+    # Splitting an appended-to file from append_point() has to give the
+    # same tree as splitting all of it again.
+    objs = {}
+    def makeblob(b):
+        sha = Sha1('blob %d\0%s' % (len(b), b)).digest()
+        objs[sha] = str(b)
+        return sha
+    def maketree(shalist):
+        sha = Sha1(repr(shalist)).digest()
+        objs[sha] = shalist
+        return sha
+    def save(f, stacks=None):
+        return hashsplit.split_to_blob_or_tree(makeblob, maketree, [f], False,
+                                               stacks=stacks)
+
+    old_fanout = hashsplit.fanout
+    try:
+        hashsplit.fanout = 2  # lots of levels
+        # Random-looking, but always the same, so the split points are too.
+        data = ''.join(Sha1(str(i)).digest() for i in xrange(160000))
+        expected = save(StringIO(data))
+        WVPASSEQ(expected[0], hashsplit.GIT_MODE_TREE)
+        resumed = 0
+        for size in (100, 70000, 1024*1024 - 3, 1024*1024 + 40000,
+                     2*1024*1024 + 12345, len(data) - 1000, len(data)):
+            (mode, sha) = save(StringIO(data[:size]))
+            f = StringIO(data)
+            r = hashsplit.append_point(f, mode, sha, objs.__getitem__)
+            if not r:
+                WVPASS(size < 100000)  # one or two chunks
+                continue
+            (ofs, stacks) = r
+            WVPASS(0 < ofs < size)
+            WVPASSEQ(f.tell(), ofs)
+            WVPASSEQ(save(f, stacks), expected)
+            resumed += 1
+        WVPASSEQ(resumed, 6)
+
+        # Changes before the last chunk are noticed.
+        (mode, sha) = save(StringIO(data[:2*1024*1024]))
+        (ofs, stacks) = hashsplit.append_point(StringIO(data), mode, sha,
+                                               objs.__getitem__)
+        changed = data[:ofs-1] + chr(ord(data[ofs-1]) ^ 1) + data[ofs:]
+        WVPASSEQ(hashsplit.append_point(StringIO(changed), mode, sha,
+                                        objs.__getitem__), None)
+        WVPASSEQ(hashsplit.append_point(StringIO(data[:ofs-1]), mode, sha,
+                                        objs.__getitem__), None)
+    finally:
+        hashsplit.fanout = old_fanout
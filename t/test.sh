@@ -144,6 +144,11 @@ WVPASSEQ "$(cat tag[ab].tmp | bup split -b --git-ids)" \
          "$(cat tagab.tmp)"
 WVPASS bup split --bench -b <"$top/t/testfile1" >tags1.tmp
 WVPASS bup split -vvvv -b "$top/t/testfile2" >tags2.tmp
+WVPASS bup split --bench-chunkers "$top/t/testfile1" 2>chunkers.tmp
+WVPASS grep -q '^rollsum.*dedup ratio' chunkers.tmp
+WVPASS grep -q '^gear.*dedup ratio' chunkers.tmp
+WVPASS grep -q '^rollsum/reference.*GB/s' chunkers.tmp
+WVFAIL bup split --bench-chunkers --noop "$top/t/testfile1"
 WVPASS echo -n "" | bup split -n split_empty_string.tmp
 WVPASS bup margin
 WVPASS bup midx -f